@@ -0,0 +1,173 @@
+import os
+import glob
+import json
+import time
+import torch
+import sqlite3
+import hashlib
+import threading
+
+from typing import Dict, List, Optional, Union
+
+def compute_model_fingerprint(pretrained_model_name_or_path: Union[str, os.PathLike], sample_size: int = 1 << 16) -> str:
+    """
+    Fingerprints a model from its 'config.json' and its weight files, without reading all the weights.
+
+    NOTE: Each weight file contributes its name, size and a sample of bytes from its start and end, which is
+          enough to tell apart different fine-tunes of the same base model (as these have identical headers).
+    """
+    fingerprint = hashlib.sha256()
+    with open(os.path.join(pretrained_model_name_or_path, 'config.json'), 'rb') as f:
+        fingerprint.update(f.read())
+    weight_files = sorted(
+        glob.glob(os.path.join(pretrained_model_name_or_path, "*.safetensors")) +
+        glob.glob(os.path.join(pretrained_model_name_or_path, "*.bin"))
+    )
+    for file_path in weight_files:
+        size = os.path.getsize(file_path)
+        fingerprint.update(f"{os.path.basename(file_path)}:{size}".encode())
+        with open(file_path, 'rb') as f:
+            fingerprint.update(f.read(sample_size))
+            f.seek(max(0, size - sample_size))
+            fingerprint.update(f.read(sample_size))
+    return fingerprint.hexdigest()
+
+class ActivationCache:
+    """
+    A persistent, content-addressed cache of last-token deltas.
+
+    Entries are keyed by a hash of (model fingerprint, capture settings, token ids), so identical conversations
+    are only ever run once: whether repeated within a run or seen in an earlier run (eg: with a different axis or
+    more samples). The total size is capped, with the least recently used entries evicted first.
+    """
+
+    DATABASE_FILENAME = "activations.sqlite"
+
+    def __init__(
+        self,
+        path: Union[str, os.PathLike],
+        model_fingerprint: str,
+        settings: dict,
+        dtype: torch.dtype,
+        max_size: Optional[int] = None
+    ):
+        self.path = path
+        self.dtype = dtype
+        self.max_size = max_size
+
+        # Everything that changes the stored values must be part of the key.
+        self.prefix = hashlib.sha256(
+            json.dumps({"model": model_fingerprint, "dtype": str(dtype), **settings}, sort_keys = True).encode()
+        ).digest()
+
+        os.makedirs(path, exist_ok = True)
+        # NOTE: The lookups and additions come from different threads when sampling is pipelined, so serialise them.
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(os.path.join(path, self.DATABASE_FILENAME), check_same_thread = False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, value BLOB, size INTEGER, last_access INTEGER)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.connection.commit()
+        # NOTE: The total size is kept up to date by put() and _evict(), rather than summed on every put.
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_duplicates = 0
+        self.num_evictions = 0
+        self.added_keys = set()
+
+    def get_key(self, tokens: torch.Tensor) -> bytes:
+        return hashlib.sha256(self.prefix + tokens.reshape(-1).to(torch.int64).numpy().tobytes()).digest()
+
+    def get(self, keys: List[bytes], shape: List[int]) -> Dict[bytes, torch.Tensor]:
+        """
+        Looks up the keys, returning the deltas (of the given shape) of those found.
+        """
+        with self.lock:
+            unique_keys = list(dict.fromkeys(keys))
+            found = {}
+            for start in range(0, len(unique_keys), 512):
+                chunk = unique_keys[start:start + 512]
+                rows = self.connection.execute(
+                    f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = torch.frombuffer(bytearray(value), dtype = self.dtype).reshape(shape)
+
+            # Touch the entries found, so they are evicted last.
+            now = time.time_ns()
+            self.connection.executemany("UPDATE entries SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+            self.connection.commit()
+
+            for key in keys:
+                if key in found:
+                    self.num_hits += 1
+                    if key in self.added_keys:
+                        self.num_duplicates += 1
+                else:
+                    self.num_misses += 1
+            return found
+
+    def put(self, keys: List[bytes], deltas: torch.Tensor) -> None:
+        """
+        Adds the deltas (one row per key), then evicts entries if over the size cap.
+        """
+        with self.lock:
+            now = time.time_ns()
+            rows = {}
+            for key, delta in zip(keys, deltas):
+                value = delta.to(self.dtype).contiguous().view(torch.uint8).numpy().tobytes()
+                rows[key] = (key, value, len(value), now)
+                self.added_keys.add(key)
+            # Any entries replaced no longer count towards the total size.
+            replaced_size = 0
+            unique_keys = list(rows)
+            for start in range(0, len(unique_keys), 512):
+                chunk = unique_keys[start:start + 512]
+                replaced_size += self.connection.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchone()[0]
+            self.connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", list(rows.values()))
+            self.connection.commit()
+            self.size += sum(row[2] for row in rows.values()) - replaced_size
+            if self.max_size is not None:
+                self._evict(self.max_size)
+
+    def get_size(self) -> int:
+        with self.lock:
+            return self.size
+
+    def record_duplicates(self, count: int) -> None:
+        """
+        Counts lookups answered from deltas computed earlier in this run, without going to the database.
+        """
+        with self.lock:
+            self.num_hits += count
+            self.num_duplicates += count
+
+    def print_statistics(self) -> None:
+        lookups = self.num_hits + self.num_misses
+        hit_rate = 100 * self.num_hits / lookups if lookups > 0 else 0
+        print(f"Activation cache: {self.num_hits} hits ({hit_rate:.1f}%; {self.num_duplicates} within this run), "
+              f"{self.num_misses} misses, {self.num_evictions} evictions, {self.get_size() / (1 << 30):.2f} GiB.")
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _evict(self, max_size: int) -> None:
+        excess = self.get_size() - max_size
+        if excess <= 0:
+            return
+        evicted = []
+        evicted_size = 0
+        for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            if evicted_size >= excess:
+                break
+            evicted.append((key,))
+            evicted_size += size
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self.connection.commit()
+        self.size -= evicted_size
+        self.num_evictions += len(evicted)
@@ -0,0 +1,362 @@
+import os
+import gc
+import sys
+import json
+import time
+import torch
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+from typing import Callable, List, Optional
+
+from dataset_manager import DatasetManager
+from hidden_state_store import HiddenStateStore
+from hidden_state_data_manager import HiddenStateDataManager
+from direction_analyzer import DirectionAnalyzer, compute_eigenvectors, project_data_onto_directions, compute_discriminant_ratios
+from gguf_exporter import export_gguf
+from weight_orthogonalizer import orthogonalize_checkpoint
+
+STAGES = [
+    "dataset_manager",
+    "tokenize",
+    "sample",
+    "modify_tensors",
+    "orthogonalize_checkpoint",
+    "store_save",
+    "store_load",
+    "direction_analysis",
+    "export_gguf",
+]
+
+# A minimal chat template, so the tiny model goes through the same tokenization path as a real one.
+CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}<|{{ message['role'] }}|>\n{{ message['content'] }}{{ eos_token }}\n{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+)
+
+class MemoryMonitor:
+    """
+    Tracks the peak resident set size (by polling '/proc/self/statm') and the peak CUDA memory of a block.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.running = False
+        self.start_rss = 0
+        self.peak_rss = 0
+
+    def __enter__(self):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.start_rss = self.peak_rss = self._get_rss()
+        self.running = True
+        self.thread = threading.Thread(target = self._poll, daemon = True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # @UnusedVariable
+        self.running = False
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, self._get_rss())
+
+    def get_peak_rss_mb(self) -> Optional[float]:
+        return (self.peak_rss - self.start_rss) / (1 << 20) if self.start_rss else None
+
+    def get_peak_cuda_mb(self) -> Optional[float]:
+        return torch.cuda.max_memory_allocated() / (1 << 20) if torch.cuda.is_available() else None
+
+    def _poll(self) -> None:
+        while self.running:
+            self.peak_rss = max(self.peak_rss, self._get_rss())
+            time.sleep(self.interval)
+
+    def _get_rss(self) -> int:
+        try:
+            with open("/proc/self/statm", 'r') as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            return 0
+
+class Benchmark:
+
+    def __init__(self, repeats: int = 1):
+        self.repeats = repeats
+        self.results = []
+
+    def measure(self, stage: str, params: dict, function: Callable):
+        """
+        Times (the best of the repeats) and memory-profiles a stage, returning the value of the last run.
+        """
+        times = []
+        peak_rss_mb = []
+        peak_cuda_mb = []
+        for _ in range(self.repeats):
+            gc.collect()
+            with MemoryMonitor() as monitor:
+                start = time.perf_counter()
+                value = function()
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                times.append(time.perf_counter() - start)
+            peak_rss_mb.append(monitor.get_peak_rss_mb())
+            peak_cuda_mb.append(monitor.get_peak_cuda_mb())
+        self.add(stage, params, min(times), times, max(peak_rss_mb, key = lambda x: x or 0), max(peak_cuda_mb, key = lambda x: x or 0))
+        return value
+
+    def add(self, stage: str, params: dict, seconds: float, all_seconds: List[float], peak_rss_mb = None, peak_cuda_mb = None) -> None:
+        self.results.append({
+            "stage": stage,
+            "params": params,
+            "seconds": seconds,
+            "all_seconds": all_seconds,
+            "peak_rss_mb": peak_rss_mb,
+            "peak_cuda_mb": peak_cuda_mb,
+        })
+        memory = f", peak RSS +{peak_rss_mb:.1f} MiB" if peak_rss_mb is not None else ""
+        print(f"- {stage} {params}: {seconds:.3f}s{memory}")
+
+def get_environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            capture_output = True,
+            text = True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "num_threads": torch.get_num_threads(),
+        "cuda": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+def build_tiny_model(path: str, texts: List[str], hidden_size: int, num_layers: int, vocab_size: int = 2048) -> None:
+    """
+    Builds a tiny random-init Llama model (and a BPE tokenizer trained on the texts), so no downloads are needed.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    special_tokens = ["<unk>", "<s>", "</s>", "<|system|>", "<|user|>", "<|assistant|>"]
+    tokenizer = Tokenizer(models.BPE(unk_token = "<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space = False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(vocab_size = vocab_size, special_tokens = special_tokens))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object = tokenizer, bos_token = "<s>", eos_token = "</s>", unk_token = "<unk>", pad_token = "</s>")
+    tokenizer.chat_template = CHAT_TEMPLATE
+    tokenizer.save_pretrained(path)
+
+    config = LlamaConfig(
+        vocab_size = len(tokenizer),
+        hidden_size = hidden_size,
+        intermediate_size = 4 * hidden_size,
+        num_hidden_layers = num_layers,
+        num_attention_heads = max(1, hidden_size // 64),
+        num_key_value_heads = max(1, hidden_size // 64),
+        max_position_embeddings = 2048,
+        bos_token_id = tokenizer.bos_token_id,
+        eos_token_id = tokenizer.eos_token_id,
+        torch_dtype = "float32",
+        architectures = ["LlamaForCausalLM"],
+    )
+    torch.manual_seed(0)
+    LlamaForCausalLM(config).save_pretrained(path, safe_serialization = True)
+
+def create_synthetic_data(num_samples: int, hidden_size: int, signal: float = 2.0) -> List[torch.Tensor]:
+    # Two differenced classes separated along a single random direction, so some directions pass the filter.
+    generator = torch.Generator().manual_seed(0)
+    direction = torch.nn.functional.normalize(torch.randn(hidden_size, generator = generator), dim = 0)
+    return [
+        torch.randn(num_samples, hidden_size, generator = generator) - signal * direction,
+        torch.randn(num_samples, hidden_size, generator = generator) + signal * direction
+    ]
+
+def benchmark_pipeline(benchmark: Benchmark, args, stages: List[str], work_path: str) -> None:
+    from model_handler import ModelHandler
+
+    print(f"Pipeline (tiny model: hidden_size = {args.tiny_hidden_size}, num_layers = {args.tiny_num_layers}):")
+    model_path = os.path.join(work_path, "tiny_model")
+    with open(args.writing_prompts_file, 'r') as f:
+        texts = [line.strip() for line in f]
+    with open(args.prompt_stems_file, 'r') as f:
+        texts += sum(json.load(f).values(), [])
+    build_tiny_model(model_path, texts, args.tiny_hidden_size, args.tiny_num_layers)
+
+    params = {"num_prompt_samples": args.num_prompt_samples}
+    dataset_manager = benchmark.measure("dataset_manager", params, lambda: DatasetManager(
+        args.prompt_stems_file,
+        args.continuations_file,
+        args.writing_prompts_file,
+        args.num_prompt_samples
+    ))
+
+    model_handler = ModelHandler(model_path, device = "cpu")
+    hidden_state_data_manager = HiddenStateDataManager.open_for_sampling(model_handler)
+    dataset_tokens = benchmark.measure(
+        "tokenize",
+        params,
+        lambda: hidden_state_data_manager._tokenize_datasets(dataset_manager, False)
+    )
+
+    if "sample" in stages:
+        hidden_state_data_manager.batch_size = args.batch_size
+        hidden_state_data_manager.max_batch_tokens = None
+        hidden_state_data_manager.checkpoint_interval = float("inf")
+        hidden_state_data_manager.num_sampling_workers = 1
+
+        def sample():
+            hidden_state_data_manager.store = HiddenStateStore.create(
+                os.path.join(work_path, "tiny_model_hidden_state_samples"),
+                num_classes = len(dataset_tokens),
+                num_samples = len(dataset_tokens[0]),
+                num_layers = model_handler.get_num_layers(),
+                layer_indices = list(range(model_handler.get_num_layers())),
+                hidden_size = model_handler.get_hidden_size(),
+                dtype = model_handler.torch_dtype
+            )
+            hidden_state_data_manager._generate_hidden_state_samples(dataset_tokens)
+            hidden_state_data_manager.store.mark_complete()
+        benchmark.measure("sample", {**params, "batch_size": args.batch_size}, sample)
+
+    direction_matrix = torch.randn(1, model_handler.get_hidden_size())
+    if "modify_tensors" in stages:
+        benchmark.measure(
+            "modify_tensors",
+            {"hidden_size": args.tiny_hidden_size, "num_layers": args.tiny_num_layers},
+            lambda: model_handler.modify_tensors(direction_matrix, 0, 0)
+        )
+    if "orthogonalize_checkpoint" in stages:
+        benchmark.measure(
+            "orthogonalize_checkpoint",
+            {"hidden_size": args.tiny_hidden_size, "num_layers": args.tiny_num_layers},
+            lambda: orthogonalize_checkpoint(model_path, os.path.join(work_path, "tiny_model_orthogonalized"), direction_matrix)
+        )
+    model_handler.delete()
+
+def benchmark_synthetic(benchmark: Benchmark, args, stages: List[str], work_path: str, num_samples: int, hidden_size: int) -> None:
+    print(f"Synthetic (num_samples = {num_samples}, hidden_size = {hidden_size}):")
+    params = {"num_samples": num_samples, "hidden_size": hidden_size}
+    data = create_synthetic_data(num_samples, hidden_size)
+
+    store_path = os.path.join(work_path, f"synthetic_{num_samples}_{hidden_size}")
+    if "store_save" in stages or "store_load" in stages:
+        def save():
+            # The differenced classes are stored as (baseline, negative, positive) with a zero baseline.
+            store = HiddenStateStore.create(store_path, 3, num_samples, 1, [0], hidden_size, getattr(torch, args.store_dtype))
+            for start in range(0, num_samples, 1024):
+                rows = torch.stack([torch.zeros_like(data[0][start:start + 1024]), data[0][start:start + 1024], data[1][start:start + 1024]])
+                num_rows = rows.shape[1]
+                store.write(
+                    [c for c in range(3) for _ in range(num_rows)],
+                    [s for _ in range(3) for s in range(start, start + num_rows)],
+                    rows.reshape(3 * num_rows, 1, hidden_size)
+                )
+            store.mark_complete()
+        benchmark.measure("store_save", {**params, "dtype": args.store_dtype}, save)
+    if "store_load" in stages:
+        def load():
+            hidden_state_data_manager = HiddenStateDataManager.open(store_path)
+            return [d.to(torch.float32) for d in hidden_state_data_manager.get_differenced_datasets(0, [1, 2])]
+        benchmark.measure("store_load", {**params, "dtype": args.store_dtype}, load)
+
+    if "direction_analysis" in stages:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        data = [d.to(device) for d in data]
+        for eigen_solver in args.eigen_solvers:
+            solver_params = {**params, "eigen_solver": eigen_solver, "num_eigenvectors": args.num_eigenvectors}
+            directions = benchmark.measure(
+                "direction_eigenvectors",
+                solver_params,
+                lambda: compute_eigenvectors(data[0], data[1], eigen_solver, args.num_eigenvectors)
+            )
+
+            def score():
+                discriminant_ratios = []
+                desired_means = []
+                for start in range(0, directions.shape[0], 1024):
+                    projected_scores = [project_data_onto_directions(d, directions[start:start + 1024]) for d in data]
+                    discriminant_ratios.append(compute_discriminant_ratios(projected_scores[0], projected_scores[1]))
+                    desired_means.append(projected_scores[1].mean(dim = 0))
+                return {"directions": directions, "discriminant_ratios": torch.cat(discriminant_ratios), "desired_means": torch.cat(desired_means)}
+            scores = benchmark.measure("direction_scoring", solver_params, score)
+
+            benchmark.measure(
+                "direction_greedy_search",
+                solver_params,
+                lambda: DirectionAnalyzer._search_layer_data(data, scores, args.discriminant_ratio_tolerance)
+            )
+
+            benchmark.measure(
+                "direction_analysis",
+                solver_params,
+                lambda: DirectionAnalyzer._analyze_layer_data(data, args.discriminant_ratio_tolerance, eigen_solver, args.num_eigenvectors)
+            )
+
+    if "export_gguf" in stages:
+        try:
+            import gguf  # @UnusedImport
+        except ImportError:
+            print("- export_gguf: skipped (the 'gguf' package is not installed)")
+            return
+        directions = [torch.randn(1, hidden_size) for _ in range(args.num_gguf_layers)]
+        benchmark.measure(
+            "export_gguf",
+            {"hidden_size": hidden_size, "num_layers": args.num_gguf_layers},
+            lambda: export_gguf(directions, os.path.join(work_path, "synthetic.gguf"), "llama", args.num_gguf_layers)
+        )
+
+def main(args):
+    torch.set_grad_enabled(False)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    stages = args.stages or STAGES
+    benchmark = Benchmark(args.repeats)
+    with tempfile.TemporaryDirectory(dir = args.work_path) as work_path:
+        if any(stage in stages for stage in STAGES[:5]):
+            benchmark_pipeline(benchmark, args, stages, work_path)
+        if any(stage in stages for stage in STAGES[5:]):
+            for hidden_size in args.hidden_sizes:
+                for num_samples in args.num_samples:
+                    benchmark_synthetic(benchmark, args, stages, work_path, num_samples, hidden_size)
+
+    report = {"environment": get_environment(), "results": benchmark.results}
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent = 2)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2)
+        print(f"Results written to '{args.output}'")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark each stage using a tiny local model and synthetic hidden states.")
+    parser.add_argument("--output", type = str, default = "benchmark_results.json", help = "The JSON file to write the results to ('-' for stdout).")
+    parser.add_argument("--stages", type = str, nargs = "+", default = None, choices = STAGES, help = "The stages to benchmark (default: all).")
+    parser.add_argument("--repeats", type = int, default = 1, help = "The number of times to run each stage (the fastest is reported).")
+    parser.add_argument("--work_path", type = str, default = None, help = "The folder to create temporary files in (default: the system's).")
+    parser.add_argument("--num_threads", type = int, default = None, help = "The number of intra-op threads PyTorch uses.")
+    parser.add_argument("--prompt_stems_file", type = str, default = "data/prompt_stems.json", help = "The file path for prompt stems.")
+    parser.add_argument("--continuations_file", type = str, default = "data/dark_tetrad_continuations/honesty_vs_machiavellianism.json", help = "The file path for continuations.")
+    parser.add_argument("--writing_prompts_file", type = str, default = "data/writing_prompts.txt", help = "The file path for writing prompts.")
+    parser.add_argument("--num_prompt_samples", type = int, default = 300, help = "The number of prompts to sample, split evenly between the classes (pipeline stages).")
+    parser.add_argument("--batch_size", type = int, default = 8, help = "The maximum number of prompts per forward pass (pipeline stages).")
+    parser.add_argument("--tiny_hidden_size", type = int, default = 128, help = "The hidden size of the tiny model.")
+    parser.add_argument("--tiny_num_layers", type = int, default = 4, help = "The number of layers of the tiny model.")
+    parser.add_argument("--hidden_sizes", type = int, nargs = "+", default = [4096], help = "The hidden sizes of the synthetic datasets (eg: 4096 8192 12288).")
+    parser.add_argument("--num_samples", type = int, nargs = "+", default = [1000], help = "The number of samples of the synthetic datasets (eg: 1000 10000 50000).")
+    parser.add_argument("--store_dtype", type = str, default = "float16", choices = ["float32", "float16", "bfloat16"], help = "The dtype to store the synthetic datasets as.")
+    parser.add_argument("--eigen_solvers", type = str, nargs = "+", default = ["auto"], choices = ["auto", "dense", "gram", "randomized"], help = "The eigensolvers to benchmark.")
+    parser.add_argument("--num_eigenvectors", type = int, default = None, help = "The number of largest magnitude eigenvectors to compute (default: all).")
+    parser.add_argument("--discriminant_ratio_tolerance", type = float, default = 0.5, help = "Used to filter low signal \"noise\" directions (0 = none).")
+    parser.add_argument("--num_gguf_layers", type = int, default = 80, help = "The number of layers of directions to export.")
+    main(parser.parse_args())
@@ -0,0 +1,145 @@
+import torch
+
+from tqdm import tqdm
+
+from typing import List, Tuple, Optional
+
+# NOTE: These must survive the chat template unchanged (eg: no whitespace for 'trim' to strip).
+SLOT_MARKERS = ["<<<CONTROL_VECTORS_SLOT_0>>>", "<<<CONTROL_VECTORS_SLOT_1>>>"]
+
+# NOTE: SentencePiece tokenizers add a "▁" prefix to the start of any text encoded on its own, so text that follows
+# other text in the conversation is encoded after this anchor (and the anchor's ids are then stripped).
+CONTEXT_ANCHOR = "\n"
+
+class ChatTemplateTokenizer:
+    """
+    Tokenizes (system_message, prompt) conversations by splicing batch-encoded message bodies into a token id
+    "skeleton" rendered once from the chat template, rather than rendering and tokenizing every conversation.
+
+    Splicing isn't guaranteed to match tokenizing the whole rendered text (eg: merges across the slot boundaries),
+    so the result is checked token-for-token against 'apply_chat_template' on a sample of conversations, and falls
+    back to calling 'apply_chat_template' for every conversation if any differ.
+    """
+
+    def __init__(self, tokenizer, use_separate_system_message: bool, num_verification_samples: int = 16, batch_size: int = 1024):
+        self.tokenizer = tokenizer
+        self.use_separate_system_message = use_separate_system_message
+        self.num_verification_samples = num_verification_samples
+        self.batch_size = batch_size
+        self.slot_prefixes = []
+        self.skeleton = self._build_skeleton()
+
+    def tokenize(self, conversations: List[Tuple[str, str]]) -> List[torch.Tensor]:
+        """
+        Tokenizes the conversations (with the generation prompt added).
+
+        Parameters:
+            conversations (List[Tuple[str, str]]): The (system_message, prompt) pairs.
+
+        Returns:
+            List[torch.Tensor]: The token ids of each conversation, of shape [1, length].
+        """
+        if self.skeleton is not None:
+            token_list = self._tokenize_with_skeleton(conversations)
+            if self._verify(conversations, token_list):
+                return token_list
+            print("WARNING: The chat template skeleton doesn't match 'apply_chat_template', so falling back to it...")
+            self.skeleton = None
+
+        return [
+            self._apply_chat_template(self._get_bodies(*conversation))
+            for conversation in tqdm(conversations, desc = "Tokenizing prompts")
+        ]
+
+    def _get_bodies(self, system_message: str, prompt: str) -> List[str]:
+        if self.use_separate_system_message:
+            return [system_message, prompt]
+        return [system_message + " " + prompt]
+
+    def _get_messages(self, bodies: List[str]) -> List[dict]:
+        if self.use_separate_system_message:
+            return [
+                {"role": "system", "content": bodies[0]},
+                {"role": "user", "content": bodies[1]}
+            ]
+        return [{"role": "user", "content": bodies[0]}]
+
+    def _apply_chat_template(self, bodies: List[str]) -> torch.Tensor:
+        return self.tokenizer.apply_chat_template(
+            conversation = self._get_messages(bodies),
+            add_generation_prompt = True,
+            return_tensors = "pt"
+        )
+
+    def _encode(self, texts: List[str]) -> List[List[int]]:
+        # NOTE: The special tokens (eg: BOS) are already in the rendered template text.
+        return self.tokenizer(texts, add_special_tokens = False)["input_ids"] if texts else []
+
+    def _encode_in_context(self, texts: List[str]) -> List[List[int]]:
+        # Encode each text as it would be after a line break, falling back to encoding it on its own if it merged
+        # with the anchor (eg: a text starting with a line break, for some BPE tokenizers).
+        anchor = self._encode([CONTEXT_ANCHOR])[0]
+        encodings = self._encode([CONTEXT_ANCHOR + text for text in texts])
+        merged = [i for i, ids in enumerate(encodings) if ids[:len(anchor)] != anchor]
+        unanchored = dict(zip(merged, self._encode([texts[i] for i in merged])))
+        return [unanchored[i] if i in unanchored else ids[len(anchor):] for i, ids in enumerate(encodings)]
+
+    def _build_skeleton(self) -> Optional[List[List[int]]]:
+        num_slots = 2 if self.use_separate_system_message else 1
+        try:
+            text = self.tokenizer.apply_chat_template(
+                conversation = self._get_messages(SLOT_MARKERS[:num_slots]),
+                add_generation_prompt = True,
+                tokenize = False
+            )
+        except Exception as e:
+            print(f"WARNING: Unable to render the chat template skeleton: {e}")
+            return None
+
+        # Split the rendered text into the fixed pieces around each slot, moving any whitespace before a slot into its
+        # body (SentencePiece and most BPE pre-tokenizers attach a space to the word that follows it).
+        pieces = []
+        slot_prefixes = []
+        for marker in SLOT_MARKERS[:num_slots]:
+            if text.count(marker) != 1:
+                return None
+            piece, text = text.split(marker)
+            pieces.append(piece.rstrip())
+            slot_prefixes.append(piece[len(pieces[-1]):])
+        pieces.append(text)
+
+        self.slot_prefixes = slot_prefixes
+        return self._encode(pieces[:1]) + self._encode_in_context(pieces[1:])
+
+    def _tokenize_with_skeleton(self, conversations: List[Tuple[str, str]]) -> List[torch.Tensor]:
+        all_bodies = [
+            [prefix + body for prefix, body in zip(self.slot_prefixes, self._get_bodies(*conversation))]
+            for conversation in conversations
+        ]
+
+        # The stems, continuations and writing prompts repeat a lot, so only encode each distinct body once.
+        texts = list(dict.fromkeys(body for bodies in all_bodies for body in bodies))
+        encodings = {}
+        with tqdm(total = len(texts), desc = "Tokenizing prompts") as bar:
+            for start in range(0, len(texts), self.batch_size):
+                batch = texts[start:start + self.batch_size]
+                encodings.update(zip(batch, self._encode_in_context(batch)))
+                bar.update(n = len(batch))
+
+        token_list = []
+        for bodies in all_bodies:
+            ids = list(self.skeleton[0])
+            for body, piece in zip(bodies, self.skeleton[1:]):
+                ids += encodings[body]
+                ids += piece
+            token_list.append(torch.tensor([ids], dtype = torch.long))
+        return token_list
+
+    def _verify(self, conversations: List[Tuple[str, str]], token_list: List[torch.Tensor]) -> bool:
+        # Check evenly spaced conversations, so every class gets checked.
+        step = max(1, len(conversations) // max(1, self.num_verification_samples))
+        for index in range(0, len(conversations), step):
+            expected = self._apply_chat_template(self._get_bodies(*conversations[index]))
+            if not torch.equal(expected.to(torch.long), token_list[index]):
+                return False
+        return True
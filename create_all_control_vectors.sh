@@ -23,7 +23,7 @@ MODEL_ID="$2"
 OUTPUT_PREFIX="$3"
 NUM_PROMPT_SAMPLES="$4"
 
-# Define arrays for continuations and output suffixes
+# Define the array of continuations (one per axis)
 continuations=(
     "$DATA/writing_style_continuations/character_focus.json"
     "$DATA/writing_style_continuations/language.json"
@@ -35,27 +35,15 @@ continuations=(
     "$DATA/other_continuations/optimism_vs_nihilism.json"
 )
 
-output_suffixes=(
-    "character_focus_"
-    "language_"
-    "storytelling_"
-    "compassion_vs_sadism_"
-    "empathy_vs_sociopathy_"
-    "honesty_vs_machiavellianism_"
-    "humility_vs_narcissism_"
-    "optimism_vs_nihilism_"
-)
-
 # Set CUDA_VISIBLE_DEVICES
 export CUDA_VISIBLE_DEVICES="$CUDA_DEVICES"
 
-# Loop through continuations and create control vectors
-for i in "${!continuations[@]}"; do
-    python3 ./create_control_vectors.py \
-        --model_id "$MODEL_ID" \
-        --output_path "${OUTPUT_PREFIX}${output_suffixes[i]}" \
-        --prompt_stems_file "$STEMS" \
-        --writing_prompts_file "$PROMPTS" \
-        --continuations_file "${continuations[i]}" \
-        --num_prompt_samples "$NUM_PROMPT_SAMPLES"
-done
\ No newline at end of file
+# Load the model once, share the baseline samples and create control vectors for every axis.
+# NOTE: Each axis is saved to "${OUTPUT_PREFIX}<continuations file name>_" (eg: "model-prefix-language__debias.gguf").
+python3 ./create_control_vectors.py \
+    --model_id "$MODEL_ID" \
+    --output_path "${OUTPUT_PREFIX}" \
+    --prompt_stems_file "$STEMS" \
+    --writing_prompts_file "$PROMPTS" \
+    --continuations_file "${continuations[@]}" \
+    --num_prompt_samples "$NUM_PROMPT_SAMPLES"
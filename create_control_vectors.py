@@ -1,92 +1,214 @@
 import argparse
-import gc
 import sys
 import signal
 import torch
+import tracing
 
-from model_handler import ModelHandler
+from gguf_exporter import ModelMetadata, export_gguf_set
 from dataset_manager import DatasetManager
 from hidden_state_data_manager import HiddenStateDataManager
-from direction_analyzer import DirectionAnalyzer
+from direction_analyzer import DirectionAnalyzer, compute_layer_range
 
 def signal_handler(sig, frame):  # @UnusedVariable
     sys.exit(1)
 
-def free_memory():
-    gc.collect()
-    torch.cuda.empty_cache()
+def parse_skip_layers(value: str) -> tuple:
+    # Parses a 'skip_begin_layers,skip_end_layers' pair (either of which can be a fraction).
+    try:
+        skip_begin_layers, skip_end_layers = (float(x) for x in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected 'skip_begin_layers,skip_end_layers': {value}")
+    return skip_begin_layers, skip_end_layers
 
 def main(
     model_id,
     output_path,
     prompt_stems_file_path,
-    continuations_file_path,
+    continuations_file_paths,
     writing_prompts_file_path,
     num_prompt_samples,
+    seed,
     use_separate_system_message,
+    batch_size,
+    max_batch_tokens,
+    share_prefix,
+    use_statistics,
+    activation_cache_path,
+    activation_cache_size_gb,
+    checkpoint_interval,
+    device,
+    torch_dtype,
+    quantize_int8,
+    num_sampling_workers,
+    num_threads,
+    num_interop_threads,
+    storage_encoding,
+    verify_store,
     skip_begin_layers,
     skip_end_layers,
-    discriminant_ratio_tolerance
+    discriminant_ratio_tolerance,
+    num_analysis_workers,
+    analysis_worker_type,
+    eigen_solver,
+    num_eigenvectors,
+    eigen_cache_path,
+    sweep_discriminant_ratio_tolerances,
+    sweep_skip_layers,
+    trace_file,
+    trace_format
 ):
     signal.signal(signal.SIGINT, signal_handler)
 
+    # NOTE: The inter-op thread count must be set before any parallel work is started.
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+
     torch.inference_mode()
     torch.set_default_device("cpu")
     torch.set_grad_enabled(False)
 
-    # Updated DatasetManager instantiation
-    dataset_manager = DatasetManager(
-        prompt_stems_file_path,
-        continuations_file_path,
-        writing_prompts_file_path,
-        num_prompt_samples
-    )
-
-    hidden_state_data_manager = HiddenStateDataManager(
-        dataset_manager,
-        model_id,
-        output_path,
-        use_separate_system_message
-    )
-
-    direction_analyzer = DirectionAnalyzer(
-        hidden_state_data_manager,
-        skip_begin_layers,
-        skip_end_layers,
-        discriminant_ratio_tolerance
-    )
-
-    for i, direction_matrices_by_class in enumerate(direction_analyzer.direction_matrices):
-
-        if any(direction_matrix_by_layer is not None for direction_matrix_by_layer in direction_matrices_by_class):
-
-            # Free as much memory as possible and reload unquantized into system RAM.
-            free_memory()
-            model_handler = ModelHandler(
-                model_id,
-                device = "cpu"
-            )
-            
-            if i == 0:
-                name = "debias"
+    # Fail now rather than after sampling, as only the moments are kept with statistics.
+    if use_statistics and eigen_solver == "gram":
+        raise ValueError("The 'gram' eigensolver needs the samples, so can't be used with --use_statistics (use 'dense' or 'randomized').")
+
+    if trace_file is not None:
+        tracing.enable()
+
+    # NOTE: The trace is saved even if the run fails (or is interrupted), as that's often when it's most needed.
+    try:
+        # Only the model's metadata is needed to export, so there is no need to reload the model.
+        model_metadata = ModelMetadata(model_id)
+
+        # A sweep analyses every combination of tolerance and layer range, with the eigenvectors of each layer cached
+        # so they're only computed once.
+        sweep = sweep_discriminant_ratio_tolerances is not None or sweep_skip_layers is not None
+        discriminant_ratio_tolerances = sweep_discriminant_ratio_tolerances or [discriminant_ratio_tolerance]
+        num_layers = model_metadata.get_num_layers()
+        layer_ranges = [compute_layer_range(num_layers, *skip_layers) for skip_layers in sweep_skip_layers or [(skip_begin_layers, skip_end_layers)]]
+        if sweep and eigen_cache_path is None:
+            eigen_cache_path = output_path + "_eigen_cache"
+
+        # Sample (and analyse) the union of the layer ranges.
+        skip_begin_layers = min(layer_range.start for layer_range in layer_ranges)
+        skip_end_layers = num_layers - max(layer_range.stop for layer_range in layer_ranges)
+
+        dataset_manager = DatasetManager(
+            prompt_stems_file_path,
+            continuations_file_paths,
+            writing_prompts_file_path,
+            num_prompt_samples,
+            seed = seed
+        )
+
+        hidden_state_data_manager = HiddenStateDataManager(
+            dataset_manager,
+            model_id,
+            output_path,
+            use_separate_system_message,
+            batch_size,
+            max_batch_tokens,
+            skip_begin_layers,
+            skip_end_layers,
+            share_prefix,
+            use_statistics,
+            activation_cache_path,
+            int(activation_cache_size_gb * (1 << 30)) if activation_cache_size_gb is not None else None,
+            checkpoint_interval,
+            device,
+            None if torch_dtype == "auto" else torch_dtype,
+            quantize_int8,
+            num_sampling_workers,
+            num_threads,
+            None if storage_encoding == "auto" else storage_encoding,
+            verify_store
+        )
+
+        for axis_index, axis_name in enumerate(dataset_manager.axis_names):
+
+            class_indices = dataset_manager.axis_class_indices[axis_index]
+
+            # With more than one continuations file, each axis gets its own output path suffix.
+            if dataset_manager.get_num_axes() > 1:
+                print(f"Analysing axis '{axis_name}':")
+                axis_output_path = output_path + f"{axis_name}_"
             else:
-                name = dataset_manager.class_names[i]
-            
-            # Save as control vectors in '.gguf' format.
-            model_handler.export_gguf(direction_matrices_by_class, output_path + f"_{name}.gguf")
+                axis_output_path = output_path
+
+            names = ["debias"] + [dataset_manager.class_names[i] for i in class_indices]
+
+            for discriminant_ratio_tolerance in discriminant_ratio_tolerances:
+                if sweep:
+                    print(f"Sweeping discriminant_ratio_tolerance = {discriminant_ratio_tolerance:g}:")
+
+                direction_analyzer = DirectionAnalyzer(
+                    hidden_state_data_manager,
+                    skip_begin_layers,
+                    skip_end_layers,
+                    discriminant_ratio_tolerance,
+                    class_indices,
+                    num_analysis_workers,
+                    analysis_worker_type,
+                    eigen_solver,
+                    num_eigenvectors,
+                    eigen_cache_path
+                )
+
+                # Save the debias, negative and positive control vectors in '.gguf' format.
+                if not sweep:
+                    export_gguf_set(direction_analyzer.direction_matrices, names, axis_output_path, model_metadata)
+                    continue
+
+                # Each layer's result doesn't depend on the other layers, so each range just keeps its own layers.
+                for layer_range in layer_ranges:
+                    direction_matrices = [
+                        [directions if layer_index in layer_range else None for layer_index, directions in enumerate(class_directions)]
+                        for class_directions in direction_analyzer.direction_matrices
+                    ]
+                    sweep_output_path = axis_output_path + f"tolerance-{discriminant_ratio_tolerance:g}_layers-{layer_range.start + 1}-{layer_range.stop}_"
+                    export_gguf_set(direction_matrices, names, sweep_output_path, model_metadata)
+    finally:
+        if trace_file is not None:
+            tracing.save(trace_file, trace_format)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Modify and save a model based on baseline, desired and undesired instructions.")
     parser.add_argument("--model_id", type=str, required=True, help="The model ID to load the pretrained model from.")
     parser.add_argument("--output_path", type=str, required=True, help="The path to save the modified models to.")
     parser.add_argument("--prompt_stems_file", type=str, required=True, help="The file path for prompt stems.")
-    parser.add_argument("--continuations_file", type=str, required=True, help="The file path for continuations.")
+    parser.add_argument("--continuations_file", type=str, nargs="+", required=True, help="The file path(s) for continuations (one per axis).")
     parser.add_argument("--writing_prompts_file", type=str, required=True, help="The file path for writing prompts.")
-    parser.add_argument("--num_prompt_samples", type = int, default = 10000, help = "The number of prompts to sample per class.")
+    parser.add_argument("--num_prompt_samples", type = int, default = 10000, help = "The number of prompts to sample, split evenly between the classes.")
+    parser.add_argument("--seed", type = int, default = 0, help = "The random seed used to sample the prompts.")
     parser.add_argument("--use_separate_system_message", action="store_true", default=False, help="Use separate system message in conversation.")
+    parser.add_argument("--batch_size", type = int, default = 1, help = "The maximum number of prompts per forward pass.")
+    parser.add_argument("--max_batch_tokens", type = int, default = None, help = "The maximum number of (padded) tokens per forward pass.")
+    parser.add_argument("--share_prefix", action="store_true", default=False, help="Run the common prefix of each matched prompt tuple once and reuse its KV cache.")
+    parser.add_argument("--use_statistics", action="store_true", default=False, help="Accumulate per-layer statistics while sampling instead of storing the samples.")
+    parser.add_argument("--activation_cache", type = str, default = None, help = "The folder of a persistent cache of hidden states, reused across runs.")
+    parser.add_argument("--activation_cache_size_gb", type = float, default = 16, help = "The maximum size of the activation cache in GiB (least recently used entries are evicted).")
+    parser.add_argument("--checkpoint_interval", type = float, default = 300, help = "The number of seconds between checkpoints while sampling (so an interrupted run can be resumed).")
+    parser.add_argument("--device", type = str, default = "cuda", choices = ["cuda", "cpu"], help = "The device to sample the hidden states on.")
+    parser.add_argument("--dtype", type = str, default = "auto", choices = ["auto", "bfloat16", "float16", "float32"], help = "The dtype to sample with on the 'cpu' device (auto = from the model's config).")
+    parser.add_argument("--quantize_int8", action="store_true", default=False, help="Dynamically quantize the linear layers' weights to int8 on the 'cpu' device.")
+    parser.add_argument("--num_sampling_workers", type = int, default = 1, help = "The number of sampling processes, each with its own model replica (one GPU each for 'cuda').")
+    parser.add_argument("--num_threads", type = int, default = None, help = "The number of intra-op threads PyTorch uses (per sampling worker, if more than one).")
+    parser.add_argument("--num_interop_threads", type = int, default = None, help = "The number of inter-op threads PyTorch uses (default: PyTorch's default).")
+    parser.add_argument("--storage_encoding", type = str, default = "auto", choices = ["auto", "float32", "float16", "bfloat16", "int8", "int4"], help = "How to store the hidden state samples (auto = the model's dtype; int8/int4 use a scale per sample and layer).")
+    parser.add_argument("--verify_store", action = "store_true", default = False, help = "Check every stored sample against its checksum before reusing a complete run (reads the whole store).")
     parser.add_argument("--skip_begin_layers", type = int, default = 0, help = "The number (or fraction) of initial layers to skip.")
     parser.add_argument("--skip_end_layers", type = int, default = 1, help = "The number (or fraction) of end layers to skip.")
     parser.add_argument("--discriminant_ratio_tolerance", type = float, default = 0.5, help = "Used to filter low signal \"noise\" directions (0 = none).")
+    parser.add_argument("--num_analysis_workers", type = int, default = 1, help = "The number of layers to analyse in parallel.")
+    parser.add_argument("--analysis_worker_type", type = str, default = "thread", choices = ["thread", "process"], help = "Analyse the layers using threads or processes.")
+    parser.add_argument("--eigen_solver", type = str, default = "auto", choices = ["auto", "dense", "gram", "randomized"], help = "The eigensolver to use (auto = choose from the problem size).")
+    parser.add_argument("--num_eigenvectors", type = int, default = None, help = "The number of largest magnitude eigenvectors to compute (default: all).")
+    parser.add_argument("--eigen_cache", type = str, default = None, help = "The folder of a cache of each layer's eigenvectors, reused while the samples are unchanged (default: none, or '<output_path>_eigen_cache' when sweeping).")
+    parser.add_argument("--sweep_discriminant_ratio_tolerances", type = float, nargs = "+", default = None, help = "Export a control vector set for each of these tolerances (and each --sweep_skip_layers range).")
+    parser.add_argument("--sweep_skip_layers", type = parse_skip_layers, nargs = "+", default = None, help = "Export a control vector set for each of these 'skip_begin_layers,skip_end_layers' pairs (eg: 0,1 4,2 0.25,0.1).")
+    parser.add_argument("--trace_file", type = str, default = None, help = "The file to write the timings, counters and peak memory of each stage to (default: no tracing).")
+    parser.add_argument("--trace_format", type = str, default = "json", choices = ["json", "chrome"], help = "Write the trace as a JSON summary or in Chrome's trace event format (for chrome://tracing or Perfetto).")
     args = parser.parse_args()
     main(
         args.model_id,
@@ -95,8 +217,33 @@ if __name__ == "__main__":
         args.continuations_file,
         args.writing_prompts_file,
         args.num_prompt_samples,
+        args.seed,
         args.use_separate_system_message,
+        args.batch_size,
+        args.max_batch_tokens,
+        args.share_prefix,
+        args.use_statistics,
+        args.activation_cache,
+        args.activation_cache_size_gb,
+        args.checkpoint_interval,
+        args.device,
+        args.dtype,
+        args.quantize_int8,
+        args.num_sampling_workers,
+        args.num_threads,
+        args.num_interop_threads,
+        args.storage_encoding,
+        args.verify_store,
         args.skip_begin_layers,
         args.skip_end_layers,
-        args.discriminant_ratio_tolerance
+        args.discriminant_ratio_tolerance,
+        args.num_analysis_workers,
+        args.analysis_worker_type,
+        args.eigen_solver,
+        args.num_eigenvectors,
+        args.eigen_cache,
+        args.sweep_discriminant_ratio_tolerances,
+        args.sweep_skip_layers,
+        args.trace_file,
+        args.trace_format
     )
\ No newline at end of file
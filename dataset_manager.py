@@ -1,42 +1,78 @@
+import os
 import sys
 import json
 import random
-from typing import List
+import hashlib
+import tracing
+from typing import List, Optional, Union
 
 class DatasetManager:
 
     def __init__(
         self,
         prompt_stems_file_path: str,
-        continuations_file_path: str,
+        continuations_file_paths: Union[str, List[str]],
         writing_prompts_file_path: str,
         num_prompt_samples: int,
-        use_baseline_class: bool = True
+        use_baseline_class: bool = True,
+        seed: int = 0
     ):
         self.class_names: List[str] = []
         self.datasets = []
-        
+
+        # Each continuations file is an "axis", whose classes all share the same baseline samples.
+        self.axis_names: List[str] = []
+        self.axis_class_indices: List[List[int]] = []
+
         self.pre_prompt_stems: List[str] = []
         self.post_prompt_stems: List[str] = []
-        self.continuations: List[List[str]] = []
+        self.continuations: List[List[List[str]]] = []
         self.writing_prompts: List[str] = []
         
         self.use_baseline_class = use_baseline_class
+        self.seed = seed
         
         self._load_prompt_stems(prompt_stems_file_path)
-        self._load_continuations(continuations_file_path)
+        if self.use_baseline_class:
+            self.class_names = ['baseline']
+        if isinstance(continuations_file_paths, (str, os.PathLike)):
+            continuations_file_paths = [continuations_file_paths]
+        for continuations_file_path in continuations_file_paths:
+            self._load_continuations(continuations_file_path)
         self._load_writing_prompts(writing_prompts_file_path)
                 
-        self._generate_datasets(num_prompt_samples)
+        with tracing.span("generate_datasets"):
+            self._generate_datasets(num_prompt_samples)
         
         #self.print_datasets()
 
     def get_num_classes(self) -> int:
         return len(self.class_names)
+
+    def get_num_axes(self) -> int:
+        return len(self.axis_names)
+
+    def get_num_classes_per_axis(self) -> int:
+        return max(len(class_indices) for class_indices in self.axis_class_indices) + (1 if self.use_baseline_class else 0)
     
     def get_total_samples(self) -> int:
         return sum(len(dataset) for dataset in self.datasets)
 
+    def get_manifest(self, num_samples: Optional[int] = None) -> dict:
+        """
+        Returns a description of the sampled datasets, to check a saved run was sampled from the same datasets.
+
+        NOTE: Sample j doesn't depend on the number of samples, so the manifest of the first 'num_samples' samples
+              matches that of a smaller run with the same seed (which can then be topped up).
+        """
+        datasets = [dataset[:num_samples] for dataset in self.datasets]
+        return {
+            "seed": self.seed,
+            "class_names": self.class_names,
+            "num_samples": len(datasets[0]) if datasets else 0,
+            "hash": hashlib.sha256(json.dumps(datasets).encode()).hexdigest(),
+        }
+
     def print_datasets(self) -> None:
         print("Printing contents of datasets:")
         for index, dataset in enumerate(self.datasets):
@@ -85,13 +121,13 @@ class DatasetManager:
         if not data or 'classes' not in data or 'data' not in data:
             raise ValueError("Invalid or no data loaded.")
     
-        if self.use_baseline_class:
-            self.class_names = ['baseline'] + data['classes']  # Prepend "baseline" to the class names
-        else:
-            self.class_names = data['classes']
-        self.continuations = data['data']
+        # NOTE: The "baseline" class (if used) is prepended once and shared by all the axes.
+        self.axis_names.append(os.path.splitext(os.path.basename(file_path))[0])
+        self.axis_class_indices.append(list(range(self.get_num_classes(), self.get_num_classes() + len(data['classes']))))
+        self.class_names += data['classes']
+        self.continuations.append(data['data'])
     
-        print(f"Done ({self.get_num_classes()} classes; each with {len(self.continuations)} continuations loaded).")
+        print(f"Done ({len(data['classes'])} classes; each with {len(data['data'])} continuations loaded).")
 
     def _load_writing_prompts(self, file_path: str) -> List[str]:
         print(f"Loading writing prompts from '{file_path}'... ", end="")
@@ -108,30 +144,33 @@ class DatasetManager:
         self.writing_prompts = data
         print(f"Done ({len(data)} loaded).")
 
-    def _generate_system_message_tuple(self) -> tuple:
-        pre_stem = random.choice(self.pre_prompt_stems)
-        post_stem = random.choice(self.post_prompt_stems)
-        continuation = random.choice(self.continuations)
+    def _generate_system_message_tuple(self, rng: random.Random) -> tuple:
+        pre_stem = rng.choice(self.pre_prompt_stems)
+        post_stem = rng.choice(self.post_prompt_stems)
         
         stem = f"{pre_stem} {post_stem}"
         if self.use_baseline_class:
             message_tuple = (stem + ".",)  # Baseline.
         else:
             message_tuple = ()
-        message_tuple += tuple(f"{stem} {cont}." for cont in continuation)
+        for axis_continuations in self.continuations:
+            continuation = rng.choice(axis_continuations)
+            message_tuple += tuple(f"{stem} {cont}." for cont in continuation)
     
         return message_tuple
 
     def _generate_datasets(self, num_prompt_samples: int) -> None:
         print("Generating dataset samples... ", end="")
         sys.stdout.flush()
-        num_samples_per_class = int(num_prompt_samples / self.get_num_classes())
+        num_samples_per_class = int(num_prompt_samples / self.get_num_classes_per_axis())
         if num_samples_per_class <= 0:
             raise ValueError("num_samples_per_class must be greater than 0.")
         self.datasets = [[] for _ in range(self.get_num_classes())]
-        for _ in range(num_samples_per_class):
-            system_message_tuple = self._generate_system_message_tuple()
-            writing_prompt = random.choice(self.writing_prompts)
+        for j in range(num_samples_per_class):
+            # Each sample has its own generator, so sample j is the same whatever the number of samples.
+            rng = random.Random(f"{self.seed}:{j}")
+            system_message_tuple = self._generate_system_message_tuple(rng)
+            writing_prompt = rng.choice(self.writing_prompts)
             # IMPORTANT: Use the same matched writing prompt for each in the system message tuple!
             for i, system_message in enumerate(system_message_tuple):
                 self.datasets[i].append((system_message, writing_prompt))
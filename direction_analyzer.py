@@ -1,4 +1,29 @@
+import os
 import torch
+import tracing
+import multiprocessing
+import concurrent.futures
+
+from eigen_cache import EigenCache
+
+def compute_layer_range(num_layers: int, skip_begin_layers, skip_end_layers) -> range:
+    """
+    Computes the range of layer indices to analyse after skipping the initial and end layers.
+
+    Parameters:
+        num_layers (int): The total number of layers.
+        skip_begin_layers (int or float): The number (or fraction) of initial layers to skip.
+        skip_end_layers (int or float): The number (or fraction) of end layers to skip.
+
+    Returns:
+        range: The layer indices to analyse.
+    """
+    # If passed a fraction, find the actual layer indices.
+    if 0 < skip_begin_layers < 1:
+        skip_begin_layers = round(skip_begin_layers * num_layers)
+    if 0 < skip_end_layers < 1:
+        skip_end_layers = round(skip_end_layers * num_layers)
+    return range(int(skip_begin_layers), num_layers - int(skip_end_layers))
 
 def compute_symmetrised_cross_covariance_eigenvectors(
     A: torch.Tensor,
@@ -23,6 +48,234 @@ def compute_symmetrised_cross_covariance_eigenvectors(
     
     return eigenvectors.T  # as rows
 
+def compute_symmetrised_cross_covariance_eigenvectors_gram(
+    A: torch.Tensor,
+    B: torch.Tensor
+) -> torch.Tensor:
+    """
+    Computes the eigenvectors of ((A^T * B) + (A^T * B)^T) / 2 with non-zero eigenvalues, using the [2n, 2n] "Gram" form.
+
+    The matrix equals (Z^T * J * Z) / 2, where Z = [A; B] and J = [[0, I], [I, 0]], so it has rank at most 2n. Taking the
+    thin QR decomposition Z^T = Q * R gives (Q * R * J * R^T * Q^T) / 2, so only a [2n, 2n] eigenproblem needs solving.
+    The remaining (d - 2n) eigenvectors all have eigenvalue zero and no sample projects onto them.
+
+    Parameters:
+        A (torch.Tensor): The first input tensor.
+        B (torch.Tensor): The second input tensor.
+
+    Returns:
+        torch.Tensor: The transpose of the (at most 2n) eigenvectors (ie: as rows).
+    """
+    n = A.shape[0]
+    Q, R = torch.linalg.qr(torch.cat([A, B], dim = 0).T)
+    RA, RB = R[:, :n], R[:, n:]
+    RB_RA = torch.matmul(RB, RA.T)
+    _, eigenvectors = torch.linalg.eigh((RB_RA + RB_RA.T) / 2)
+    return torch.matmul(Q, eigenvectors).T  # as rows
+
+def compute_randomized_symmetric_eigenvectors(
+    matmul,
+    num_features: int,
+    num_eigenvectors: int,
+    dtype: torch.dtype,
+    device,
+    num_oversamples: int = 10,
+    num_iterations: int = 4,
+    seed: int = 0
+) -> torch.Tensor:
+    """
+    Computes the eigenvectors with the largest magnitude eigenvalues of a symmetric matrix using randomized subspace iteration.
+
+    Parameters:
+        matmul (callable): Returns the product of the (implicit) [d, d] matrix with a [d, m] tensor.
+        num_features (int): The dimension d of the matrix.
+        num_eigenvectors (int): The number of eigenvectors to compute.
+        dtype (torch.dtype): The dtype to compute in.
+        device: The device to compute on.
+        num_oversamples (int): The number of extra vectors used to improve the accuracy of the subspace.
+        num_iterations (int): The number of (power) iterations.
+        seed (int): Seeds the random starting subspace, so the same matrix always gives the same eigenvectors.
+
+    Returns:
+        torch.Tensor: The transpose of the eigenvectors (ie: as rows).
+    """
+    subspace_size = min(num_features, num_eigenvectors + num_oversamples)
+    generator = torch.Generator(device = device).manual_seed(seed)
+    Q, _ = torch.linalg.qr(matmul(torch.randn(num_features, subspace_size, dtype = dtype, device = device, generator = generator)))
+    for _ in range(num_iterations):
+        Q, _ = torch.linalg.qr(matmul(Q))
+
+    # Rayleigh-Ritz on the subspace, then keep the largest magnitude eigenvalues.
+    T = torch.matmul(Q.T, matmul(Q))
+    eigenvalues, eigenvectors = torch.linalg.eigh((T + T.T) / 2)
+    order = torch.argsort(eigenvalues.abs(), descending = True)[:num_eigenvectors]
+    return torch.matmul(Q, eigenvectors[:, order]).T  # as rows
+
+def select_eigen_solver(num_samples: int, num_features: int, num_eigenvectors = None, allow_gram: bool = True) -> str:
+    """
+    Selects the cheapest eigensolver for the given problem size.
+
+    Parameters:
+        num_samples (int): The number of (paired) samples n.
+        num_features (int): The dimension d.
+        num_eigenvectors (int): The number of eigenvectors requested (None = all with non-zero eigenvalues).
+        allow_gram (bool): Whether 'gram' can be used (it needs the samples themselves, not just their moments).
+
+    Returns:
+        str: One of 'dense', 'gram' or 'randomized'.
+    """
+    rank = min(2 * num_samples, num_features)
+    if num_eigenvectors is not None and 0 < num_eigenvectors and 4 * num_eigenvectors < rank:
+        return "randomized"
+    if allow_gram and 2 * num_samples < num_features:
+        return "gram"
+    return "dense"
+
+def compute_eigenvectors(
+    A: torch.Tensor,
+    B: torch.Tensor,
+    eigen_solver: str = "auto",
+    num_eigenvectors = None,
+    seed: int = 0
+) -> torch.Tensor:
+    """
+    Computes the eigenvectors of the symmetrised cross-covariance matrix using the selected (or chosen) eigensolver.
+
+    Parameters:
+        A (torch.Tensor): The first input tensor.
+        B (torch.Tensor): The second input tensor.
+        eigen_solver (str): One of 'auto', 'dense', 'gram' or 'randomized'.
+        num_eigenvectors (int): The number of largest magnitude eigenvectors wanted (None = all).
+        seed (int): Seeds the 'randomized' eigensolver.
+
+    Returns:
+        torch.Tensor: The eigenvectors (as rows).
+    """
+    if eigen_solver == "auto":
+        eigen_solver = select_eigen_solver(A.shape[0], A.shape[1], num_eigenvectors)
+    if eigen_solver == "dense":
+        return compute_symmetrised_cross_covariance_eigenvectors(A, B)
+    if eigen_solver == "gram":
+        return compute_symmetrised_cross_covariance_eigenvectors_gram(A, B)
+    if eigen_solver == "randomized":
+        if num_eigenvectors is None:
+            raise ValueError("The 'randomized' eigensolver needs the number of eigenvectors.")
+        # Multiply by ((A^T * B) + (B^T * A)) / 2 without ever forming the [d, d] matrix.
+        def matmul(X):
+            return (torch.matmul(A.T, torch.matmul(B, X)) + torch.matmul(B.T, torch.matmul(A, X))) / 2
+        return compute_randomized_symmetric_eigenvectors(matmul, A.shape[1], num_eigenvectors, A.dtype, A.device, seed = seed)
+    raise ValueError(f"Unknown eigensolver: {eigen_solver}")
+
+def compute_symmetrised_cross_moment_eigenvectors(
+    count: int,
+    means: torch.Tensor,
+    comoments: tuple,
+    eigen_solver: str = "auto",
+    num_eigenvectors = None,
+    seed: int = 0
+) -> torch.Tensor:
+    """
+    Computes the eigenvectors of ((A^T * B) + (A^T * B)^T) / 2 from sufficient statistics, rather than from A and B.
+
+    Parameters:
+        count (int): The number of (paired) samples.
+        means (torch.Tensor): The means of A and B, as rows of a [2, d] tensor.
+        comoments (tuple): The centred co-moments (C_AA, C_AB, C_BB), where C_AB = (A - mean_A)^T * (B - mean_B).
+        eigen_solver (str): One of 'auto', 'dense' or 'randomized' (the samples needed by 'gram' aren't available).
+        num_eigenvectors (int): The number of largest magnitude eigenvectors wanted (None = all).
+        seed (int): Seeds the 'randomized' eigensolver.
+
+    Returns:
+        torch.Tensor: The transpose of the eigenvectors of the symmetrised cross-covariance matrix (ie: as rows).
+    """
+    # Add back the means to get the (uncentred) A^T * B used by compute_symmetrised_cross_covariance_eigenvectors().
+    AT_B = comoments[1] + count * torch.outer(means[0], means[1])
+    symmetrised_AT_B = ((AT_B + AT_B.T) / 2).to(torch.float32)
+
+    if eigen_solver == "auto":
+        eigen_solver = select_eigen_solver(count, symmetrised_AT_B.shape[0], num_eigenvectors, allow_gram = False)
+    if eigen_solver == "gram":
+        raise ValueError("The 'gram' eigensolver needs the samples, so can't be used with statistics (use 'dense' or 'randomized').")
+    if eigen_solver == "randomized":
+        if num_eigenvectors is None:
+            raise ValueError("The 'randomized' eigensolver needs the number of eigenvectors.")
+        return compute_randomized_symmetric_eigenvectors(
+            lambda X: torch.matmul(symmetrised_AT_B, X),
+            symmetrised_AT_B.shape[0],
+            num_eigenvectors,
+            symmetrised_AT_B.dtype,
+            symmetrised_AT_B.device,
+            seed = seed
+        )
+
+    # Compute the eigenvectors of the symmetrised cross-covariance matrix
+    _, eigenvectors = torch.linalg.eigh(symmetrised_AT_B)
+
+    return eigenvectors.T  # as rows
+
+def compute_projected_moments(
+    direction_matrix: torch.Tensor,
+    means: torch.Tensor,
+    comoments: tuple,
+    chunk_size: int = 1024
+) -> tuple:
+    """
+    Computes the means and within-class sums of squares of A and B projected onto each (unit) direction.
+
+    Parameters:
+        direction_matrix (torch.Tensor): The unit directions, as rows of a [k, d] tensor.
+        means (torch.Tensor): The means of A and B, as rows of a [2, d] tensor.
+        comoments (tuple): The centred co-moments (C_AA, C_AB, C_BB).
+        chunk_size (int): The number of directions to process at once (to bound memory use).
+
+    Returns:
+        tuple: The projected means and within-class sums of squares, each as a [2, k] tensor.
+    """
+    direction_matrix = direction_matrix.to(means.dtype)
+    projected_means = torch.matmul(means, direction_matrix.T)
+    within_sums = torch.empty_like(projected_means)
+    for start in range(0, direction_matrix.shape[0], chunk_size):
+        chunk = direction_matrix[start:start + chunk_size]
+        # The quadratic form v^T * C * v for every direction in the chunk.
+        within_sums[0, start:start + chunk_size] = (torch.matmul(chunk, comoments[0]) * chunk).sum(dim = 1)
+        within_sums[1, start:start + chunk_size] = (torch.matmul(chunk, comoments[2]) * chunk).sum(dim = 1)
+    return projected_means, within_sums
+
+def compute_discriminant_ratios_from_moments(projected_means: torch.Tensor, within_sums: torch.Tensor, count: int) -> torch.Tensor:
+    """
+    Computes the discriminant ratios (see compute_discriminant_ratio) from the projected moments of two equally sized classes.
+
+    Parameters:
+        projected_means (torch.Tensor): The projected means, as a [2, k] tensor.
+        within_sums (torch.Tensor): The projected within-class sums of squares, as a [2, k] tensor.
+        count (int): The number of samples in each class.
+
+    Returns:
+        torch.Tensor: The discriminant ratio of each direction.
+    """
+    overall_means = projected_means.mean(dim = 0)
+    between_class_variance = count * ((projected_means - overall_means) ** 2).sum(dim = 0)
+    within_class_variance = within_sums.sum(dim = 0)
+    safe_within_class_variance = torch.where(within_class_variance != 0, within_class_variance, torch.ones_like(within_class_variance))
+    return torch.where(within_class_variance != 0, between_class_variance / safe_within_class_variance, torch.zeros_like(within_class_variance))
+
+def compute_variance_reductions_from_moments(projected_means: torch.Tensor, within_sums: torch.Tensor, count: int) -> torch.Tensor:
+    """
+    Computes the variance reductions (see compute_variance_reduction) from the projected moments of two equally sized classes.
+
+    Parameters:
+        projected_means (torch.Tensor): The projected means, as a [2, k] tensor.
+        within_sums (torch.Tensor): The projected within-class sums of squares, as a [2, k] tensor.
+        count (int): The number of samples in each class.
+
+    Returns:
+        torch.Tensor: The variance reduction of each direction.
+    """
+    overall_means = projected_means.mean(dim = 0)
+    variances = within_sums / (count - 1)
+    combined_variance = (within_sums.sum(dim = 0) + count * ((projected_means - overall_means) ** 2).sum(dim = 0)) / (2 * count - 1)
+    return torch.clamp(1 - variances.sum(dim = 0) / (2 * combined_variance), min = 0)
+
 def project_data_onto_direction(data: torch.Tensor, direction: torch.Tensor) -> torch.Tensor:
     """
     Projects the data onto the given direction vector.
@@ -59,6 +312,43 @@ def compute_discriminant_ratio(projected_scoresA: torch.Tensor, projected_scores
     within_class_variance = torch.sum((projected_scoresA - mean1) ** 2) + torch.sum((projected_scoresB - mean2) ** 2)
     return between_class_variance / within_class_variance if within_class_variance != 0 else 0
 
+def project_data_onto_directions(data: torch.Tensor, direction_matrix: torch.Tensor) -> torch.Tensor:
+    """
+    Projects the data onto each of the given direction vectors at once.
+
+    Parameters:
+        data (torch.Tensor): The input data to be projected, as a [n, d] tensor.
+        direction_matrix (torch.Tensor): The direction vectors, as rows of a [k, d] tensor.
+
+    Returns:
+        torch.Tensor: The projected data, as a [n, k] tensor (ie: one column per direction).
+    """
+    # Normalize the direction vectors to ensure they are unit vectors
+    direction_matrix = direction_matrix / torch.norm(direction_matrix, dim = 1, keepdim = True)
+
+    return torch.matmul(data, direction_matrix.T)
+
+def compute_discriminant_ratios(projected_scoresA: torch.Tensor, projected_scoresB: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the discriminant ratio (see compute_discriminant_ratio) of every column of two sets of projected scores.
+
+    Parameters:
+        projected_scoresA (torch.Tensor): The first set of projected scores, as a [n1, k] tensor.
+        projected_scoresB (torch.Tensor): The second set of projected scores, as a [n2, k] tensor.
+
+    Returns:
+        torch.Tensor: The discriminant ratio of each column.
+    """
+    mean1 = torch.mean(projected_scoresA, dim = 0)
+    mean2 = torch.mean(projected_scoresB, dim = 0)
+    n1 = projected_scoresA.size(0)
+    n2 = projected_scoresB.size(0)
+    overall_mean = (n1 * mean1 + n2 * mean2) / (n1 + n2)
+    between_class_variance = n1 * (mean1 - overall_mean) ** 2 + n2 * (mean2 - overall_mean) ** 2
+    within_class_variance = torch.sum((projected_scoresA - mean1) ** 2, dim = 0) + torch.sum((projected_scoresB - mean2) ** 2, dim = 0)
+    safe_within_class_variance = torch.where(within_class_variance != 0, within_class_variance, torch.ones_like(within_class_variance))
+    return torch.where(within_class_variance != 0, between_class_variance / safe_within_class_variance, torch.zeros_like(within_class_variance))
+
 def compute_variance_reduction(projected_scoresA: torch.Tensor, projected_scoresB: torch.Tensor) -> float:
     """
     Computes the variance reduction between two sets of projected scores.
@@ -74,6 +364,31 @@ def compute_variance_reduction(projected_scoresA: torch.Tensor, projected_scores
     variance_reduction = max(0, 1 - (projected_scoresA.var() + projected_scoresB.var()) / (2 * combined_scores.var()))
     return variance_reduction
     
+# Each analysis worker process opens its own (memory-mapped) view of the hidden state data.
+_worker_hidden_state_data_manager = None
+
+def _initialize_worker(store_path, use_statistics, num_threads, trace):
+    global _worker_hidden_state_data_manager
+    from hidden_state_data_manager import HiddenStateDataManager
+    if trace:
+        tracing.enable()
+    torch.set_num_threads(num_threads)
+    torch.set_grad_enabled(False)
+    _worker_hidden_state_data_manager = HiddenStateDataManager.open(store_path, use_statistics)
+
+def _analyze_layer_in_worker(layer_index, class_indices, discriminant_ratio_tolerance, eigen_solver, num_eigenvectors, eigen_cache_path):
+    result = DirectionAnalyzer._analyze_layer(
+        _worker_hidden_state_data_manager,
+        layer_index,
+        class_indices,
+        discriminant_ratio_tolerance,
+        eigen_solver,
+        num_eigenvectors,
+        eigen_cache_path
+    )
+    # Hand back the layer's spans and counters, to be merged into the parent's trace.
+    return result, tracing.collect() if tracing.is_enabled() else None
+
 class DirectionAnalyzer:
 
     def __init__(
@@ -81,13 +396,25 @@ class DirectionAnalyzer:
         hidden_state_data_manager,
         start_layer_index,
         skip_end_layers,
-        discriminant_ratio_tolerance
+        discriminant_ratio_tolerance,
+        class_indices = None,
+        num_workers = 1,
+        worker_type = "thread",
+        eigen_solver = "auto",
+        num_eigenvectors = None,
+        eigen_cache_path = None
     ):
         self.direction_matrices = self._analyze_directions(
             hidden_state_data_manager,
             start_layer_index,
             skip_end_layers,
-            discriminant_ratio_tolerance
+            discriminant_ratio_tolerance,
+            class_indices if class_indices is not None else [1, 2],
+            num_workers,
+            worker_type,
+            eigen_solver,
+            num_eigenvectors,
+            eigen_cache_path
         )
 
     def _analyze_directions(
@@ -95,110 +422,379 @@ class DirectionAnalyzer:
         hidden_state_data_manager,
         start_layer_index,
         skip_end_layers,
-        discriminant_ratio_tolerance
+        discriminant_ratio_tolerance,
+        class_indices,
+        num_workers,
+        worker_type,
+        eigen_solver,
+        num_eigenvectors,
+        eigen_cache_path
     ):
 
         num_layers = hidden_state_data_manager.get_num_layers()
 
-        # If passed a fraction, find the actual layer indices.
-        if 0 < start_layer_index < 1:
-            start_layer_index = round(start_layer_index * num_layers)
-        if 0 < skip_end_layers < 1:
-            skip_end_layers = round(skip_end_layers * num_layers)
+        layer_range = compute_layer_range(num_layers, start_layer_index, skip_end_layers)
 
-        print(f"Testing Eigenvector Directions for layers {start_layer_index + 1} to {num_layers - skip_end_layers}:")
+        print(f"Testing Eigenvector Directions for layers {layer_range.start + 1} to {layer_range.stop}:")
 
-        num_dataset_types = hidden_state_data_manager.get_num_dataset_types()
+        if not torch.cuda.is_available():
+            print("CUDA is not available. Using CPU instead.")
 
         # [0] = de-bias direction, [1] = negative direction, [2] = positive direction.
-        direction_matrices = [[[] for _ in range(num_layers)] for _ in range(num_dataset_types)]
+        direction_matrices = [[[] for _ in range(num_layers)] for _ in range(len(class_indices) + 1)]
 
-        for layer_index in range(start_layer_index, num_layers - skip_end_layers):
-            print(f"- Layer {layer_index + 1}: ", end = "", flush = True)
-
-            data = hidden_state_data_manager.get_differenced_datasets(layer_index)
+        layer_results = self._map_layers(
+            hidden_state_data_manager,
+            layer_range,
+            class_indices,
+            discriminant_ratio_tolerance,
+            num_workers,
+            worker_type,
+            eigen_solver,
+            num_eigenvectors,
+            eigen_cache_path
+        )
 
-            if torch.cuda.is_available():
-                data = [d.to('cuda').to(torch.float32) for d in data]  # Convert to CUDA and then to float32
-            else:
-                data = [d.to(torch.float32) for d in data]  # Convert to float32 on CPU
-                print("CUDA is not available. Using CPU instead.")
+        # NOTE: The results are always merged (and printed) in layer order, whatever order the workers finish in.
+        for layer_index, (summary, vectors) in zip(layer_range, layer_results):
+            print(f"- Layer {layer_index + 1}: {summary}", flush = True)
+            if vectors is not None:
+                for i, vector in enumerate(vectors):
+                    direction_matrices[i][layer_index].append(vector)
 
-            directions = compute_symmetrised_cross_covariance_eigenvectors(data[0], data[1])
+        direction_matrices = self._convert_to_torch_tensors(direction_matrices)
 
-            total_directions = directions.shape[0]
+        return direction_matrices
 
-            results = []
-            
-            filtered_directions = 0
+    @staticmethod
+    def _map_layers(
+        hidden_state_data_manager,
+        layer_range,
+        class_indices,
+        discriminant_ratio_tolerance,
+        num_workers,
+        worker_type,
+        eigen_solver,
+        num_eigenvectors,
+        eigen_cache_path
+    ):
+        layer_arguments = (class_indices, discriminant_ratio_tolerance, eigen_solver, num_eigenvectors, eigen_cache_path)
+        if num_workers <= 1:
+            return (
+                DirectionAnalyzer._analyze_layer(hidden_state_data_manager, layer_index, *layer_arguments)
+                for layer_index in layer_range
+            )
+
+        # Split the cores between the workers, rather than each using them all.
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        if worker_type == "thread":
+            # Threads share the (memory-mapped) data directly and PyTorch releases the GIL inside its kernels.
+            # NOTE: PyTorch's thread count is process-wide, so it's lowered for as long as the pool runs.
+            previous_num_threads = torch.get_num_threads()
+            torch.set_num_threads(num_threads)
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers = num_workers)
+            futures = [
+                executor.submit(DirectionAnalyzer._analyze_layer, hidden_state_data_manager, layer_index, *layer_arguments)
+                for layer_index in layer_range
+            ]
+
+            def results():
+                try:
+                    with executor:
+                        for future in futures:
+                            yield future.result()
+                finally:
+                    torch.set_num_threads(previous_num_threads)
+
+        elif worker_type == "process":
+            # Processes open the store themselves (via memory mapping), so no layer data is ever pickled.
+            store_path, use_statistics = hidden_state_data_manager.get_store_path(), hidden_state_data_manager.has_statistics()
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers = num_workers,
+                mp_context = multiprocessing.get_context("spawn"),
+                initializer = _initialize_worker,
+                initargs = (store_path, use_statistics, num_threads, tracing.is_enabled())
+            )
+            futures = [
+                executor.submit(_analyze_layer_in_worker, layer_index, *layer_arguments)
+                for layer_index in layer_range
+            ]
+
+            def results():
+                with executor:
+                    for future in futures:
+                        result, records = future.result()
+                        if records is not None:
+                            tracing.merge(records)
+                        yield result
+
+        else:
+            raise ValueError(f"The worker type must be 'thread' or 'process': {worker_type}")
+
+        return results()
 
-            # Project each direction onto datasets then store discriminant ratio and scaled/flipped direction.
-            for i in range(directions.shape[0]):
-                direction = directions[i,:]
-                projected_scores = [project_data_onto_direction(d, direction) for d in data]
-                discriminant_ratio = compute_discriminant_ratio(projected_scores[0], projected_scores[1])
-                if discriminant_ratio >= discriminant_ratio_tolerance:
-                    mean_desired = projected_scores[1].mean()
-                    scaled_direction = mean_desired * direction # Scale and flip sign if needed.
-                    results.append((discriminant_ratio, scaled_direction))
-                    filtered_directions += 1
-
-            if filtered_directions > 0:
-                print(f"[{filtered_directions}/{total_directions} filtered]", end = "")
+    @staticmethod
+    def _analyze_layer(
+        hidden_state_data_manager,
+        layer_index,
+        class_indices,
+        discriminant_ratio_tolerance,
+        eigen_solver = "auto",
+        num_eigenvectors = None,
+        eigen_cache_path = None
+    ):
+        if not hidden_state_data_manager.has_layer(layer_index):
+            return "[not sampled]", None
+
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        # The eigenvectors and their scores don't depend on the tolerance, so can be reused from an earlier run.
+        scores = None
+        if eigen_cache_path is not None:
+            eigen_cache = EigenCache(eigen_cache_path)
+            key = eigen_cache.get_key(hidden_state_data_manager.get_fingerprint(), layer_index, class_indices, eigen_solver, num_eigenvectors)
+            scores = eigen_cache.load(key)
+
+        # NOTE: The 'randomized' eigensolver is seeded by the layer, so each layer gives the same directions on every run
+        #       (whichever worker analyses it), which also keeps the eigen cache consistent.
+        with tracing.span("analyze_layer", memory = True, layer = layer_index, cached = scores is not None):
+            if hidden_state_data_manager.has_statistics():
+                count, means, comoments = hidden_state_data_manager.get_layer_moments(layer_index, class_indices)
+                means = means.to(device).to(torch.float64)
+                comoments = [comoment.to(device).to(torch.float64) for comoment in comoments]
+                if scores is None:
+                    scores = DirectionAnalyzer._score_layer_moments(count, means, comoments, eigen_solver, num_eigenvectors, seed = layer_index)
+                    if eigen_cache_path is not None:
+                        eigen_cache.save(key, scores)
+                layer_result = DirectionAnalyzer._search_layer_moments(count, means, comoments, scores, discriminant_ratio_tolerance)
             else:
-                print("[no directions filtered]", end = "")
-                
-            # Sort the directions into descending order using the scoring criterion.
-            results.sort(key = lambda x: x[0], reverse = True)
+                data = hidden_state_data_manager.get_differenced_datasets(layer_index, class_indices)
+                data = [d.to(device).to(torch.float32) for d in data]  # Convert to CUDA (if available) and then to float32
+                if scores is None:
+                    scores = DirectionAnalyzer._score_layer_data(data, eigen_solver, num_eigenvectors, seed = layer_index)
+                    if eigen_cache_path is not None:
+                        eigen_cache.save(key, scores)
+                layer_result = DirectionAnalyzer._search_layer_data(data, scores, discriminant_ratio_tolerance)
+
+        (
+            total_directions,
+            filtered_directions,
+            selected_directions,
+            best_direction_sum,
+            best_discriminant_ratio,
+            best_variance_reduction,
+            best_means,
+            best_stds
+        ) = layer_result
+
+        if filtered_directions > 0:
+            summary = f"[{filtered_directions}/{total_directions} filtered]"
+        else:
+            summary = "[no directions filtered]"
+
+        # If we have a selected direction, then regularise it and use the scaled direction.
+        if selected_directions > 0:
+            midpoint = (best_means[0] + best_means[1]) / 2
+            adjusted_means = [
+                best_means[0] - midpoint,
+                best_means[1] - midpoint
+            ]
+            raw_sum = abs(best_means[1]) + abs(best_means[0])
+            raw_ratio = abs(best_means[1]) / raw_sum if raw_sum != 0 else 0.0
+            summary += f" [{selected_directions}/{total_directions} selected]"
+            summary += f" Δ = {best_discriminant_ratio * 100:.0f}%,"
+            summary += f" Δσ² = {best_variance_reduction * 100:.1f}%,"
+            summary += f" σ= ({best_stds[0]:.3f}, {best_stds[1]:.3f}),"
+            summary += f" μ = ({best_means[0]:.3f}, {best_means[1]:.3f} [{raw_ratio * 100:.1f}%]) --> "
+            summary += f" μ' = ({midpoint:.3f}, {adjusted_means[0]:.3f}, {adjusted_means[1]:.3f})"
+            best_unit_direction = best_direction_sum / torch.norm(best_direction_sum)
+            vectors = (
+                (midpoint * best_unit_direction).to(torch.float32).cpu(),           # de-bias vector.
+                (adjusted_means[0] * best_unit_direction).to(torch.float32).cpu(),  # should be -ve of [2].
+                (adjusted_means[1] * best_unit_direction).to(torch.float32).cpu()   # should be -ve of [1].
+            )
+        else:
+            summary += " [no directions selected]"
+            vectors = None
+
+        return summary, vectors
 
-            best_discriminant_ratio = 0.0
-            best_variance_reduction = 0.0
-            best_means = [0.0, 0.0]
-            best_stds = [0.0, 0.0]
-            best_direction_sum = torch.zeros_like(directions[0,:])
+    @staticmethod
+    def _analyze_layer_data(data, discriminant_ratio_tolerance, eigen_solver = "auto", num_eigenvectors = None, chunk_size = 1024, seed = 0):
+        scores = DirectionAnalyzer._score_layer_data(data, eigen_solver, num_eigenvectors, chunk_size, seed)
+        return DirectionAnalyzer._search_layer_data(data, scores, discriminant_ratio_tolerance)
 
-            selected_directions = 0
+    @staticmethod
+    def _score_layer_data(data, eigen_solver = "auto", num_eigenvectors = None, chunk_size = 1024, seed = 0):
+        """
+        Finds the candidate directions and scores each of them (which doesn't depend on the tolerance, so can be cached).
+        """
+        with tracing.span("eigenvectors", eigen_solver = eigen_solver):
+            directions = compute_eigenvectors(data[0], data[1], eigen_solver, num_eigenvectors, seed)
+
+        # Project each chunk of directions onto datasets at once (chunking keeps the [n, chunk_size] scores bounded).
+        with tracing.span("scoring"):
+            discriminant_ratios = []
+            desired_means = []
+            for start in range(0, directions.shape[0], chunk_size):
+                projected_scores = [project_data_onto_directions(d, directions[start:start + chunk_size]) for d in data]
+                discriminant_ratios.append(compute_discriminant_ratios(projected_scores[0], projected_scores[1]))
+                desired_means.append(projected_scores[1].mean(dim = 0))
+
+        return {
+            "directions": directions,
+            "discriminant_ratios": torch.cat(discriminant_ratios),
+            "desired_means": torch.cat(desired_means),
+        }
 
-            # Greedily try to create an even better "compound direction".
-            for result in results:
-                direction_sum = best_direction_sum + result[1]
-                direction = direction_sum / torch.norm(direction_sum)
-                projected_scores = [project_data_onto_direction(d, direction) for d in data]
+    @staticmethod
+    def _search_layer_data(data, scores, discriminant_ratio_tolerance):
+        device = data[0].device
+        directions = scores["directions"].to(device)
+        discriminant_ratios = scores["discriminant_ratios"].to(device)
+        desired_means = scores["desired_means"].to(device)
+
+        total_directions = directions.shape[0]
+
+        # Only the directions that pass the filter need their projected scores for the greedy search below.
+        filtered_indices = torch.nonzero(discriminant_ratios >= discriminant_ratio_tolerance).flatten()
+        filtered_directions = filtered_indices.numel()
+        filtered_matrix = directions[filtered_indices]
+        filtered_scores = [project_data_onto_directions(d, filtered_matrix) for d in data]
+
+        # Store discriminant ratio, scale (which flips the sign if needed) and column of the cached projected scores.
+        results = [
+            (discriminant_ratios[i].item(), desired_means[i], column)
+            for column, i in enumerate(filtered_indices.tolist())
+        ]
+            
+        # Sort the directions into descending order using the scoring criterion.
+        results.sort(key = lambda x: x[0], reverse = True)
+
+        # The filtered directions' Gram matrix (~identity, as eigenvectors are orthonormal) gives exact norm updates.
+        gram_matrix = torch.matmul(filtered_matrix, filtered_matrix.T)
+
+        best_discriminant_ratio = 0.0
+        best_variance_reduction = 0.0
+        best_means = [0.0, 0.0]
+        best_stds = [0.0, 0.0]
+        best_direction_sum = torch.zeros_like(directions[0,:])
+
+        # Projections are linear, so the (unnormalised) scores of the running sum are just the sum of the scaled
+        # scores of its directions, and only need dividing by the norm of the sum. This makes each step O(n).
+        best_scores = [torch.zeros(d.shape[0], dtype = d.dtype, device = d.device) for d in data]
+        best_norm_squared = 0.0
+        best_gram_product = torch.zeros(filtered_directions, dtype = directions.dtype, device = directions.device)
+
+        selected_directions = 0
+
+        # Greedily try to create an even better "compound direction".
+        with tracing.span("greedy_search"):
+            for _, scale, column in results:
+                # |s + c.v|^2 = |s|^2 + 2c.(s.v) + c^2.(v.v)
+                norm_squared = best_norm_squared + (2 * scale * best_gram_product[column] + scale * scale * gram_matrix[column, column]).item()
+                if norm_squared <= 0:
+                    continue
+                norm = norm_squared ** 0.5
+                scores = [best_scores[i] + scale * filtered_scores[i][:, column] for i in range(len(data))]
+                projected_scores = [score / norm for score in scores]
                 discriminant_ratio = compute_discriminant_ratio(projected_scores[0], projected_scores[1])
                 if discriminant_ratio > best_discriminant_ratio + discriminant_ratio_tolerance:
                     best_discriminant_ratio = discriminant_ratio
                     best_variance_reduction = compute_variance_reduction(projected_scores[0], projected_scores[1])
                     best_means = [projected_scores[0].mean(), projected_scores[1].mean()]
                     best_stds = [projected_scores[0].std(), projected_scores[1].std()]
-                    best_direction_sum = direction_sum
+                    best_direction_sum = best_direction_sum + scale * filtered_matrix[column]
+                    best_scores = scores
+                    best_norm_squared = norm_squared
+                    best_gram_product = best_gram_product + scale * gram_matrix[:, column]
                     selected_directions += 1
 
-            # If we have a selected direction, then regularise it and use the scaled direction.
-            if selected_directions > 0:
-                midpoint = (best_means[0] + best_means[1]) / 2
-                adjusted_means = [
-                    best_means[0] - midpoint,
-                    best_means[1] - midpoint
-                ]
-                raw_sum = abs(best_means[1]) + abs(best_means[0])
-                raw_ratio = abs(best_means[1]) / raw_sum if raw_sum != 0 else 0.0
-                print(f" [{selected_directions}/{total_directions} selected]", end = "")
-                print(f" Δ = {best_discriminant_ratio * 100:.0f}%,", end = "")
-                print(f" Δσ² = {best_variance_reduction * 100:.1f}%,", end = "")
-                print(f" σ= ({best_stds[0]:.3f}, {best_stds[1]:.3f}),", end = "")
-                print(f" μ = ({best_means[0]:.3f}, {best_means[1]:.3f} [{raw_ratio * 100:.1f}%]) --> ", end = "")
-                print(f" μ' = ({midpoint:.3f}, {adjusted_means[0]:.3f}, {adjusted_means[1]:.3f})", end = "")
-                print("")
-                best_unit_direction = best_direction_sum / torch.norm(best_direction_sum)
-                direction_matrices[0][layer_index].append(midpoint * best_unit_direction)           # de-bias vector.
-                direction_matrices[1][layer_index].append(adjusted_means[0] * best_unit_direction)  # should be -ve of [2].
-                direction_matrices[2][layer_index].append(adjusted_means[1] * best_unit_direction)  # should be -ve of [1].
-            else:
-                print(" [no directions selected]")
+        return (
+            total_directions,
+            filtered_directions,
+            selected_directions,
+            best_direction_sum,
+            best_discriminant_ratio,
+            best_variance_reduction,
+            best_means,
+            best_stds
+        )
 
-        direction_matrices = self._convert_to_torch_tensors(direction_matrices)
+    @staticmethod
+    def _analyze_layer_moments(count, means, comoments, discriminant_ratio_tolerance, eigen_solver = "auto", num_eigenvectors = None, seed = 0):
+        scores = DirectionAnalyzer._score_layer_moments(count, means, comoments, eigen_solver, num_eigenvectors, seed)
+        return DirectionAnalyzer._search_layer_moments(count, means, comoments, scores, discriminant_ratio_tolerance)
 
-        return direction_matrices
+    @staticmethod
+    def _score_layer_moments(count, means, comoments, eigen_solver = "auto", num_eigenvectors = None, seed = 0):
+        """
+        Finds the candidate directions and scores each of them (which doesn't depend on the tolerance, so can be cached).
+        """
+        with tracing.span("eigenvectors", eigen_solver = eigen_solver):
+            directions = compute_symmetrised_cross_moment_eigenvectors(count, means, comoments, eigen_solver, num_eigenvectors, seed).to(torch.float64)
+
+        # Score every direction at once, as the projected means and variances are just quadratic forms.
+        with tracing.span("scoring"):
+            projected_means, within_sums = compute_projected_moments(directions, means, comoments)
+            discriminant_ratios = compute_discriminant_ratios_from_moments(projected_means, within_sums, count)
+
+        return {
+            "directions": directions,
+            "discriminant_ratios": discriminant_ratios,
+            "desired_means": projected_means[1],
+        }
+
+    @staticmethod
+    def _search_layer_moments(count, means, comoments, scores, discriminant_ratio_tolerance):
+        device = means.device
+        directions = scores["directions"].to(device)
+        discriminant_ratios = scores["discriminant_ratios"].to(device)
+        desired_means = scores["desired_means"].to(device)
+
+        total_directions = directions.shape[0]
+
+        # Store discriminant ratio and scaled/flipped direction (ie: scaled by the desired projected mean).
+        selected = torch.nonzero(discriminant_ratios >= discriminant_ratio_tolerance).flatten()
+        results = [(discriminant_ratios[i].item(), desired_means[i] * directions[i,:]) for i in selected.tolist()]
+        filtered_directions = len(results)
+
+        # Sort the directions into descending order using the scoring criterion.
+        results.sort(key = lambda x: x[0], reverse = True)
+
+        best_discriminant_ratio = 0.0
+        best_variance_reduction = 0.0
+        best_means = [0.0, 0.0]
+        best_stds = [0.0, 0.0]
+        best_direction_sum = torch.zeros_like(directions[0,:])
+
+        selected_directions = 0
+
+        # Greedily try to create an even better "compound direction".
+        with tracing.span("greedy_search"):
+            for result in results:
+                direction_sum = best_direction_sum + result[1]
+                direction = (direction_sum / torch.norm(direction_sum)).unsqueeze(0)
+                direction_means, direction_within_sums = compute_projected_moments(direction, means, comoments)
+                discriminant_ratio = compute_discriminant_ratios_from_moments(direction_means, direction_within_sums, count)[0].item()
+                if discriminant_ratio > best_discriminant_ratio + discriminant_ratio_tolerance:
+                    best_discriminant_ratio = discriminant_ratio
+                    best_variance_reduction = compute_variance_reductions_from_moments(direction_means, direction_within_sums, count)[0].item()
+                    best_means = direction_means[:, 0].tolist()
+                    best_stds = torch.sqrt(direction_within_sums[:, 0] / (count - 1)).tolist()
+                    best_direction_sum = direction_sum
+                    selected_directions += 1
+
+        return (
+            total_directions,
+            filtered_directions,
+            selected_directions,
+            best_direction_sum.to(torch.float32),
+            best_discriminant_ratio,
+            best_variance_reduction,
+            best_means,
+            best_stds
+        )
 
     @staticmethod
     def _convert_to_torch_tensors(direction_matrices):
@@ -0,0 +1,54 @@
+import os
+import json
+import torch
+import hashlib
+
+from typing import Dict, List, Optional, Union
+
+class EigenCache:
+    """
+    An on-disk cache of each layer's eigenvectors and per-direction projection statistics.
+
+    These don't depend on the discriminant ratio tolerance or on which layers are analysed, so reruns with
+    different values of either (eg: a parameter sweep) can skip the eigendecomposition and scoring entirely.
+    Entries are keyed by a fingerprint of the hidden state store, so resampling or topping up invalidates them.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        os.makedirs(path, exist_ok = True)
+
+    @staticmethod
+    def get_key(
+        store_fingerprint: str,
+        layer_index: int,
+        class_indices: List[int],
+        eigen_solver: str,
+        num_eigenvectors: Optional[int]
+    ) -> str:
+        return hashlib.sha256(json.dumps({
+            "store": store_fingerprint,
+            "layer_index": layer_index,
+            "class_indices": list(class_indices),
+            "eigen_solver": eigen_solver,
+            "num_eigenvectors": num_eigenvectors,
+        }, sort_keys = True).encode()).hexdigest()
+
+    def load(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        filename = self._get_filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            return torch.load(filename, weights_only = True)
+        except (RuntimeError, EOFError, ValueError) as e:
+            print(f"WARNING: Ignoring the unreadable eigen cache entry '{filename}' ({e}).")
+            return None
+
+    def save(self, key: str, scores: Dict[str, torch.Tensor]) -> None:
+        # Write then rename, so a concurrent or interrupted write never leaves a partial entry.
+        filename = self._get_filename(key)
+        torch.save({name: tensor.cpu() for name, tensor in scores.items()}, filename + f".{os.getpid()}.tmp")
+        os.replace(filename + f".{os.getpid()}.tmp", filename)
+
+    def _get_filename(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.pt")
@@ -0,0 +1,136 @@
+import argparse
+import json
+import torch
+
+from typing import List, Optional
+
+from hidden_state_store import HiddenStateStore, STORAGE_ENCODINGS, encode_rows, decode_rows, get_encoded_row_size
+from direction_analyzer import DirectionAnalyzer
+
+def round_trip(layer: torch.Tensor, encoding: str, chunk_size: int = 4096) -> torch.Tensor:
+    """
+    Encodes and then decodes a [class, sample, hidden] block, as if it had been stored with the given encoding.
+    """
+    rows = layer.reshape(-1, layer.shape[-1])
+    decoded = torch.empty(rows.shape, dtype = torch.float32)
+    for start in range(0, rows.shape[0], chunk_size):
+        codes, scales = encode_rows(rows[start:start + chunk_size], encoding)
+        decoded[start:start + chunk_size] = decode_rows(codes, scales, encoding, rows.shape[-1])
+    return decoded.view(layer.shape)
+
+def analyze_layer(
+    layer: torch.Tensor,
+    class_indices: List[int],
+    discriminant_ratio_tolerance: float,
+    eigen_solver: str = "auto",
+    num_eigenvectors: Optional[int] = None
+):
+    """
+    Runs the direction analysis on a [class, sample, hidden] block (differenced against the baseline class).
+
+    Returns:
+        tuple: The summary statistics and the selected unit direction (or None if no direction was selected).
+    """
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    data = [(layer[i] - layer[0]).to(device).to(torch.float32) for i in class_indices]
+    (
+        _,
+        filtered_directions,
+        selected_directions,
+        best_direction_sum,
+        best_discriminant_ratio,
+        best_variance_reduction,
+        _,
+        _
+    ) = DirectionAnalyzer._analyze_layer_data(data, discriminant_ratio_tolerance, eigen_solver, num_eigenvectors)
+    summary = {
+        "filtered_directions": filtered_directions,
+        "selected_directions": selected_directions,
+        "discriminant_ratio": float(best_discriminant_ratio),
+        "variance_reduction": float(best_variance_reduction),
+    }
+    direction = (best_direction_sum / torch.norm(best_direction_sum)).cpu() if selected_directions > 0 else None
+    return summary, direction
+
+def compare_encodings(
+    store: HiddenStateStore,
+    layer_indices: List[int],
+    encodings: List[str],
+    class_indices: List[int],
+    discriminant_ratio_tolerance: float,
+    eigen_solver: str = "auto",
+    num_eigenvectors: Optional[int] = None
+) -> List[dict]:
+    """
+    Compares the directions found after storing each layer with each encoding against those found from the store as is.
+
+    Returns:
+        List[dict]: For each (layer, encoding): the size of a stored row, the relative reconstruction error, the
+                    discriminant ratio (and the baseline's) and the cosine similarity to the baseline direction.
+    """
+    baseline_row_size = get_encoded_row_size(store.encoding, store.hidden_size)
+    results = []
+    for layer_index in layer_indices:
+        layer = store.get_layer(layer_index).to(torch.float32)
+        baseline, baseline_direction = analyze_layer(layer, class_indices, discriminant_ratio_tolerance, eigen_solver, num_eigenvectors)
+        for encoding in encodings:
+            decoded = round_trip(layer, encoding)
+            summary, direction = analyze_layer(decoded, class_indices, discriminant_ratio_tolerance, eigen_solver, num_eigenvectors)
+            row_size = get_encoded_row_size(encoding, store.hidden_size)
+            cosine = None
+            if direction is not None and baseline_direction is not None:
+                cosine = torch.dot(direction.to(torch.float32), baseline_direction.to(torch.float32)).item()
+            results.append({
+                "layer": layer_index,
+                "encoding": encoding,
+                "bytes_per_row": row_size,
+                "compression": baseline_row_size / row_size,
+                "relative_error": (torch.norm(decoded - layer) / torch.norm(layer)).item(),
+                "baseline_discriminant_ratio": baseline["discriminant_ratio"],
+                "baseline_selected_directions": baseline["selected_directions"],
+                "direction_cosine": cosine,
+                **summary,
+            })
+            cosine_text = f"{cosine:.4f}" if cosine is not None else "n/a"
+            print(f"- Layer {layer_index + 1} [{encoding}]: {row_size} bytes/row ({baseline_row_size / row_size:.1f}x),"
+                  f" error = {results[-1]['relative_error'] * 100:.2f}%,"
+                  f" Δ = {summary['discriminant_ratio'] * 100:.1f}% (vs {baseline['discriminant_ratio'] * 100:.1f}%),"
+                  f" cos = {cosine_text}", flush = True)
+    return results
+
+def main(args):
+    torch.set_grad_enabled(False)
+    store = HiddenStateStore(args.store_path)
+    if not store.is_complete():
+        raise ValueError(f"'{args.store_path}' is not complete.")
+    if store.encoding not in ("float32", "float16", "bfloat16"):
+        print(f"WARNING: '{args.store_path}' is stored as '{store.encoding}', so the baseline isn't lossless.")
+
+    layer_indices = args.layer_indices or store.layer_indices
+    print(f"Comparing storage encodings against '{store.encoding}' for {len(layer_indices)} layers:")
+    results = compare_encodings(
+        store,
+        layer_indices,
+        args.encodings,
+        args.class_indices,
+        args.discriminant_ratio_tolerance,
+        args.eigen_solver,
+        args.num_eigenvectors
+    )
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({"store_path": args.store_path, "baseline_encoding": store.encoding, "results": results}, f, indent = 2)
+        print(f"Results written to '{args.output}'")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Report how each storage encoding changes the directions found, against the samples as stored.")
+    parser.add_argument("--store_path", type = str, required = True, help = "The hidden state samples folder (eg: '<output_path>_hidden_state_samples').")
+    parser.add_argument("--encodings", type = str, nargs = "+", default = ["float16", "bfloat16", "int8", "int4"], choices = STORAGE_ENCODINGS, help = "The encodings to compare.")
+    parser.add_argument("--layer_indices", type = int, nargs = "+", default = None, help = "The (0-based) layers to compare (default: all stored layers).")
+    parser.add_argument("--class_indices", type = int, nargs = 2, default = [1, 2], help = "The (negative, positive) classes to difference against the baseline class 0.")
+    parser.add_argument("--discriminant_ratio_tolerance", type = float, default = 0.5, help = "Used to filter low signal \"noise\" directions (0 = none).")
+    parser.add_argument("--eigen_solver", type = str, default = "auto", choices = ["auto", "dense", "gram", "randomized"], help = "The eigensolver to use (auto = choose from the problem size).")
+    parser.add_argument("--num_eigenvectors", type = int, default = None, help = "The number of largest magnitude eigenvectors to compute (default: all).")
+    parser.add_argument("--output", type = str, default = None, help = "The JSON file to write the results to (default: just print them).")
+    main(parser.parse_args())
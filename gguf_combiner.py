@@ -0,0 +1,217 @@
+import os
+import json
+import torch
+import argparse
+import tracing
+
+from typing import Dict, List, Optional, Union
+
+from gguf_exporter import ARCHITECTURE, export_gguf
+
+class ControlVector:
+    """
+    A control vector read from a '.gguf' file, with its directions held as a [layer_count, hidden] tensor.
+
+    NOTE: Layers missing from the file (which llama.cpp treats as zero) are zero rows, flagged in 'present'.
+    """
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        import gguf
+
+        reader = gguf.GGUFReader(path)
+        architecture = self._get_string(reader, "general.architecture")
+        if architecture != ARCHITECTURE:
+            raise ValueError(f"'{path}' is not a control vector (its architecture is '{architecture}').")
+
+        self.path = path
+        self.model_hint = self._get_string(reader, f"{ARCHITECTURE}.model_hint")
+        self.layer_count = int(self._get_value(reader, f"{ARCHITECTURE}.layer_count"))
+
+        # The tensors are named 'direction.<layer>' with 1-based layer numbers (as llama.cpp expects).
+        tensors = {}
+        for tensor in reader.tensors:
+            if not tensor.name.startswith("direction."):
+                continue
+            layer = int(tensor.name.split(".")[1])
+            if not 1 <= layer <= self.layer_count:
+                raise ValueError(f"'{path}' has a direction for layer {layer}, but only {self.layer_count} layers.")
+            tensors[layer] = torch.from_numpy(tensor.data.copy()).to(torch.float32).flatten()
+        if not tensors:
+            raise ValueError(f"'{path}' has no directions.")
+
+        hidden_size = {tensor.numel() for tensor in tensors.values()}
+        if len(hidden_size) != 1:
+            raise ValueError(f"'{path}' has directions of different sizes: {sorted(hidden_size)}")
+        self.hidden_size = hidden_size.pop()
+
+        self.directions = torch.zeros((self.layer_count, self.hidden_size), dtype = torch.float32)
+        self.present = torch.zeros(self.layer_count, dtype = torch.bool)
+        for layer, tensor in tensors.items():
+            self.directions[layer - 1] = tensor
+            self.present[layer - 1] = True
+
+    @staticmethod
+    def _get_value(reader, key: str):
+        field = reader.get_field(key)
+        if field is None:
+            raise KeyError(f"The '{key}' key is missing.")
+        return field.parts[field.data[0]][0]
+
+    @staticmethod
+    def _get_string(reader, key: str) -> str:
+        field = reader.get_field(key)
+        if field is None:
+            raise KeyError(f"The '{key}' key is missing.")
+        return bytes(field.parts[field.data[0]]).decode("utf-8")
+
+def parse_layers(layers: Optional[str], layer_count: int) -> torch.Tensor:
+    """
+    Parses a list of 1-based layers and inclusive ranges (eg: '1,3,10-40') into a [layer_count] boolean mask.
+
+    Returns:
+        torch.Tensor: The mask (all True if 'layers' is None).
+    """
+    mask = torch.zeros(layer_count, dtype = torch.bool)
+    if layers is None:
+        mask[:] = True
+        return mask
+    for part in layers.split(","):
+        start, _, end = part.strip().partition("-")
+        start, end = int(start), int(end or start)
+        if not 1 <= start <= end <= layer_count:
+            raise ValueError(f"Invalid layer range '{part}' (the layers are numbered 1 to {layer_count}).")
+        mask[start - 1:end] = True
+    return mask
+
+def combine_control_vectors(
+    control_vectors: List[ControlVector],
+    scales: Optional[List[float]] = None,
+    layer_masks: Optional[List[Optional[torch.Tensor]]] = None
+) -> List[Optional[torch.Tensor]]:
+    """
+    Combines control vectors into one, by summing the scaled (and optionally masked) directions of each layer.
+
+    Parameters:
+        control_vectors (List[ControlVector]): The control vectors, which must all be for the same model.
+        scales (List[float]): The scale of each control vector (default: 1.0).
+        layer_masks (List[torch.Tensor]): An optional [layer_count] boolean mask of the layers to use from each.
+
+    Returns:
+        List[Optional[torch.Tensor]]: The [1, hidden] direction of each layer (None for layers none of them use),
+                                      in the form export_gguf() takes.
+    """
+    if not control_vectors:
+        raise ValueError("At least one control vector must be given.")
+    first = control_vectors[0]
+    for control_vector in control_vectors[1:]:
+        if (control_vector.model_hint, control_vector.layer_count, control_vector.hidden_size) != (first.model_hint, first.layer_count, first.hidden_size):
+            raise ValueError(
+                f"'{control_vector.path}' is for a different model ('{control_vector.model_hint}', {control_vector.layer_count} layers, "
+                f"hidden size {control_vector.hidden_size}) than '{first.path}' ('{first.model_hint}', {first.layer_count} layers, "
+                f"hidden size {first.hidden_size})."
+            )
+    scales = scales if scales is not None else [1.0] * len(control_vectors)
+    layer_masks = layer_masks if layer_masks is not None else [None] * len(control_vectors)
+
+    # Sum every layer of every control vector at once: [n] x [n, layer, hidden] --> [layer, hidden].
+    with tracing.span("combine_control_vectors", count = len(control_vectors)):
+        masks = torch.stack([
+            control_vector.present & (mask if mask is not None else True)
+            for control_vector, mask in zip(control_vectors, layer_masks)
+        ])
+        directions = torch.stack([control_vector.directions for control_vector in control_vectors])
+        weights = torch.tensor(scales, dtype = torch.float32).unsqueeze(1) * masks
+        combined = torch.einsum("nl,nld->ld", weights, directions)
+        used = masks.any(dim = 0)
+
+    return [combined[layer].unsqueeze(0) if used[layer] else None for layer in range(first.layer_count)]
+
+def combine_gguf_files(
+    paths: List[Union[str, os.PathLike]],
+    output_path: Union[str, os.PathLike],
+    scales: Optional[List[float]] = None,
+    layers: Optional[List[Optional[str]]] = None,
+    cache: Optional[Dict[str, ControlVector]] = None,
+    verbose: bool = True
+) -> None:
+    """
+    Combines control vector '.gguf' files into a single '.gguf' file.
+
+    Parameters:
+        paths (List[str]): The control vector files.
+        output_path (str): The file to write.
+        scales (List[float]): The scale of each file (default: 1.0).
+        layers (List[str]): The (1-based) layers to use from each file, eg: '10-40' (default: all).
+        cache (Dict[str, ControlVector]): The control vectors already read (so files shared by presets are only read once).
+        verbose (bool): Print the details of the file written.
+    """
+    cache = cache if cache is not None else {}
+    control_vectors = []
+    for path in paths:
+        if path not in cache:
+            cache[path] = ControlVector(path)
+        control_vectors.append(cache[path])
+    layer_masks = [parse_layers(layer_range, control_vectors[0].layer_count) for layer_range in (layers or [None] * len(paths))]
+    directions = combine_control_vectors(control_vectors, scales, layer_masks)
+    if all(direction is None for direction in directions):
+        raise ValueError(f"No layers are left to write to '{output_path}'.")
+    export_gguf(directions, output_path, control_vectors[0].model_hint, control_vectors[0].layer_count, verbose = verbose)
+
+def combine_presets(presets_file_path: str, output_dir: str) -> List[str]:
+    """
+    Combines every preset in a JSON file of the form:
+
+        {"<name>": [{"path": "<file>.gguf", "scale": 0.5, "layers": "10-40"}, ...], ...}
+
+    writing each to '<output_dir>/<name>.gguf' ("scale" and "layers" are optional, and relative paths are
+    relative to the presets file).
+
+    Returns:
+        List[str]: The paths of the files written.
+    """
+    with open(presets_file_path, 'r') as f:
+        presets = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(presets_file_path))
+    os.makedirs(output_dir, exist_ok = True)
+
+    cache = {}
+    output_paths = []
+    for name, entries in presets.items():
+        output_path = os.path.join(output_dir, f"{name}.gguf")
+        combine_gguf_files(
+            [os.path.join(base_dir, entry["path"]) for entry in entries],
+            output_path,
+            scales = [float(entry.get("scale", 1.0)) for entry in entries],
+            layers = [entry.get("layers") for entry in entries],
+            cache = cache,
+            verbose = False
+        )
+        output_paths.append(output_path)
+    print(f"Combined {len(output_paths)} presets (from {len(cache)} control vectors) into '{output_dir}'.")
+    return output_paths
+
+def main(args):
+    if args.presets is not None:
+        if args.output_dir is None:
+            raise ValueError("--output_dir is needed to combine a presets file.")
+        combine_presets(args.presets, args.output_dir)
+        return
+
+    if not args.control_vector or args.output is None:
+        raise ValueError("--control_vector (at least once) and --output are needed, unless combining a presets file.")
+    paths, scales, layers = [], [], []
+    for values in args.control_vector:
+        if not 1 <= len(values) <= 3:
+            raise ValueError(f"Expected '--control_vector <file> [<scale> [<layers>]]': {' '.join(values)}")
+        paths.append(values[0])
+        scales.append(float(values[1]) if len(values) > 1 else 1.0)
+        layers.append(values[2] if len(values) > 2 else None)
+    combine_gguf_files(paths, args.output, scales, layers)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Combine control vector '.gguf' files into one, so llama.cpp only has to load (and add) a single file.")
+    parser.add_argument("--control_vector", type = str, nargs = "+", action = "append", metavar = "VALUE", help = "A control vector file, with an optional scale and (1-based) layers, eg: 'ornate.gguf 0.5 10-40' (can be repeated).")
+    parser.add_argument("--output", type = str, default = None, help = "The combined '.gguf' file to write.")
+    parser.add_argument("--presets", type = str, default = None, help = "A JSON file of presets to combine in one go (instead of --control_vector).")
+    parser.add_argument("--output_dir", type = str, default = None, help = "The folder to write each combined preset to.")
+    main(parser.parse_args())
@@ -0,0 +1,108 @@
+import os
+import json
+import torch
+import tracing
+
+from typing import List, Optional, Union
+
+ARCHITECTURE = "controlvector"
+
+class ModelMetadata:
+    """
+    The model metadata needed to export control vectors, read from 'config.json' only (ie: without loading the model).
+    """
+
+    def __init__(self, pretrained_model_name_or_path: Union[str, os.PathLike]):
+        config_path = os.path.join(pretrained_model_name_or_path, 'config.json')
+        if not os.path.exists(config_path):
+            raise FileNotFoundError(f"Configuration file not found at {config_path}")
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+
+        # Some (multimodal) configs keep the language model's settings in a nested 'text_config'.
+        text_config = config.get("text_config", {})
+
+        self.model_type = config.get("model_type")
+        if self.model_type is None:
+            raise KeyError("The 'model_type' key is missing in the configuration file")
+        self.num_layers = config.get("num_hidden_layers", text_config.get("num_hidden_layers"))
+        if self.num_layers is None:
+            raise KeyError("The 'num_hidden_layers' key is missing in the configuration file")
+        self.hidden_size = config.get("hidden_size", text_config.get("hidden_size"))
+
+    def get_num_layers(self):
+        return self.num_layers
+
+    def get_hidden_size(self):
+        return self.hidden_size
+
+    def get_model_type(self):
+        return self.model_type
+
+# See: https://github.com/vgel/repeng/blob/main/repeng/extract.py
+def export_gguf(directions: List[Optional[torch.Tensor]], path: Union[str, os.PathLike], model_type: str, num_layers: int, verbose: bool = True) -> None:
+    import gguf
+
+    if verbose:
+        print(f"Initializing GGUFWriter with path: '{path}' and architecture: '{ARCHITECTURE}'")
+    writer = gguf.GGUFWriter(path, ARCHITECTURE)
+
+    if verbose:
+        print(f"- Adding model hint: '{model_type}'")
+    writer.add_string(f"{ARCHITECTURE}.model_hint", model_type)
+
+    if verbose:
+        print(f"- Adding layer count: '{num_layers}'")
+    writer.add_uint32(f"{ARCHITECTURE}.layer_count", num_layers)
+
+    # Find the hidden dimension size from the first non-None tensor
+    hidden_dimension = next((tensor.shape[1] for tensor in directions if tensor is not None), None)
+    if hidden_dimension is None:
+        raise ValueError("All tensors are None or no tensor has a second dimension.")
+
+    if verbose:
+        print(f"Hidden dimension size across tensors: {hidden_dimension}")
+
+    # NOTE: Layers without a direction are left out, as llama.cpp treats missing layers as zero.
+    for layer, tensor in enumerate(directions):
+        if tensor is not None:
+            if verbose:
+                print(f"-- Processing layer: {layer + 1} with tensor of shape: {tensor.shape}")
+            if tensor.shape[0] > 1:
+                combined_tensor = torch.sum(tensor, dim=0)
+                if verbose:
+                    print(f"--- Combined vectors for layer {layer + 1} into shape: {combined_tensor.shape}")
+            else:
+                combined_tensor = tensor[0]
+            writer.add_tensor(f"direction.{layer + 1}", combined_tensor.flatten().numpy())
+
+    with tracing.span("write_gguf"):
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file()
+
+        writer.close()
+    tracing.count("bytes_written", os.path.getsize(path))
+
+    if verbose:
+        print("Export completed")
+
+def export_gguf_set(
+    direction_matrices: List[List[Optional[torch.Tensor]]],
+    names: List[str],
+    output_path: str,
+    model_metadata: ModelMetadata
+) -> List[str]:
+    """
+    Exports each class's directions (eg: debias, negative and positive) to '<output_path>_<name>.gguf'.
+
+    Returns:
+        List[str]: The paths of the files written (classes without any directions are skipped).
+    """
+    paths = []
+    for directions, name in zip(direction_matrices, names):
+        if any(direction is not None for direction in directions):
+            path = output_path + f"_{name}.gguf"
+            export_gguf(directions, path, model_metadata.get_model_type(), model_metadata.get_num_layers())
+            paths.append(path)
+    return paths
@@ -0,0 +1,136 @@
+import torch
+import tracing
+
+from functools import partial
+from typing import List, Optional
+from transformers import DynamicCache
+
+class StopForward(Exception):
+    """
+    Raised from the hook of the last needed layer to skip the remaining layers (and the LM head).
+    """
+    pass
+
+class LastTokenCapture:
+    """
+    Captures the last-token residual stream going into and coming out of selected decoder layers
+    using forward hooks on 'model.model.layers', rather than asking the model for all hidden states.
+
+    NOTE: With device_map = 'auto' the layers (and a layer's input) can be split over several GPUs, so every captured
+          row is moved to the device of the first captured layer before they are differenced and stacked.
+    """
+
+    def __init__(self, model, layer_indices: List[int]):
+        assert hasattr(model.model, 'layers'), "The model does not have the expected structure."
+        if not layer_indices:
+            raise ValueError("At least one layer index must be given.")
+
+        self.model = model
+        self.layer_indices = sorted(layer_indices)
+        self.num_layers = len(model.model.layers)
+        self.last_layer_index = self.layer_indices[-1]
+        if self.layer_indices[0] < 0 or self.last_layer_index >= self.num_layers:
+            raise IndexError(f"Layer indices must be in the range [0, {self.num_layers}).")
+
+        first_layer = model.model.layers[self.layer_indices[0]]
+        self.capture_device = next(first_layer.parameters(), torch.empty(0)).device
+
+        self.inputs = {}
+        self.outputs = {}
+        self.handles = []
+        for layer_index in self.layer_indices:
+            layer = model.model.layers[layer_index]
+            self.handles.append(layer.register_forward_pre_hook(partial(self._pre_hook, layer_index), with_kwargs = True))
+            self.handles.append(layer.register_forward_hook(partial(self._hook, layer_index)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # @UnusedVariable
+        self.remove()
+
+    def remove(self) -> None:
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        past_key_values: Optional[DynamicCache] = None,
+        to_host: bool = True
+    ) -> torch.Tensor:
+        """
+        Runs the decoder stack (without the LM head) up to the last needed layer.
+
+        Parameters:
+            input_ids (torch.Tensor): The (left padded) token ids.
+            attention_mask (torch.Tensor): The attention mask, including any cached prefix.
+            position_ids (torch.Tensor): The position ids.
+            past_key_values (DynamicCache): An optional cache holding a previously run prefix.
+            to_host (bool): Copy the deltas to the CPU (otherwise leave them on the model's device).
+
+        Returns:
+            torch.Tensor: The last-token deltas of shape [batch, len(layer_indices), hidden].
+        """
+        with tracing.span("forward", rows = input_ids.shape[0], length = input_ids.shape[1]):
+            self._run(input_ids, attention_mask, position_ids, past_key_values)
+        deltas = torch.stack([self.outputs[i] - self.inputs[i] for i in self.layer_indices], dim = 1)
+        if to_host:
+            with tracing.span("device_to_host"):
+                deltas = deltas.to('cpu')
+        self.inputs = {}
+        self.outputs = {}
+        return deltas
+
+    def prefill(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None
+    ) -> DynamicCache:
+        """
+        Runs a prefix through the decoder stack up to the last needed layer to fill a KV cache.
+
+        Returns:
+            DynamicCache: The cache, which can then be passed to forward() for each suffix.
+        """
+        cache = DynamicCache()
+        self._run(input_ids, attention_mask, position_ids, cache)
+        self.inputs = {}
+        self.outputs = {}
+        return cache
+
+    def _run(self, input_ids, attention_mask, position_ids, past_key_values) -> None:
+        self.inputs = {}
+        self.outputs = {}
+        try:
+            self.model.model(
+                input_ids = input_ids,
+                attention_mask = attention_mask,
+                position_ids = position_ids,
+                past_key_values = past_key_values,
+                use_cache = past_key_values is not None
+            )
+        except StopForward:
+            pass
+
+    def _pre_hook(self, layer_index, module, args, kwargs):  # @UnusedVariable
+        hidden_states = args[0] if args else kwargs["hidden_states"]
+        # NOTE: Clone so the full [batch, seq_len, hidden] activation isn't kept alive by the view.
+        self.inputs[layer_index] = hidden_states[:, -1, :].to(self.capture_device, copy = True)
+
+    def _hook(self, layer_index, module, args, output):  # @UnusedVariable
+        hidden_states = output[0] if isinstance(output, tuple) else output
+        last_hidden_state = hidden_states[:, -1:, :]
+
+        # The final entry of 'output_hidden_states' has the final norm applied, so match that for the last layer.
+        if layer_index == self.num_layers - 1 and getattr(self.model.model, 'norm', None) is not None:
+            last_hidden_state = self.model.model.norm(last_hidden_state)
+
+        self.outputs[layer_index] = last_hidden_state[:, 0, :].to(self.capture_device, copy = True)
+
+        if layer_index == self.last_layer_index:
+            raise StopForward()
@@ -1,13 +1,25 @@
 import os
 import sys
+import copy
+import time
 import torch
+import concurrent.futures
+import tracing
 
 from tqdm import tqdm
 
-from typing import Union, List
+from typing import Union, List, Tuple, Optional, TYPE_CHECKING
 
 from dataset_manager import DatasetManager
-from model_handler import ModelHandler
+from hidden_state_store import HiddenStateStore
+from hidden_state_statistics import HiddenStateStatistics
+from direction_analyzer import compute_layer_range
+from chat_template_tokenizer import ChatTemplateTokenizer
+from activation_cache import ActivationCache, compute_model_fingerprint
+
+# NOTE: The model (and hence transformers, bitsandbytes, etc) are only imported when sampling is needed.
+if TYPE_CHECKING:
+    from hidden_state_capture import LastTokenCapture
 
 class HiddenStateDataManager:
 
@@ -16,60 +28,265 @@ class HiddenStateDataManager:
         dataset_manager: DatasetManager,
         pretrained_model_name_or_path: Union[str, os.PathLike],
         output_path: str,
-        use_separate_system_message: bool
+        use_separate_system_message: bool,
+        batch_size: int = 1,
+        max_batch_tokens: Optional[int] = None,
+        skip_begin_layers = 0,
+        skip_end_layers = 0,
+        share_prefix: bool = False,
+        use_statistics: bool = False,
+        activation_cache_path: Optional[str] = None,
+        activation_cache_size: Optional[int] = None,
+        checkpoint_interval: float = 300,
+        device: str = "cuda",
+        torch_dtype: Optional[str] = None,
+        quantize_int8: bool = False,
+        num_sampling_workers: int = 1,
+        num_threads: Optional[int] = None,
+        storage_encoding: Optional[str] = None,
+        verify_store: bool = False
     ):
         self.model_handler = None
-        self.dataset_hidden_states = []
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.share_prefix = share_prefix
+        self.use_statistics = use_statistics
+        self.checkpoint_interval = checkpoint_interval
+        self.num_sampling_workers = num_sampling_workers
+        self.verify_store = verify_store
+        self.sampling_backend = {
+            "pretrained_model_name_or_path": pretrained_model_name_or_path,
+            "device": device,
+            "torch_dtype": torch_dtype,
+            "quantize_int8": quantize_int8,
+            "num_threads": num_threads,
+        }
+        self.store = None
+        self.statistics = None
+        self.activation_cache = None
 
-        filename = output_path + "_hidden_state_samples.pt"
-        if os.path.exists(filename):
-            print(f"Loading existing '{filename}'... ", end="")
+        store_path = output_path + ("_hidden_state_statistics" if use_statistics else "_hidden_state_samples")
+        legacy_filename = output_path + "_hidden_state_samples.pt"
+        # NOTE: A complete run is reused as is, unless more samples were asked for (when only the new ones are sampled).
+        if use_statistics and HiddenStateStatistics.exists(store_path) and self._is_reusable(HiddenStateStatistics(store_path), dataset_manager):
+            print(f"Loading existing '{store_path}'... ", end="")
             sys.stdout.flush()
-            self.load_hidden_state_samples(filename)
-            print(f"Done ({self.get_total_samples()} samples; {self.get_num_layers()} layers).")
-        else:
-            self._load_model(pretrained_model_name_or_path)
-            dataset_tokens = self._tokenize_datasets(dataset_manager, use_separate_system_message)
-            self._generate_hidden_state_samples(dataset_tokens)
-            print(f"Saving to '{filename}'... ", end="")
+            self.statistics = HiddenStateStatistics(store_path)
+            print(f"Done ({self.get_total_samples()} samples; {len(self.statistics.layer_indices)}/{self.get_num_layers()} layers).")
+        elif not use_statistics and HiddenStateStore.exists(store_path) and self._is_reusable(HiddenStateStore(store_path), dataset_manager):
+            print(f"Loading existing '{store_path}'... ", end="")
             sys.stdout.flush()
-            self.save_hidden_state_samples(filename)
-            print("Done.")
+            self.load_hidden_state_samples(store_path)
+            print(f"Done ({self.get_total_samples()} samples; {len(self.store.layer_indices)}/{self.get_num_layers()} layers).")
+        elif not use_statistics and os.path.exists(legacy_filename):
+            print(f"Converting existing '{legacy_filename}' to '{store_path}'... ", end="")
+            sys.stdout.flush()
+            self.convert_legacy_hidden_state_samples(legacy_filename, store_path)
+            print(f"Done ({self.get_total_samples()} samples; {len(self.store.layer_indices)}/{self.get_num_layers()} layers).")
+        else:
+            # Tokenize in the background while the model loads (only the tokenizer is needed for this).
+            # NOTE: Sampling workers each load their own model, so then only the tokenizer and config are needed here.
+            self._load_model(pretrained_model_name_or_path, device, torch_dtype, quantize_int8, load_model = False)
+            with concurrent.futures.ThreadPoolExecutor(max_workers = 1) as executor:
+                tokenize_future = executor.submit(self._tokenize_datasets, dataset_manager, use_separate_system_message)
+                if num_sampling_workers <= 1:
+                    with tracing.span("load_model"):
+                        self.model_handler.load_model()
+                with tracing.span("wait_for_tokenize"):
+                    dataset_tokens = tokenize_future.result()
+            # Only capture the layers the direction analysis will actually use.
+            layer_indices = list(compute_layer_range(self.model_handler.get_num_layers(), skip_begin_layers, skip_end_layers))
+            model_fingerprint = compute_model_fingerprint(pretrained_model_name_or_path)
+            # Everything that determines the samples, so a partial run is only resumed if it would give the same samples.
+            manifest = {
+                "dataset": dataset_manager.get_manifest(),
+                "model": model_fingerprint,
+                "backend": self.model_handler.get_backend(),
+                "use_separate_system_message": use_separate_system_message,
+                "layer_indices": layer_indices,
+            }
+            if activation_cache_path is not None:
+                self.activation_cache = ActivationCache(
+                    activation_cache_path,
+                    model_fingerprint,
+                    settings = {"layer_indices": layer_indices, **self.model_handler.get_backend()},
+                    dtype = self.model_handler.torch_dtype,
+                    max_size = activation_cache_size
+                )
+            if use_statistics:
+                self.statistics = self._resume_statistics(store_path, manifest, dataset_manager)
+                if self.statistics is None:
+                    # Only the pair of classes analysed for each axis needs a cross co-moment.
+                    self.statistics = HiddenStateStatistics.create(
+                        store_path,
+                        num_classes = len(dataset_tokens),
+                        num_layers = self.model_handler.get_num_layers(),
+                        layer_indices = layer_indices,
+                        hidden_size = self.model_handler.get_hidden_size(),
+                        class_pairs = [tuple(class_indices[:2]) for class_indices in dataset_manager.axis_class_indices if len(class_indices) >= 2],
+                        manifest = manifest
+                    )
+                self._generate_hidden_state_samples(dataset_tokens)
+                self.statistics.save()
+            else:
+                # The encoding changes the stored samples, so a partial run is only resumed with the same encoding.
+                storage_encoding = storage_encoding or str(self.model_handler.torch_dtype).replace("torch.", "")
+                manifest["storage_encoding"] = storage_encoding
+                self.store = self._resume_store(store_path, manifest, dataset_manager)
+                if self.store is None:
+                    self.store = HiddenStateStore.create(
+                        store_path,
+                        num_classes = len(dataset_tokens),
+                        num_samples = len(dataset_tokens[0]),
+                        num_layers = self.model_handler.get_num_layers(),
+                        layer_indices = layer_indices,
+                        hidden_size = self.model_handler.get_hidden_size(),
+                        dtype = self.model_handler.torch_dtype,
+                        manifest = manifest,
+                        encoding = storage_encoding
+                    )
+                self._generate_hidden_state_samples(dataset_tokens)
+                self.store.mark_complete()
+            if self.activation_cache is not None:
+                self.activation_cache.print_statistics()
+                self.activation_cache.close()
+                self.activation_cache = None
+
+        if self.get_num_dataset_types() != dataset_manager.get_num_classes():
+            raise ValueError(f"'{store_path}' has {self.get_num_dataset_types()} classes but {dataset_manager.get_num_classes()} were expected.")
     
-    def get_datasets(self, layer_index: int) -> List[torch.Tensor]:
-        return [torch.stack([sample[layer_index] for sample in dataset]) for dataset in self.dataset_hidden_states]
+    @classmethod
+    def open(cls, store_path: str, use_statistics: bool = False) -> "HiddenStateDataManager":
+        """
+        Opens an existing store without sampling (eg: for the analysis worker processes).
+        """
+        hidden_state_data_manager = cls.__new__(cls)
+        hidden_state_data_manager.model_handler = None
+        hidden_state_data_manager.use_statistics = use_statistics
+        hidden_state_data_manager.store = None if use_statistics else HiddenStateStore(store_path)
+        hidden_state_data_manager.statistics = HiddenStateStatistics(store_path) if use_statistics else None
+        return hidden_state_data_manager
+
+    @classmethod
+    def open_for_sampling(cls, model_handler, share_prefix: bool = False) -> "HiddenStateDataManager":
+        """
+        Wraps a loaded model without any store (eg: for the sampling worker processes).
+        """
+        hidden_state_data_manager = cls.__new__(cls)
+        hidden_state_data_manager.model_handler = model_handler
+        hidden_state_data_manager.share_prefix = share_prefix
+        hidden_state_data_manager.store = None
+        hidden_state_data_manager.statistics = None
+        hidden_state_data_manager.activation_cache = None
+        return hidden_state_data_manager
+
+    def run_groups(
+        self,
+        capture: "LastTokenCapture",
+        groups: List[List[Tuple[int, int, torch.Tensor]]],
+        share_prefix: bool,
+        to_host: bool = True
+    ) -> Tuple[List[Tuple[int, int, torch.Tensor]], torch.Tensor]:
+        """
+        Runs a batch of groups through the model (eg: for a sampling worker process).
+
+        Parameters:
+            capture (LastTokenCapture): The capture hooked into the model's layers.
+            groups (List[List[Tuple[int, int, torch.Tensor]]]): The (class_index, sample_index, tokens) items of each group.
+            share_prefix (bool): Run each group's shared prefix once (the groups must be matched sample tuples).
+            to_host (bool): Copy the deltas back to the host (or else leave them on the device).
+
+        Returns:
+            tuple: The items in the order run, and their deltas of shape [batch, len(layer_indices), hidden].
+        """
+        if share_prefix:
+            return self._generate_with_shared_prefix(capture, groups, to_host)
+        items = [item for group in groups for item in group]
+        return items, self._generate(capture, [tokens for _, _, tokens in items], to_host)
+
+    def get_store_path(self) -> str:
+        return self.statistics.path if self.has_statistics() else self.store.path
+
+    def get_fingerprint(self) -> str:
+        return self.statistics.get_fingerprint() if self.has_statistics() else self.store.get_fingerprint()
+
+    def has_statistics(self) -> bool:
+        return self.statistics is not None
+
+    def get_layer_moments(self, layer_index: int, class_indices: List[int]):
+        return self.statistics.get_layer_moments(layer_index, class_indices)
+
+    def get_datasets(self, layer_index: int, class_indices: Optional[List[int]] = None) -> List[torch.Tensor]:
+        if class_indices is None:
+            class_indices = range(self.get_num_dataset_types())
+        # NOTE: Only the chosen classes are read (and decoded, if the store is quantized).
+        return [self.store.get_class(layer_index, i) for i in class_indices]
     
-    def get_differenced_datasets(self, layer_index: int) -> List[torch.Tensor]:
-        datasets = self.get_datasets(layer_index)
-        return [dataset - datasets[0] for dataset in datasets[1:]]
+    def get_differenced_datasets(self, layer_index: int, class_indices: Optional[List[int]] = None) -> List[torch.Tensor]:
+        # Difference the chosen classes (default: all non-baseline classes) against the baseline class.
+        if class_indices is None:
+            class_indices = range(1, self.get_num_dataset_types())
+        baseline = self.store.get_class(layer_index, 0)
+        return [self.store.get_class(layer_index, i) - baseline for i in class_indices]
     
     def get_num_layers(self) -> int:
-        return len(self.dataset_hidden_states[0][0])
+        return self.statistics.num_layers if self.has_statistics() else self.store.num_layers
+
+    def has_layer(self, layer_index: int) -> bool:
+        return self.statistics.has_layer(layer_index) if self.has_statistics() else self.store.has_layer(layer_index)
 
     def get_num_dataset_types(self) -> int:
-        return len(self.dataset_hidden_states)
+        return self.statistics.num_classes if self.has_statistics() else self.store.num_classes
 
     def get_total_samples(self) -> int:
-        return sum(len(dataset) for dataset in self.dataset_hidden_states)
+        if self.has_statistics():
+            return self.statistics.num_classes * self.statistics.count
+        return self.store.num_classes * self.store.num_samples
 
-    def get_num_features(self, layer_index: int) -> int:
-        return self.dataset_hidden_states[0][0][layer_index].shape[-1]
+    def get_num_features(self, layer_index: int) -> int:  # @UnusedVariable
+        return self.statistics.hidden_size if self.has_statistics() else self.store.hidden_size
 
-    def load_hidden_state_samples(self, file_path: str) -> None:
-        try:
-            self.dataset_hidden_states = torch.load(file_path)
-        except Exception as e:
-            print(f"Error loading hidden state samples from {file_path}: {e}")
-            
-    def save_hidden_state_samples(self, file_path: str) -> None:
-        try:
-            torch.save(self.dataset_hidden_states, file_path)
-        except Exception as e:
-            print(f"Error saving hidden state samples to {file_path}: {e}")
+    def load_hidden_state_samples(self, store_path: str) -> None:
+        self.store = HiddenStateStore(store_path)
+
+    def convert_legacy_hidden_state_samples(self, file_path: str, store_path: str, chunk_size: int = 256) -> None:
+        # The old format is a pickled [class][sample][layer] list of tensors (with None for layers not sampled).
+        dataset_hidden_states = torch.load(file_path)
+        first_sample = dataset_hidden_states[0][0]
+        layer_indices = [i for i, tensor in enumerate(first_sample) if tensor is not None]
+        self.store = HiddenStateStore.create(
+            store_path,
+            num_classes = len(dataset_hidden_states),
+            num_samples = len(dataset_hidden_states[0]),
+            num_layers = len(first_sample),
+            layer_indices = layer_indices,
+            hidden_size = first_sample[layer_indices[0]].shape[-1],
+            dtype = first_sample[layer_indices[0]].dtype
+        )
+        for class_index, dataset in enumerate(dataset_hidden_states):
+            for start in range(0, len(dataset), chunk_size):
+                samples = dataset[start:start + chunk_size]
+                deltas = torch.stack([torch.stack([sample[i] for i in layer_indices]) for sample in samples])
+                self.store.write([class_index] * len(samples), list(range(start, start + len(samples))), deltas)
+        self.store.mark_complete()
 
-    def _load_model(self, pretrained_model_name_or_path: Union[str, os.PathLike]):
+    def _load_model(
+        self,
+        pretrained_model_name_or_path: Union[str, os.PathLike],
+        device: str = "cuda",
+        torch_dtype: Optional[str] = None,
+        quantize_int8: bool = False,
+        load_model: bool = True
+    ):
+        from model_handler import ModelHandler
         try:
-            self.model_handler = ModelHandler(pretrained_model_name_or_path, device = "cuda")
+            self.model_handler = ModelHandler(
+                pretrained_model_name_or_path,
+                device = device,
+                torch_dtype = torch_dtype,
+                quantize_int8 = quantize_int8,
+                load_model = load_model
+            )
         except Exception as e:
             print(f"Error loading model: {e}")
 
@@ -78,52 +295,381 @@ class HiddenStateDataManager:
         dataset_manager: DatasetManager,
         use_separate_system_message: bool
     ) -> List[List[torch.Tensor]]:
-        dataset_tokens = [[] for _ in range(dataset_manager.get_num_classes())]
-        try:
-            with tqdm(total = dataset_manager.get_total_samples(), desc = "Tokenizing prompts") as bar:
-                for i, dataset in enumerate(dataset_manager.datasets):
-                    for system_message, prompt in dataset:
-                        if use_separate_system_message:
-                            conversation = [
-                                {"role": "system", "content": system_message},
-                                {"role": "user", "content": prompt}
-                            ]
-                        else:
-                            conversation = [{"role": "user", "content": system_message + " " + prompt}]
-                        tokens = self.model_handler.tokenizer.apply_chat_template(
-                            conversation = conversation,
-                            add_generation_prompt = True,
-                            return_tensors = "pt"
-                        )
-                        dataset_tokens[i].append(tokens)
-                        bar.update(n = 1)
-        except Exception as e:
-            print(f"Error during tokenization: {e}")
+        # Tokenize every class in one go, so the bodies shared between classes are only encoded once.
+        with tracing.span("tokenize"):
+            tokenizer = ChatTemplateTokenizer(self.model_handler.tokenizer, use_separate_system_message)
+            token_list = tokenizer.tokenize([conversation for dataset in dataset_manager.datasets for conversation in dataset])
+        dataset_tokens = []
+        start = 0
+        for dataset in dataset_manager.datasets:
+            dataset_tokens.append(token_list[start:start + len(dataset)])
+            start += len(dataset)
         return dataset_tokens
 
+    def _is_reusable(self, saved: Union[HiddenStateStore, HiddenStateStatistics], dataset_manager: DatasetManager) -> bool:
+        # NOTE: A damaged run is resumed instead, which resamples the rows (or restarts the statistics) that don't
+        #       match their checksums. Only a cheap check is done unless asked for, as a full one reads everything.
+        return saved.is_complete() and not self._can_top_up(saved.get_manifest(), dataset_manager) and saved.verify(self.verify_store)
+
+    @staticmethod
+    def _can_top_up(saved_manifest: Optional[dict], dataset_manager: DatasetManager, manifest: Optional[dict] = None) -> bool:
+        """
+        Checks if a saved run holds fewer samples than asked for, which are the first samples of the requested datasets
+        (and, if a manifest is given, that everything else that determines the samples matches it).
+        """
+        if saved_manifest is None or "dataset" not in saved_manifest:
+            return False
+        if manifest is not None and {k: v for k, v in saved_manifest.items() if k != "dataset"} != {k: v for k, v in manifest.items() if k != "dataset"}:
+            return False
+        num_samples = saved_manifest["dataset"]["num_samples"]
+        return num_samples < len(dataset_manager.datasets[0]) and saved_manifest["dataset"] == dataset_manager.get_manifest(num_samples)
+
+    def _resume_statistics(self, store_path: str, manifest: dict, dataset_manager: DatasetManager) -> Optional[HiddenStateStatistics]:
+        if not HiddenStateStatistics.exists(store_path):
+            return None
+        statistics = HiddenStateStatistics(store_path)
+        if self._can_top_up(statistics.get_manifest(), dataset_manager, manifest):
+            print(f"Topping up '{store_path}' from {statistics.get_manifest()['dataset']['num_samples']} to {manifest['dataset']['num_samples']} samples per class.")
+            statistics.reopen(manifest)
+        elif statistics.get_manifest() != manifest:
+            print(f"WARNING: '{store_path}' was sampled from a different dataset or model, so starting again.")
+            return None
+        try:
+            statistics.load_checkpoint()
+        except (ValueError, KeyError, RuntimeError) as e:
+            print(f"WARNING: Unable to load the checkpoint in '{store_path}' ({e}), so starting again.")
+            return None
+        print(f"Resuming '{store_path}' ({len(statistics.completed_samples)} sample tuples already done).")
+        return statistics
+
+    def _resume_store(self, store_path: str, manifest: dict, dataset_manager: DatasetManager) -> Optional[HiddenStateStore]:
+        if not HiddenStateStore.exists(store_path):
+            return None
+        store = HiddenStateStore(store_path)
+        if self._can_top_up(store.get_manifest(), dataset_manager, manifest):
+            print(f"Topping up '{store_path}' from {store.num_samples} to {manifest['dataset']['num_samples']} samples per class... ", end="")
+            sys.stdout.flush()
+            store.grow(manifest["dataset"]["num_samples"], manifest)
+            print("Done.")
+        elif store.get_manifest() != manifest:
+            print(f"WARNING: '{store_path}' was sampled from a different dataset or model, so starting again.")
+            return None
+        num_written = store.load_journal()
+        print(f"Resuming '{store_path}' ({num_written}/{store.num_classes * store.num_samples} samples already done).")
+        return store
+
     def _generate_hidden_state_samples(self, dataset_tokens: List[List[torch.Tensor]]) -> None:
+        # Skip anything already done by an earlier (interrupted) run.
+        groups = [group for group in self._create_groups(dataset_tokens) if not self._is_group_done(group)]
+        batches = self._create_batches(groups)
+        self._find_repeats(batches)
+        num_samples = sum(len(tokens) for tokens in dataset_tokens)
+        num_remaining = sum(len(group) for group in groups)
+        layer_indices = self.statistics.layer_indices if self.has_statistics() else self.store.layer_indices
+        self.last_checkpoint = time.time()
         try:
-            num_samples = sum(len(tokens) for tokens in dataset_tokens)
-            with tqdm(total = num_samples, desc = "Sampling hidden states") as bar:
-                for token_list in dataset_tokens:
-                    hidden_states = []
-                    for tokens in token_list:
-                        hidden_states.append(self._generate(tokens))
-                        bar.update(n = 1)
-                    self.dataset_hidden_states.append(hidden_states)
-        except Exception as e:
-            print(f"Error generating hidden states: {e}")
-
-    def _generate(self, tokens: torch.Tensor) -> List[torch.Tensor]:
-        output = self.model_handler.model.generate(
-            tokens.to(self.model_handler.model.device),
-            use_cache = False,
-            max_new_tokens = 1,
-            return_dict_in_generate = True,
-            output_hidden_states = True,
-            attention_mask = torch.ones(tokens.size(), dtype=torch.long).to(tokens.device),
-            pad_token_id = self.model_handler.tokenizer.pad_token_id if self.model_handler.tokenizer.pad_token_id is not None else self.model_handler.tokenizer.eos_token_id
+            with tracing.span("sample_hidden_states"), tqdm(total = num_samples, initial = num_samples - num_remaining, desc = "Sampling hidden states") as bar:
+                if self.num_sampling_workers > 1:
+                    self._sample_with_workers(batches, layer_indices, bar)
+                else:
+                    self._sample(batches, layer_indices, bar)
+        except BaseException:
+            # Keep every batch written so far (an interrupted statistics update can't be kept though).
+            if not self.has_statistics():
+                self.store.checkpoint()
+            raise
+
+    def _sample(self, batches: List[List[List[Tuple[int, int, torch.Tensor]]]], layer_indices: List[int], bar: tqdm) -> None:
+        from hidden_state_capture import LastTokenCapture
+        from sampling_pipeline import SamplingPipeline
+
+        # The cache lookups run ahead in a producer thread, and the deltas are copied back asynchronously to be
+        # cached and saved in a writer thread, so the model is kept busy.
+        def compute(prepared):
+            items, keys, found, groups, share_prefix = prepared
+            with tracing.span("batch", memory = True, rows = len(items)):
+                computed_items, computed = self.run_groups(capture, groups, share_prefix, to_host = False) if groups else ([], None)
+            return (items, keys, found, computed_items), computed
+
+        def finish(payload, computed):
+            self._save_batch(*self._complete_batch(*payload, computed), bar)
+
+        with LastTokenCapture(self.model_handler.model, layer_indices) as capture:
+            pipeline = SamplingPipeline(
+                prepare = lambda batch: self._lookup_batch(batch, layer_indices),
+                compute = compute,
+                finish = finish
+            )
+            pipeline.run(batches)
+
+    def _sample_with_workers(self, batches: List[List[List[Tuple[int, int, torch.Tensor]]]], layer_indices: List[int], bar: tqdm) -> None:
+        from sampling_workers import SamplingWorkerPool
+        backend = self.sampling_backend
+        with SamplingWorkerPool(
+            self.num_sampling_workers,
+            backend["pretrained_model_name_or_path"],
+            backend["device"],
+            backend["torch_dtype"],
+            backend["quantize_int8"],
+            layer_indices,
+            backend["num_threads"]
+        ) as pool:
+            # Keep a couple of batches queued per worker, so none are left idle (but without holding every batch in flight).
+            # NOTE: The results come back in any order, but are saved in order (as repeats reuse earlier batches' deltas).
+            pending = {}
+            results = {}
+            next_batch = 0
+            next_save = 0
+            while next_save < len(batches):
+                while next_batch < len(batches) and len(pending) < 2 * self.num_sampling_workers:
+                    items, keys, found, groups, share_prefix = self._lookup_batch(batches[next_batch], layer_indices)
+                    pending[next_batch] = (items, keys, found)
+                    if groups:
+                        pool.submit(next_batch, groups, share_prefix)
+                    else:
+                        results[next_batch] = ([], None)
+                    next_batch += 1
+                if next_save not in results:
+                    with tracing.span("wait_for_workers"):
+                        task_id, computed_items, computed = pool.get_result()
+                    results[task_id] = (computed_items, computed)
+                    continue
+                self._save_batch(*self._complete_batch(*pending.pop(next_save), *results.pop(next_save)), bar)
+                next_save += 1
+
+    def _is_group_done(self, group: List[Tuple[int, int, torch.Tensor]]) -> bool:
+        if self.has_statistics():
+            return group[0][1] in self.statistics.completed_samples
+        return all(self.store.is_written(class_index, sample_index) for class_index, sample_index, _ in group)
+
+    def _find_repeats(self, batches: List[List[List[Tuple[int, int, torch.Tensor]]]]) -> None:
+        """
+        Finds the cache key of every item up front, so a conversation repeated anywhere in the run (not just within
+        a batch) is only looked up and run once: later batches reuse the deltas of its first occurrence, which are
+        held until the last repeat is saved.
+        """
+        self.item_keys = {}
+        self.repeated_items = set()
+        self.repeat_counts = {}
+        self.repeat_deltas = {}
+        if self.activation_cache is None:
+            return
+        first_batch = {}
+        for batch_index, batch in enumerate(batches):
+            for group in batch:
+                for class_index, sample_index, tokens in group:
+                    key = self.activation_cache.get_key(tokens)
+                    self.item_keys[(class_index, sample_index)] = key
+                    if first_batch.setdefault(key, batch_index) < batch_index:
+                        self.repeated_items.add((class_index, sample_index))
+                        self.repeat_counts[key] = self.repeat_counts.get(key, 0) + 1
+        tracing.count("repeated_items", len(self.repeated_items))
+
+    def _lookup_batch(self, batch: List[List[Tuple[int, int, torch.Tensor]]], layer_indices: List[int]):
+        """
+        Looks up a batch in the activation cache (if used).
+
+        Returns:
+            tuple: The items, their cache keys (or None), the cached deltas found, and the groups left to run (and if they can share prefixes).
+        """
+        items = [item for group in batch for item in group]
+        tracing.count("tokens", sum(tokens.shape[-1] for _, _, tokens in items))
+        if self.activation_cache is None:
+            return items, None, {}, batch, self.share_prefix
+
+        keys = [self.item_keys[(class_index, sample_index)] for class_index, sample_index, _ in items]
+        repeated = [(class_index, sample_index) in self.repeated_items for class_index, sample_index, _ in items]
+        found = self.activation_cache.get(
+            [key for key, is_repeat in zip(keys, repeated) if not is_repeat],
+            [len(layer_indices), self.model_handler.get_hidden_size()]
         )
-        hidden_states_by_layer = [hidden_state[:, -1,:].squeeze().to('cpu') for hidden_state in output.hidden_states[-1][:]]
-        deltas = [hidden_states_by_layer[i] - hidden_states_by_layer[i - 1] for i in range(1, len(hidden_states_by_layer))]
-        return deltas
+        self.activation_cache.record_duplicates(sum(repeated))
+
+        # Only run each distinct conversation that isn't already cached or run by an earlier batch (once).
+        missing = {}
+        for key, item, is_repeat in zip(keys, items, repeated):
+            if not is_repeat and key not in found and key not in missing:
+                missing[key] = item
+        if len(missing) == len(items):
+            return items, keys, found, batch, self.share_prefix
+        return items, keys, found, [[item] for item in missing.values()], False
+
+    def _complete_batch(
+        self,
+        items: List[Tuple[int, int, torch.Tensor]],
+        keys: Optional[List[bytes]],
+        found: dict,
+        computed_items: List[Tuple[int, int, Optional[torch.Tensor]]],
+        computed: Optional[torch.Tensor]
+    ) -> Tuple[List[Tuple[int, int, Optional[torch.Tensor]]], torch.Tensor]:
+        if keys is None:
+            return computed_items, computed
+        if computed_items:
+            key_of = {(class_index, sample_index): key for key, (class_index, sample_index, _) in zip(keys, items)}
+            computed_keys = [key_of[(class_index, sample_index)] for class_index, sample_index, _ in computed_items]
+            self.activation_cache.put(computed_keys, computed)
+            found.update(zip(computed_keys, computed))
+        for key, (class_index, sample_index, _) in zip(keys, items):
+            if (class_index, sample_index) in self.repeated_items:
+                found[key] = self.repeat_deltas[key]
+                self.repeat_counts[key] -= 1
+            elif key in self.repeat_counts and key not in self.repeat_deltas:
+                # NOTE: Copied, as the computed deltas may live in a pinned buffer that gets reused.
+                self.repeat_deltas[key] = found[key].clone()
+        for key in set(keys):
+            if self.repeat_counts.get(key) == 0:
+                del self.repeat_counts[key], self.repeat_deltas[key]
+        return items, torch.stack([found[key] for key in keys])
+
+    def _save_batch(self, items: List[Tuple[int, int, Optional[torch.Tensor]]], deltas: torch.Tensor, bar: tqdm) -> None:
+        if self.has_statistics():
+            self._update_statistics(items, deltas)
+        else:
+            self.store.write([item[0] for item in items], [item[1] for item in items], deltas)
+        bar.update(n = len(items))
+        tracing.count("samples", len(items))
+        if time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            if self.has_statistics():
+                self.statistics.checkpoint()
+            else:
+                self.store.checkpoint()
+            self.last_checkpoint = time.time()
+
+    def _update_statistics(self, items: List[Tuple[int, int, torch.Tensor]], deltas: torch.Tensor) -> None:
+        # Rearrange the rows into [class, sample, layer, hidden] so each sample's classes can be differenced.
+        sample_indices = sorted({sample_index for _, sample_index, _ in items})
+        rows = {(class_index, sample_index): row for row, (class_index, sample_index, _) in enumerate(items)}
+        row_indices = torch.tensor([
+            [rows[(class_index, sample_index)] for sample_index in sample_indices]
+            for class_index in range(self.statistics.num_classes)
+        ])
+        self.statistics.update(deltas[row_indices], sample_indices)
+
+    def _create_groups(self, dataset_tokens: List[List[torch.Tensor]]) -> List[List[Tuple[int, int, torch.Tensor]]]:
+        # When sharing prefixes (or accumulating statistics), keep the matched (baseline, negative, positive, ...) tuple
+        # for each sample together.
+        if self.share_prefix or self.has_statistics():
+            num_samples = len(dataset_tokens[0])
+            if any(len(token_list) != num_samples for token_list in dataset_tokens):
+                raise ValueError("All classes must have the same number of samples to group them by sample.")
+            return [
+                [(class_index, sample_index, token_list[sample_index]) for class_index, token_list in enumerate(dataset_tokens)]
+                for sample_index in range(num_samples)
+            ]
+        return [
+            [(class_index, sample_index, tokens)]
+            for class_index, token_list in enumerate(dataset_tokens)
+            for sample_index, tokens in enumerate(token_list)
+        ]
+
+    def _create_batches(self, groups: List[List[Tuple[int, int, torch.Tensor]]]) -> List[List[List[Tuple[int, int, torch.Tensor]]]]:
+        # Sort by token length so each batch holds prompts of similar length and little compute is wasted on padding.
+        def get_length(group):
+            return max(tokens.shape[-1] for _, _, tokens in group)
+        groups = sorted(groups, key = get_length)
+
+        batches = []
+        batch = []
+        num_rows = 0
+        for group in groups:
+            # Groups are sorted, so the padded length of the batch is the length of the newest group.
+            padded_tokens = (num_rows + len(group)) * get_length(group)
+            if batch and (num_rows + len(group) > self.batch_size or (self.max_batch_tokens and padded_tokens > self.max_batch_tokens)):
+                batches.append(batch)
+                batch = []
+                num_rows = 0
+            batch.append(group)
+            num_rows += len(group)
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def _pad_left(self, token_list: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        tokenizer = self.model_handler.tokenizer
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+        # Left pad so the last token of every prompt is in the final position.
+        max_length = max(tokens.shape[-1] for tokens in token_list)
+        input_ids = torch.full((len(token_list), max_length), pad_token_id, dtype = torch.long)
+        attention_mask = torch.zeros((len(token_list), max_length), dtype = torch.long)
+        for row, tokens in enumerate(token_list):
+            length = tokens.shape[-1]
+            input_ids[row, max_length - length:] = tokens.reshape(-1)
+            attention_mask[row, max_length - length:] = 1
+
+        return input_ids, attention_mask
+
+    def _generate(self, capture: "LastTokenCapture", token_list: List[torch.Tensor], to_host: bool = True) -> torch.Tensor:
+        input_ids, attention_mask = self._pad_left(token_list)
+
+        # Position ids must skip the padding to match what an unpadded prompt would see.
+        position_ids = (attention_mask.cumsum(dim = -1) - 1).clamp(min = 0)
+
+        device = self.model_handler.model.device
+        return capture.forward(
+            input_ids = input_ids.to(device),
+            attention_mask = attention_mask.to(device),
+            position_ids = position_ids.to(device),
+            to_host = to_host
+        )
+
+    def _generate_with_shared_prefix(
+        self,
+        capture: "LastTokenCapture",
+        batch: List[List[Tuple[int, int, torch.Tensor]]],
+        to_host: bool = True
+    ) -> Tuple[List[Tuple[int, int, torch.Tensor]], torch.Tensor]:
+        prefix_lengths = [self._get_common_prefix_length([tokens for _, _, tokens in group]) for group in batch]
+
+        # Every row of the prefix pass needs at least one real token.
+        if min(prefix_lengths) == 0:
+            items = [item for group in batch for item in group]
+            return items, self._generate(capture, [tokens for _, _, tokens in items], to_host)
+
+        device = self.model_handler.model.device
+
+        # Run the shared prefix of each tuple once...
+        prefix_ids, prefix_mask = self._pad_left([group[0][2].reshape(-1)[:length] for group, length in zip(batch, prefix_lengths)])
+        prefix_position_ids = (prefix_mask.cumsum(dim = -1) - 1).clamp(min = 0)
+        with tracing.span("prefill"):
+            cache = capture.prefill(
+                input_ids = prefix_ids.to(device),
+                attention_mask = prefix_mask.to(device),
+                position_ids = prefix_position_ids.to(device)
+            )
+
+        # ... then branch the KV cache for each class-specific suffix.
+        # NOTE: The suffix padding ends up between the prefix and suffix, which the attention mask takes care of.
+        items = []
+        deltas = []
+        num_classes = len(batch[0])
+        for position in range(num_classes):
+            suffix_ids, suffix_mask = self._pad_left([group[position][2].reshape(-1)[length:] for group, length in zip(batch, prefix_lengths)])
+            attention_mask = torch.cat([prefix_mask, suffix_mask], dim = 1)
+            position_ids = torch.tensor(prefix_lengths, dtype = torch.long).unsqueeze(1) + (suffix_mask.cumsum(dim = -1) - 1).clamp(min = 0)
+            deltas.append(capture.forward(
+                input_ids = suffix_ids.to(device),
+                attention_mask = attention_mask.to(device),
+                position_ids = position_ids.to(device),
+                past_key_values = cache if position == num_classes - 1 else copy.deepcopy(cache),
+                to_host = to_host
+            ))
+            items.extend(group[position] for group in batch)
+
+        return items, torch.cat(deltas, dim = 0)
+
+    @staticmethod
+    def _get_common_prefix_length(token_list: List[torch.Tensor]) -> int:
+        sequences = [tokens.reshape(-1) for tokens in token_list]
+
+        # Leave at least one token in every suffix so its last token is still computed.
+        limit = min(len(sequence) for sequence in sequences) - 1
+        if limit <= 0:
+            return 0
+
+        matches = torch.ones(limit, dtype = torch.bool)
+        for sequence in sequences[1:]:
+            matches &= (sequence[:limit] == sequences[0][:limit])
+        mismatches = torch.nonzero(~matches)
+        return limit if mismatches.numel() == 0 else int(mismatches[0])
@@ -0,0 +1,257 @@
+import os
+import glob
+import json
+import zlib
+import hashlib
+import torch
+import tracing
+
+from typing import List, Optional, Tuple, Union
+
+class HiddenStateStatistics:
+    """
+    Streaming (float64) sufficient statistics of the differenced (ie: class - baseline) hidden state samples.
+
+    For each sampled layer this holds the mean of every differenced class and the centred co-moments
+    needed by the direction analysis: C_kk for every class and C_ab for each analysed (a, b) class pair.
+    Batches are merged using Chan et al.'s pairwise update, so the raw samples never need to be stored.
+
+    Checkpoints are written as a new "generation" of layer files (with checksums) before the metadata is
+    switched over to them, so an interrupted checkpoint always leaves the previous one intact.
+    """
+
+    METADATA_FILENAME = "metadata.json"
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        with open(os.path.join(path, self.METADATA_FILENAME), 'r') as f:
+            self.metadata = json.load(f)
+        self.num_classes = self.metadata["num_classes"]
+        self.num_layers = self.metadata["num_layers"]
+        self.layer_indices = self.metadata["layer_indices"]
+        self.hidden_size = self.metadata["hidden_size"]
+        self.class_pairs = [tuple(pair) for pair in self.metadata["class_pairs"]]
+        self.count = self.metadata["count"]
+        self.completed_samples = set(self.metadata.get("completed_samples", []))
+        self.means = {}
+        self.comoments = {}
+
+    @staticmethod
+    def exists(path: Union[str, os.PathLike]) -> bool:
+        return os.path.exists(os.path.join(path, HiddenStateStatistics.METADATA_FILENAME))
+
+    @classmethod
+    def create(
+        cls,
+        path: Union[str, os.PathLike],
+        num_classes: int,
+        num_layers: int,
+        layer_indices: List[int],
+        hidden_size: int,
+        class_pairs: List[Tuple[int, int]],
+        manifest: Optional[dict] = None
+    ) -> "HiddenStateStatistics":
+        # Every differenced class needs its own co-moment (for the variances), plus the cross co-moment of each pair.
+        all_pairs = [(i, i) for i in range(1, num_classes)]
+        all_pairs += [tuple(pair) for pair in class_pairs if pair[0] != pair[1]]
+
+        os.makedirs(path, exist_ok = True)
+        for filename in glob.glob(os.path.join(path, "layer_*.pt")):
+            os.remove(filename)
+        metadata = {
+            "num_classes": num_classes,
+            "num_layers": num_layers,
+            "layer_indices": sorted(layer_indices),
+            "hidden_size": hidden_size,
+            "class_pairs": [list(pair) for pair in all_pairs],
+            "count": 0,
+            "completed_samples": [],
+            "manifest": manifest,
+            "generation": None,
+            "checksums": {},
+            "complete": False,
+        }
+        cls._write_metadata(path, metadata)
+
+        statistics = cls(path)
+        statistics.load_checkpoint()
+        return statistics
+
+    def get_manifest(self) -> Optional[dict]:
+        return self.metadata.get("manifest")
+
+    def get_fingerprint(self) -> str:
+        """
+        Identifies the statistics held (the metadata includes the checksum of every layer's file).
+        """
+        return hashlib.sha256(json.dumps(self.metadata, sort_keys = True).encode()).hexdigest()
+
+    def load_checkpoint(self) -> None:
+        """
+        Loads every layer of the last checkpoint into memory (to continue updating), checking each file's checksum.
+        """
+        for layer_index in self.layer_indices:
+            if self.metadata.get("generation") is None:
+                self.means[layer_index] = torch.zeros((self.num_classes - 1, self.hidden_size), dtype = torch.float64)
+                self.comoments[layer_index] = {
+                    pair: torch.zeros((self.hidden_size, self.hidden_size), dtype = torch.float64) for pair in self.class_pairs
+                }
+            else:
+                filename = self._get_layer_filename(self.path, layer_index, self.metadata["generation"])
+                if self._compute_file_checksum(filename) != self.metadata["checksums"][os.path.basename(filename)]:
+                    raise ValueError(f"'{filename}' doesn't match its checksum.")
+                self.means[layer_index], self.comoments[layer_index] = self._load_layer(filename)
+
+    def is_complete(self) -> bool:
+        return self.metadata.get("complete", False)
+
+    def verify(self, full: bool = False) -> bool:
+        """
+        Checks complete statistics before reusing them: that every layer's file of the last checkpoint exists and, if
+        'full' is set, that it matches its checksum (which reads every file, so isn't done by default).
+        """
+        if self.metadata.get("generation") is None:
+            return True
+        for layer_index in self.layer_indices:
+            filename = self._get_layer_filename(self.path, layer_index, self.metadata["generation"])
+            if not os.path.exists(filename) or os.path.basename(filename) not in self.metadata["checksums"]:
+                print(f"WARNING: '{filename}' is missing.")
+                return False
+            if full and self._compute_file_checksum(filename) != self.metadata["checksums"][os.path.basename(filename)]:
+                print(f"WARNING: '{filename}' doesn't match its checksum.")
+                return False
+        return True
+
+    def reopen(self, manifest: Optional[dict] = None) -> None:
+        """
+        Reopens complete statistics so more samples can be merged in (the samples already merged are kept).
+        """
+        if manifest is not None:
+            self.metadata["manifest"] = manifest
+        self.metadata["complete"] = False
+
+    def has_layer(self, layer_index: int) -> bool:
+        return layer_index in self.layer_indices
+
+    def update(self, deltas: torch.Tensor, sample_indices: List[int]) -> None:
+        """
+        Merges a batch of complete sample tuples into the running statistics.
+
+        Parameters:
+            deltas (torch.Tensor): The deltas of shape [class, batch, len(layer_indices), hidden], where class 0 is the baseline.
+            sample_indices (List[int]): The sample index of each tuple.
+        """
+        with tracing.span("statistics_update", samples = deltas.shape[1]):
+            deltas = deltas.to(torch.float64)
+            differenced = deltas[1:] - deltas[0:1]
+            batch_count = differenced.shape[1]
+            count = self.count + batch_count
+            for position, layer_index in enumerate(self.layer_indices):
+                data = differenced[:, :, position, :]
+                batch_means = data.mean(dim = 1)
+                delta = batch_means - self.means[layer_index]
+                centred = data - batch_means.unsqueeze(1)
+                for (a, b), comoment in self.comoments[layer_index].items():
+                    comoment.addmm_(centred[a - 1].T, centred[b - 1])
+                    comoment.addr_(delta[a - 1], delta[b - 1], alpha = self.count * batch_count / count)
+                self.means[layer_index] += delta * (batch_count / count)
+            self.count = count
+            self.completed_samples.update(sample_indices)
+
+    def checkpoint(self) -> None:
+        self._save(complete = False)
+
+    def save(self) -> None:
+        self._save(complete = True)
+
+    def get_layer_moments(self, layer_index: int, class_indices: List[int]) -> Tuple[int, torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """
+        Returns the moments of a pair of differenced classes for one layer.
+
+        Returns:
+            tuple: The count, the [2, d] means and the co-moments (C_AA, C_AB, C_BB).
+        """
+        if not self.has_layer(layer_index):
+            raise IndexError(f"Layer {layer_index} is not in the statistics.")
+        a, b = class_indices[0], class_indices[1]
+        if (a, b) not in self.class_pairs and (b, a) not in self.class_pairs:
+            raise KeyError(f"No co-moment was accumulated for classes ({a}, {b}).")
+
+        if layer_index in self.means:
+            means = self.means[layer_index]
+            comoments = self.comoments[layer_index]
+        else:
+            # NOTE: Only load one layer at a time, so memory use is set by a single layer.
+            means, comoments = self._load_layer(
+                self._get_layer_filename(self.path, layer_index, self.metadata.get("generation")),
+                mmap = True
+            )
+
+        cross_comoment = comoments[(a, b)] if (a, b) in comoments else comoments[(b, a)].T
+        return (
+            self.count,
+            torch.stack([means[a - 1], means[b - 1]]),
+            (comoments[(a, a)], cross_comoment, comoments[(b, b)])
+        )
+
+    def _save(self, complete: bool) -> None:
+        with tracing.span("checkpoint"):
+            previous_generation = self.metadata.get("generation")
+            generation = 0 if previous_generation is None else previous_generation + 1
+
+            # Write the new generation in full before switching the metadata over to it...
+            checksums = {}
+            for layer_index in self.layer_indices:
+                filename = self._get_layer_filename(self.path, layer_index, generation)
+                torch.save(
+                    {
+                        "means": self.means[layer_index],
+                        "comoments": {f"{a},{b}": comoment for (a, b), comoment in self.comoments[layer_index].items()},
+                    },
+                    filename
+                )
+                with open(filename, 'rb') as f:
+                    os.fsync(f.fileno())
+                checksums[os.path.basename(filename)] = self._compute_file_checksum(filename)
+            self.metadata["count"] = self.count
+            self.metadata["completed_samples"] = sorted(self.completed_samples)
+            self.metadata["generation"] = generation
+            self.metadata["checksums"] = checksums
+            self.metadata["complete"] = complete
+            self._write_metadata(self.path, self.metadata)
+
+            # ... and only then remove the previous generation.
+            if previous_generation is not None:
+                for layer_index in self.layer_indices:
+                    filename = self._get_layer_filename(self.path, layer_index, previous_generation)
+                    if os.path.exists(filename):
+                        os.remove(filename)
+
+    @staticmethod
+    def _load_layer(filename: str, mmap: bool = False):
+        layer = torch.load(filename, mmap = mmap, weights_only = True)
+        comoments = {tuple(int(i) for i in key.split(",")): comoment for key, comoment in layer["comoments"].items()}
+        return layer["means"], comoments
+
+    @staticmethod
+    def _compute_file_checksum(filename: str, chunk_size: int = 1 << 24) -> int:
+        checksum = 0
+        with open(filename, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                checksum = zlib.crc32(chunk, checksum)
+        return checksum
+
+    @staticmethod
+    def _get_layer_filename(path: Union[str, os.PathLike], layer_index: int, generation: Optional[int] = None) -> str:
+        # NOTE: Statistics saved before checkpointing was added have no generation.
+        if generation is None:
+            return os.path.join(path, f"layer_{layer_index:03d}.pt")
+        return os.path.join(path, f"layer_{layer_index:03d}_{generation:06d}.pt")
+
+    @staticmethod
+    def _write_metadata(path: Union[str, os.PathLike], metadata: dict) -> None:
+        # Write then rename, so the metadata is never left half written.
+        filename = os.path.join(path, HiddenStateStatistics.METADATA_FILENAME)
+        with open(filename + ".tmp", 'w') as f:
+            json.dump(metadata, f, indent = 2)
+        os.replace(filename + ".tmp", filename)
@@ -0,0 +1,484 @@
+import os
+import json
+import zlib
+import hashlib
+import numpy as np
+import torch
+import tracing
+
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+# NOTE: NumPy has no bfloat16 type, so bfloat16 data is stored as int16 and viewed back as bfloat16.
+STORAGE_DTYPES = {
+    "float32": (np.float32, torch.float32),
+    "float16": (np.float16, torch.float16),
+    "bfloat16": (np.int16, torch.bfloat16),
+}
+
+# The quantized encodings store symmetric integer codes, with a float32 scale for each (class, sample) row of a layer,
+# and are decoded to float32. The int4 codes are offset by 8 and packed two to a byte.
+QUANTIZED_ENCODINGS = {
+    "int8": (np.int8, 127),
+    "int4": (np.uint8, 7),
+}
+
+STORAGE_ENCODINGS = list(STORAGE_DTYPES) + list(QUANTIZED_ENCODINGS)
+
+def encode_rows(rows: torch.Tensor, encoding: str):
+    """
+    Encodes rows of hidden states.
+
+    Parameters:
+        rows (torch.Tensor): The rows of shape [n, hidden].
+        encoding (str): One of STORAGE_ENCODINGS.
+
+    Returns:
+        tuple: The codes and the scale of each row (None unless quantized).
+    """
+    if encoding in STORAGE_DTYPES:
+        return rows.to(STORAGE_DTYPES[encoding][1]), None
+    max_code = QUANTIZED_ENCODINGS[encoding][1]
+    rows = rows.to(torch.float32)
+    scales = rows.abs().amax(dim = -1) / max_code
+    codes = torch.round(rows / scales.clamp(min = torch.finfo(torch.float32).tiny).unsqueeze(-1)).clamp(-max_code, max_code)
+    if encoding == "int8":
+        return codes.to(torch.int8), scales
+    codes = (codes + 8).to(torch.uint8)
+    if codes.shape[-1] % 2 != 0:
+        codes = torch.nn.functional.pad(codes, (0, 1), value = 8)
+    return codes[:, 0::2] | (codes[:, 1::2] << 4), scales
+
+def decode_rows(codes: torch.Tensor, scales: Optional[torch.Tensor], encoding: str, hidden_size: int) -> torch.Tensor:
+    """
+    Decodes rows encoded by encode_rows(), returning them as float32 if quantized (or else in their storage dtype).
+    """
+    if encoding in STORAGE_DTYPES:
+        return codes
+    if encoding == "int4":
+        codes = torch.stack([codes & 0x0F, codes >> 4], dim = -1).reshape(codes.shape[0], -1)[:, :hidden_size].to(torch.int8) - 8
+    return codes.to(torch.float32) * scales.unsqueeze(-1)
+
+def get_encoded_row_size(encoding: str, hidden_size: int) -> int:
+    """
+    Returns the number of bytes used to store one row (including its scale, if quantized).
+    """
+    if encoding in STORAGE_DTYPES:
+        return hidden_size * np.dtype(STORAGE_DTYPES[encoding][0]).itemsize
+    if encoding == "int4":
+        return (hidden_size + 1) // 2 + 4
+    return hidden_size + 4
+
+class HiddenStateStore:
+    """
+    A layer-major, memory-mapped store of hidden state samples.
+
+    Each sampled layer is held in its own file as a contiguous [class, sample, hidden] block,
+    so a single layer can be read (zero-copy) without touching the rest of the dataset.
+
+    Written rows only count once a checkpoint has flushed them and appended them (with a checksum of each
+    row) to an append-only journal, so an interrupted run can be resumed and corrupt rows are resampled.
+
+    The layers can also be stored quantized (see QUANTIZED_ENCODINGS), with the codes and the per-row scales held
+    in separate files, in which case a layer is decoded (in chunks) when read rather than memory-mapped as is.
+    """
+
+    METADATA_FILENAME = "metadata.json"
+    JOURNAL_FILENAME = "journal.jsonl"
+
+    def __init__(self, path: Union[str, os.PathLike]):
+        self.path = path
+        with open(os.path.join(path, self.METADATA_FILENAME), 'r') as f:
+            self.metadata = json.load(f)
+        # NOTE: Stores written before the encodings were added just hold their dtype.
+        self.encoding = self.metadata.get("encoding", self.metadata["dtype"])
+        if self.encoding not in STORAGE_ENCODINGS:
+            raise ValueError(f"Unsupported storage encoding '{self.encoding}' in '{path}'.")
+        self.num_classes = self.metadata["num_classes"]
+        self.num_samples = self.metadata["num_samples"]
+        self.num_layers = self.metadata["num_layers"]
+        self.layer_indices = self.metadata["layer_indices"]
+        self.hidden_size = self.metadata["hidden_size"]
+        self.numpy_dtype, self.torch_dtype, self.row_width = self._get_layout(self.encoding, self.hidden_size)
+        self.memmaps = {}
+        self.scale_memmaps = {}
+        self.completed = set()
+        self.pending = []
+        self._recover_growth()
+
+    @staticmethod
+    def exists(path: Union[str, os.PathLike]) -> bool:
+        return os.path.exists(os.path.join(path, HiddenStateStore.METADATA_FILENAME))
+
+    @classmethod
+    def create(
+        cls,
+        path: Union[str, os.PathLike],
+        num_classes: int,
+        num_samples: int,
+        num_layers: int,
+        layer_indices: List[int],
+        hidden_size: int,
+        dtype: torch.dtype,
+        manifest: Optional[dict] = None,
+        encoding: Optional[str] = None
+    ) -> "HiddenStateStore":
+        """
+        Creates an empty store, with the samples held in 'dtype' or else in the given encoding (see STORAGE_ENCODINGS).
+        """
+        dtype_name = str(dtype).replace("torch.", "")
+        if dtype_name not in STORAGE_DTYPES:
+            raise ValueError(f"Unsupported storage dtype: {dtype}")
+        encoding = encoding or dtype_name
+        if encoding not in STORAGE_ENCODINGS:
+            raise ValueError(f"The storage encoding must be one of {STORAGE_ENCODINGS}: {encoding}")
+        os.makedirs(path, exist_ok = True)
+        if os.path.exists(os.path.join(path, cls.JOURNAL_FILENAME)):
+            os.remove(os.path.join(path, cls.JOURNAL_FILENAME))
+
+        # Preallocate each layer's block (and scales) so batches can be written into place as they are sampled.
+        numpy_dtype, _, row_width = cls._get_layout(encoding, hidden_size)
+        for layer_index in layer_indices:
+            cls._allocate_file(cls._get_layer_filename(path, layer_index), num_classes * num_samples * row_width * np.dtype(numpy_dtype).itemsize)
+            if encoding in QUANTIZED_ENCODINGS:
+                cls._allocate_file(cls._get_scales_filename(path, layer_index), num_classes * num_samples * np.dtype(np.float32).itemsize)
+
+        metadata = {
+            "num_classes": num_classes,
+            "num_samples": num_samples,
+            "num_layers": num_layers,
+            "layer_indices": sorted(layer_indices),
+            "hidden_size": hidden_size,
+            "dtype": dtype_name,
+            "encoding": encoding,
+            "manifest": manifest,
+            "complete": False,
+        }
+        cls._write_metadata(path, metadata)
+        return cls(path)
+
+    def is_complete(self) -> bool:
+        return self.metadata.get("complete", False)
+
+    def get_manifest(self) -> Optional[dict]:
+        return self.metadata.get("manifest")
+
+    def get_fingerprint(self) -> str:
+        """
+        Identifies the samples held, from the metadata and the size and modification time of each layer's files.
+        """
+        fingerprint = hashlib.sha256(json.dumps(self.metadata, sort_keys = True).encode())
+        for filename, _, _ in self._get_files():
+            stat = os.stat(filename)
+            fingerprint.update(f"{os.path.basename(filename)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return fingerprint.hexdigest()
+
+    def mark_complete(self) -> None:
+        self.checkpoint()
+        num_rows = self.num_classes * self.num_samples
+        if len(self.completed) != num_rows:
+            raise ValueError(f"Only {len(self.completed)} of {num_rows} samples were written to '{self.path}'.")
+        self.metadata["complete"] = True
+        self._write_metadata(self.path, self.metadata)
+
+    def is_written(self, class_index: int, sample_index: int) -> bool:
+        return (class_index, sample_index) in self.completed
+
+    def checkpoint(self) -> None:
+        """
+        Makes the rows written since the last checkpoint durable, by flushing them and then journaling them.
+        """
+        if not self.pending:
+            return
+        with tracing.span("checkpoint", rows = len(self.pending)):
+            self.flush()
+            rows = sorted(set(self.pending))
+            record = {"rows": [list(row) for row in rows], "checksums": [self._compute_row_checksum(*row) for row in rows]}
+            line = json.dumps({"record": record, "crc": zlib.crc32(json.dumps(record).encode())})
+            with open(os.path.join(self.path, self.JOURNAL_FILENAME), 'a') as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.completed.update(rows)
+            self.pending = []
+
+    def load_journal(self) -> int:
+        """
+        Reads the journal of a partially written store, checking every journaled row against its checksum.
+
+        A torn or corrupt journal entry (and everything after it) is truncated, and rows whose data
+        doesn't match their checksum are dropped, so both get sampled again.
+
+        Returns:
+            int: The number of rows that can be kept.
+        """
+        checksums = self._read_journal()
+        self.completed = self._check_rows(checksums)
+        if len(self.completed) != len(checksums):
+            print(f"WARNING: {len(checksums) - len(self.completed)} rows of '{self.path}' don't match their checksums.")
+        self.pending = []
+        return len(self.completed)
+
+    def verify(self, full: bool = False) -> bool:
+        """
+        Checks a complete store before reusing it.
+
+        By default only the metadata, the journal and the size of each file are checked (which is cheap), as
+        reading every row back would cost a full pass over the store on every rerun.
+
+        NOTE: Stores written before the journal was added have no journal or checksums, so only their file sizes are checked.
+
+        Parameters:
+            full (bool): Also check every row against its journaled checksum (ie: read the whole store).
+
+        Returns:
+            bool: True if the store looks intact.
+        """
+        for filename, dtype, row_shape in self._get_files():
+            expected_size = self._get_file_size(dtype, row_shape)
+            if not os.path.exists(filename) or os.path.getsize(filename) != expected_size:
+                print(f"WARNING: '{filename}' is missing or isn't {expected_size} bytes.")
+                return False
+        if not os.path.exists(os.path.join(self.path, self.JOURNAL_FILENAME)):
+            return True
+
+        checksums = self._read_journal()
+        num_rows = self.num_classes * self.num_samples
+        if len(checksums) != num_rows:
+            print(f"WARNING: Only {len(checksums)} of {num_rows} rows of '{self.path}' are journaled.")
+            return False
+        if full:
+            with tracing.span("verify_store"):
+                num_valid = len(self._check_rows(checksums))
+            if num_valid != num_rows:
+                print(f"WARNING: Only {num_valid} of {num_rows} rows of '{self.path}' match their checksums.")
+                return False
+        return True
+
+    def grow(self, num_samples: int, manifest: Optional[dict] = None) -> None:
+        """
+        Grows the store in place to hold more samples per class, keeping every row already written (and journaled).
+
+        Each layer's [class, sample, hidden] block has to be copied into a larger file, but no row is resampled.
+        The grown files are written in full before the metadata is switched over to them, so an interrupted
+        grow either leaves the store as it was or is finished off when the store is next opened.
+        """
+        if num_samples < self.num_samples:
+            raise ValueError(f"Can't shrink '{self.path}' from {self.num_samples} to {num_samples} samples.")
+        self.checkpoint()
+        self.close()
+        with tracing.span("grow_store", num_samples = num_samples):
+            for filename, dtype, row_shape in self._get_files():
+                old = np.memmap(filename, dtype = dtype, mode = 'r', shape = (self.num_classes, self.num_samples, *row_shape))
+                new = np.memmap(filename + ".grow", dtype = dtype, mode = 'w+', shape = (self.num_classes, num_samples, *row_shape))
+                for class_index in range(self.num_classes):
+                    new[class_index, :self.num_samples] = old[class_index]
+                new.flush()
+                del old, new
+                with open(filename + ".grow", 'rb') as f:
+                    os.fsync(f.fileno())
+            self.metadata["num_samples"] = num_samples
+            if manifest is not None:
+                self.metadata["manifest"] = manifest
+            self.metadata["complete"] = False
+            self._write_metadata(self.path, self.metadata)
+            self.num_samples = num_samples
+            self._recover_growth()
+
+    def has_layer(self, layer_index: int) -> bool:
+        return layer_index in self.layer_indices
+
+    def get_layer(self, layer_index: int, chunk_size: int = 4096) -> torch.Tensor:
+        """
+        Returns the [class, sample, hidden] block for a layer as a (zero-copy) memory-mapped tensor,
+        or decoded to float32 (a chunk of rows at a time) if quantized.
+        """
+        if self.encoding not in QUANTIZED_ENCODINGS:
+            return self._to_torch(self._get_memmap(layer_index))
+        return self._decode_layer_rows(layer_index, 0, self.num_classes * self.num_samples, chunk_size).view(
+            self.num_classes, self.num_samples, self.hidden_size
+        )
+
+    def get_class(self, layer_index: int, class_index: int, chunk_size: int = 4096) -> torch.Tensor:
+        """
+        Returns the [sample, hidden] block of one class for a layer, as for get_layer() but only decoding
+        that class's rows if quantized.
+        """
+        if self.encoding not in QUANTIZED_ENCODINGS:
+            return self.get_layer(layer_index)[class_index]
+        start = class_index * self.num_samples
+        return self._decode_layer_rows(layer_index, start, start + self.num_samples, chunk_size)
+
+    def _decode_layer_rows(self, layer_index: int, start: int, stop: int, chunk_size: int) -> torch.Tensor:
+        codes = self._get_memmap(layer_index).reshape(-1, self.row_width)
+        scales = self._get_scales_memmap(layer_index).reshape(-1)
+        rows = torch.empty((stop - start, self.hidden_size), dtype = torch.float32)
+        for offset in range(0, stop - start, chunk_size):
+            end = min(start + offset + chunk_size, stop)
+            rows[offset:offset + chunk_size] = decode_rows(
+                torch.from_numpy(codes[start + offset:end]),
+                torch.from_numpy(scales[start + offset:end]),
+                self.encoding,
+                self.hidden_size
+            )
+        return rows
+
+    def write(self, class_indices: List[int], sample_indices: List[int], deltas: torch.Tensor) -> None:
+        """
+        Writes a batch of samples for every stored layer.
+
+        Parameters:
+            class_indices (List[int]): The class index of each row.
+            sample_indices (List[int]): The sample index of each row.
+            deltas (torch.Tensor): The deltas of shape [batch, len(layer_indices), hidden].
+        """
+        with tracing.span("store_write"):
+            for position, layer_index in enumerate(self.layer_indices):
+                codes, scales = encode_rows(deltas[:, position, :], self.encoding)
+                self._get_memmap(layer_index, writable = True)[class_indices, sample_indices] = self._to_numpy(codes)
+                if scales is not None:
+                    self._get_scales_memmap(layer_index, writable = True)[class_indices, sample_indices] = scales.numpy()
+            self.pending.extend(zip(class_indices, sample_indices))
+        tracing.count("bytes_written", len(class_indices) * len(self.layer_indices) * get_encoded_row_size(self.encoding, self.hidden_size))
+
+    def flush(self) -> None:
+        for memmap in list(self.memmaps.values()) + list(self.scale_memmaps.values()):
+            if memmap.mode == 'r+':
+                memmap.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.memmaps = {}
+        self.scale_memmaps = {}
+
+    def _get_memmap(self, layer_index: int, writable: bool = False) -> np.memmap:
+        if not self.has_layer(layer_index):
+            raise IndexError(f"Layer {layer_index} is not in the store.")
+        memmap = self.memmaps.get(layer_index)
+        if memmap is None or (writable and memmap.mode != 'r+'):
+            # NOTE: Copy-on-write mode avoids PyTorch warning about read-only arrays, but never touches the file.
+            memmap = np.memmap(
+                self._get_layer_filename(self.path, layer_index),
+                dtype = self.numpy_dtype,
+                mode = 'r+' if writable else 'c',
+                shape = (self.num_classes, self.num_samples, self.row_width)
+            )
+            self.memmaps[layer_index] = memmap
+        return memmap
+
+    def _get_scales_memmap(self, layer_index: int, writable: bool = False) -> np.memmap:
+        memmap = self.scale_memmaps.get(layer_index)
+        if memmap is None or (writable and memmap.mode != 'r+'):
+            memmap = np.memmap(
+                self._get_scales_filename(self.path, layer_index),
+                dtype = np.float32,
+                mode = 'r+' if writable else 'c',
+                shape = (self.num_classes, self.num_samples)
+            )
+            self.scale_memmaps[layer_index] = memmap
+        return memmap
+
+    def _get_files(self):
+        # The filename, numpy dtype and row shape of every file holding a [class, sample, ...] block.
+        files = []
+        for layer_index in self.layer_indices:
+            files.append((self._get_layer_filename(self.path, layer_index), self.numpy_dtype, (self.row_width,)))
+            if self.encoding in QUANTIZED_ENCODINGS:
+                files.append((self._get_scales_filename(self.path, layer_index), np.float32, ()))
+        return files
+
+    def _get_file_size(self, dtype, row_shape) -> int:
+        return self.num_classes * self.num_samples * int(np.prod(row_shape, dtype = np.int64)) * np.dtype(dtype).itemsize
+
+    def _recover_growth(self) -> None:
+        # Grown files that match the metadata were written in full before it was switched over, so finish moving
+        # them into place. Any others are from a grow that was interrupted before the switch, so discard them.
+        for filename, dtype, row_shape in self._get_files():
+            if not os.path.exists(filename + ".grow"):
+                continue
+            if os.path.getsize(filename + ".grow") == self._get_file_size(dtype, row_shape):
+                os.replace(filename + ".grow", filename)
+            else:
+                os.remove(filename + ".grow")
+
+    def _read_journal(self) -> Dict[Tuple[int, int], int]:
+        # The checksum of every journaled row, truncating the journal at the first torn or corrupt entry.
+        checksums = {}
+        filename = os.path.join(self.path, self.JOURNAL_FILENAME)
+        if not os.path.exists(filename):
+            return checksums
+        valid_length = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    record = entry["record"]
+                    if not line.endswith(b"\n") or zlib.crc32(json.dumps(record).encode()) != entry["crc"]:
+                        raise ValueError("checksum mismatch")
+                except (ValueError, KeyError, TypeError):
+                    print(f"WARNING: Truncating the corrupt or partial journal entry at byte {valid_length} of '{filename}'.")
+                    break
+                checksums.update((tuple(row), checksum) for row, checksum in zip(record["rows"], record["checksums"]))
+                valid_length += len(line)
+        with open(filename, 'r+b') as f:
+            f.truncate(valid_length)
+        return checksums
+
+    def _check_rows(self, checksums: Dict[Tuple[int, int], int]) -> Set[Tuple[int, int]]:
+        # Returns the rows that match their checksums, reading a layer at a time rather than a row at a time (as
+        # _compute_row_checksum() does), so each file is read in order.
+        rows = sorted(checksums)
+        computed = [0] * len(rows)
+        for layer_index in self.layer_indices:
+            blocks = [self._get_memmap(layer_index)]
+            if self.encoding in QUANTIZED_ENCODINGS:
+                blocks.append(self._get_scales_memmap(layer_index))
+            for block in blocks:
+                for i, (class_index, sample_index) in enumerate(rows):
+                    computed[i] = zlib.crc32(block[class_index, sample_index].tobytes(), computed[i])
+        return {row for row, checksum in zip(rows, computed) if checksum == checksums[row]}
+
+    def _compute_row_checksum(self, class_index: int, sample_index: int) -> int:
+        checksum = 0
+        for layer_index in self.layer_indices:
+            checksum = zlib.crc32(self._get_memmap(layer_index)[class_index, sample_index].tobytes(), checksum)
+            if self.encoding in QUANTIZED_ENCODINGS:
+                checksum = zlib.crc32(self._get_scales_memmap(layer_index)[class_index, sample_index].tobytes(), checksum)
+        return checksum
+
+    def _to_torch(self, array: np.ndarray) -> torch.Tensor:
+        return torch.from_numpy(array).view(self.torch_dtype)
+
+    def _to_numpy(self, tensor: torch.Tensor) -> np.ndarray:
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.view(torch.int16)
+        return tensor.contiguous().numpy()
+
+    @staticmethod
+    def _get_layout(encoding: str, hidden_size: int):
+        # The numpy dtype of the stored codes, the torch dtype the layers are read as, and the number of codes per row.
+        if encoding in STORAGE_DTYPES:
+            return (*STORAGE_DTYPES[encoding], hidden_size)
+        numpy_dtype = QUANTIZED_ENCODINGS[encoding][0]
+        return numpy_dtype, torch.float32, (hidden_size + 1) // 2 if encoding == "int4" else hidden_size
+
+    @staticmethod
+    def _allocate_file(filename: str, num_bytes: int) -> None:
+        # A (sparse) zero-filled file of the given size, as np.memmap(mode = 'w+') would create.
+        with open(filename, 'wb') as f:
+            f.truncate(num_bytes)
+
+    @staticmethod
+    def _get_layer_filename(path: Union[str, os.PathLike], layer_index: int) -> str:
+        return os.path.join(path, f"layer_{layer_index:03d}.bin")
+
+    @staticmethod
+    def _get_scales_filename(path: Union[str, os.PathLike], layer_index: int) -> str:
+        return os.path.join(path, f"layer_{layer_index:03d}_scales.bin")
+
+    @staticmethod
+    def _write_metadata(path: Union[str, os.PathLike], metadata: dict) -> None:
+        # Write then rename, so the metadata is never left half written.
+        filename = os.path.join(path, HiddenStateStore.METADATA_FILENAME)
+        with open(filename + ".tmp", 'w') as f:
+            json.dump(metadata, f, indent = 2)
+        os.replace(filename + ".tmp", filename)
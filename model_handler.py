@@ -2,14 +2,28 @@ import os
 import sys
 import json
 import torch
+import tracing
 
-from typing import Union
+from typing import Optional, Union
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 
+from gguf_exporter import ModelMetadata, export_gguf
+from weight_orthogonalizer import orthogonalize_weight
+
 class ModelHandler:
 
-    def __init__(self, pretrained_model_name_or_path: Union[str, os.PathLike], device = "cpu"):
+    def __init__(
+        self,
+        pretrained_model_name_or_path: Union[str, os.PathLike],
+        device = "cpu",
+        torch_dtype: Optional[str] = None,
+        quantize_int8: bool = False,
+        load_model: bool = True
+    ):
+        self.pretrained_model_name_or_path = pretrained_model_name_or_path
         self.device = device
+        self.quantize_int8 = quantize_int8
+        self.metadata = ModelMetadata(pretrained_model_name_or_path)
 
         # Load the config file.
         config_path = os.path.join(pretrained_model_name_or_path, 'config.json')
@@ -22,45 +36,80 @@ class ModelHandler:
         # NOTE: The Gemma2 models need attn_implementation="eager" and doesn't like float16 due to the +/- 2^16 range.
         #       https://old.reddit.com/r/LocalLLaMA/comments/1dsvpp2/thread_on_running_gemma_2_correctly_with_hf/
         isGemma2 = (config.get("architectures", [])[0] == "Gemma2ForCausalLM")
+        self.isGemma2 = isGemma2
         if isGemma2:
             print("*** Gemma2ForCausalLM: Using torch_dtype = bfloat16 and attn_implementation = 'eager' ***")
                 
         # Use float16 and 4-bit for 'cuda'.
         if device == "cuda":
+            if torch_dtype is not None:
+                print(f"WARNING: The dtype '{torch_dtype}' only applies to the 'cpu' device, so it is ignored for 'cuda'.")
             # Adjust dtype for Gemma2.
             self.torch_dtype = torch.bfloat16 if isGemma2 else torch.float16
             self.quantization_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=self.torch_dtype)
 
-        # Use the model's actual float type for 'cpu'.
+        # Use the model's actual float type for 'cpu' (unless overridden).
         elif device == "cpu":
-            if "torch_dtype" not in config:
+            if torch_dtype is None and "torch_dtype" not in config:
                 raise KeyError("The 'torch_dtype' key is missing in the configuration file")
-            self.torch_dtype = getattr(torch, config["torch_dtype"])
+            self.torch_dtype = getattr(torch, torch_dtype or config["torch_dtype"])
+            # NOTE: PyTorch's dynamic int8 quantization only supports float32 activations.
+            if quantize_int8 and self.torch_dtype != torch.float32:
+                print(f"*** Dynamic int8 quantization: Using torch_dtype = float32 instead of {str(self.torch_dtype).replace('torch.', '')} ***")
+                self.torch_dtype = torch.float32
             self.quantization_config = None
         else:
             raise RuntimeError(f"The device must be 'cpu' or 'cuda': {device}")
 
-        print(f"Loading '{pretrained_model_name_or_path}' model and tokenizer...")
+        self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path, trust_remote_code=True)
+
+        # NOTE: The tokenizer and config are all that's needed to coordinate sampling workers (which load their own models),
+        #       or to start tokenizing while the model loads.
+        self.model = None
+        if load_model:
+            self.load_model()
+
+    def load_model(self) -> None:
+        print(f"Loading '{self.pretrained_model_name_or_path}' model...")
         self.model = AutoModelForCausalLM.from_pretrained(
-            pretrained_model_name_or_path,
+            self.pretrained_model_name_or_path,
             torch_dtype = self.torch_dtype,
             quantization_config = self.quantization_config,
-            device_map = 'auto' if device == "cuda" else 'cpu',
+            device_map = 'auto' if self.device == "cuda" else 'cpu',
             # Adjust attn_implementation for Gemma2.
-            attn_implementation=None if device != "cuda" else ("eager" if isGemma2 else "flash_attention_2"),
+            attn_implementation="eager" if self.isGemma2 else ("flash_attention_2" if self.device == "cuda" else "sdpa"),
             trust_remote_code=True,
             low_cpu_mem_usage = True,
         )
         self.model.requires_grad_(False)
 
-        self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path, trust_remote_code=True)
+        # Quantize the weights of every linear layer to int8 (the activations are quantized on the fly).
+        # NOTE: Only for sampling, as the modified weights can't be saved from the quantized model.
+        if self.quantize_int8:
+            if self.device != "cpu":
+                raise RuntimeError("Dynamic int8 quantization is only supported on the 'cpu' device")
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype = torch.qint8)
 
     def get_num_layers(self):
+        if self.model is None:
+            return self.metadata.get_num_layers()
         return len(self.model.model.layers)
 
+    def get_hidden_size(self):
+        if self.model is None:
+            return self.metadata.get_hidden_size()
+        return self.model.config.hidden_size
+
     def get_model_type(self):
+        if self.model is None:
+            return self.metadata.get_model_type()
         return self.model.config.model_type
 
+    def get_backend(self) -> dict:
+        # Describes everything (besides the model itself) that changes the hidden states.
+        quantization = "int8" if self.quantize_int8 else ("4bit" if self.quantization_config is not None else None)
+        return {"device": self.device, "dtype": str(self.torch_dtype).replace("torch.", ""), "quantization": quantization}
+
     def modify_tensor(self, layer_index, direction_matrix):
         assert hasattr(self.model.model, 'layers'), "The model does not have the expected structure."
         direction_matrix = direction_matrix.to(torch.float32)
@@ -71,16 +120,16 @@ class ModelHandler:
         # NOTE: The projection matrix calculation is invariant to the signs of the vectors though...
         direction_matrix = torch.nn.functional.normalize(direction_matrix, p = 2, dim = 1)
 
-        identity_matrix = torch.eye(direction_matrix.size(1), dtype = torch.float32, device = self.model.device)
-        projection_matrix = identity_matrix - torch.mm(direction_matrix.t(), direction_matrix)
-        weight_matrix = self.model.model.layers[layer_index].mlp.down_proj.weight.data.to(torch.float32)
-        weight_matrix = torch.mm(projection_matrix, weight_matrix)
+        # NOTE: See weight_orthogonalizer.py to modify a checkpoint without loading the model.
+        weight_matrix = self.model.model.layers[layer_index].mlp.down_proj.weight.data
+        weight_matrix = orthogonalize_weight(weight_matrix, direction_matrix)
         self.model.model.layers[layer_index].mlp.down_proj.weight = torch.nn.Parameter(weight_matrix.to(self.torch_dtype))
 
     def modify_tensors(self, direction_matrix, skip_begin_layers, skip_end_layers):
         assert hasattr(self.model.model, 'layers'), "The model does not have the expected structure."
         for layer_index in range(skip_begin_layers, self.get_num_layers() - skip_end_layers):
-            self.modify_tensor(layer_index, direction_matrix)
+            with tracing.span("modify_tensor", layer = layer_index):
+                self.modify_tensor(layer_index, direction_matrix)
 
     def save_model_and_tokenizer(self, output_path):
         print(f"Saving modified model + original tokenizer to '{output_path}'... ", end = "")
@@ -89,62 +138,9 @@ class ModelHandler:
         self.tokenizer.save_pretrained(output_path)
         print("Done.")
 
-    # See: https://github.com/vgel/repeng/blob/main/repeng/extract.py
     def export_gguf(self, directions: list[torch.Tensor | None], path: os.PathLike[str] | str):
-        import gguf
-        ARCHITECTURE = "controlvector"
-
-        print(f"Initializing GGUFWriter with path: '{path}' and architecture: '{ARCHITECTURE}'")
-        writer = gguf.GGUFWriter(path, ARCHITECTURE)
-
-        print(f"- Adding model hint: '{self.get_model_type()}'")
-        writer.add_string(f"{ARCHITECTURE}.model_hint", self.get_model_type())
-
-        # Count non-None tensors to determine the layer count
-        #non_none_tensors = [tensor for tensor in directions if tensor is not None]
-        print(f"- Adding layer count: '{self.get_num_layers()}'")
-        writer.add_uint32(f"{ARCHITECTURE}.layer_count", self.get_num_layers())
-
-        # Find the hidden dimension size from the first non-None tensor
-        hidden_dimension = next((tensor.shape[1] for tensor in directions if tensor is not None), None)
-        if hidden_dimension is None:
-            raise ValueError("All tensors are None or no tensor has a second dimension.")
-        
-        print(f"Hidden dimension size across tensors: {hidden_dimension}")
-        
-        ### @@@ NOTE: Padded with zero tensors to work around llama.cpp code @@@ ###
-        for layer, tensor in enumerate(directions):
-            """
-            if tensor is None:
-                # Create a zero tensor with the shape (1, hidden_dimension)
-                combined_tensor = torch.zeros((1, hidden_dimension))
-                print(f"-- Layer: {layer + 1} is None, using zero tensor of shape: {combined_tensor.shape}")
-            else:
-                print(f"-- Processing layer: {layer + 1} with tensor of shape: {tensor.shape}")
-                if tensor.shape[0] > 1:
-                    combined_tensor = torch.sum(tensor, dim=0)
-                    print(f"--- Combined vectors for layer {layer + 1} into shape: {combined_tensor.shape}")
-                else:
-                    combined_tensor = tensor[0]
-        
-            writer.add_tensor(f"direction.{layer + 1}", combined_tensor.flatten().numpy())
-            """
-            if tensor is not None:
-                print(f"-- Processing layer: {layer + 1} with tensor of shape: {tensor.shape}")
-                if tensor.shape[0] > 1:
-                    combined_tensor = torch.sum(tensor, dim=0)
-                    print(f"--- Combined vectors for layer {layer + 1} into shape: {combined_tensor.shape}")
-                else:
-                    combined_tensor = tensor[0]
-                writer.add_tensor(f"direction.{layer + 1}", combined_tensor.flatten().numpy())            
-                
-        writer.write_header_to_file()
-        writer.write_kv_data_to_file()
-        writer.write_tensors_to_file()
-
-        writer.close()
-
-        print("Export completed")
+        # NOTE: See gguf_exporter.py to export without loading the model.
+        export_gguf(directions, path, self.get_model_type(), self.get_num_layers())
 
     def delete(self):
         del self.model
@@ -0,0 +1,164 @@
+import queue
+import torch
+import threading
+import tracing
+
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+# Marks the end of the items passed between the stages.
+_DONE = object()
+
+class PinnedBufferPool:
+    """
+    A small pool of page-locked host buffers, so device-to-host copies can run asynchronously.
+
+    NOTE: The bounded queues limit how many copies are in flight, so the pool never holds more than a few buffers.
+    """
+
+    def __init__(self, max_buffers: int = 4):
+        self.max_buffers = max_buffers
+        self.lock = threading.Lock()
+        self.buffers = []
+
+    def acquire(self, numel: int, dtype: torch.dtype) -> torch.Tensor:
+        with self.lock:
+            for i, buffer in enumerate(self.buffers):
+                if buffer.dtype == dtype and buffer.numel() >= numel:
+                    return self.buffers.pop(i)
+        return torch.empty(numel, dtype = dtype, pin_memory = True)
+
+    def release(self, buffer: torch.Tensor) -> None:
+        with self.lock:
+            self.buffers.append(buffer)
+            if len(self.buffers) > self.max_buffers:
+                # Keep the largest buffers, as these can hold any batch.
+                self.buffers.sort(key = lambda buffer: buffer.numel(), reverse = True)
+                self.buffers.pop()
+
+    def copy_to_host(self, tensor: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional["torch.cuda.Event"]]:
+        """
+        Starts copying a tensor to the host.
+
+        Returns:
+            tuple: The host tensor, the pinned buffer it lives in (or None) and an event to wait on before reading it (or None).
+        """
+        if tensor.device.type != "cuda":
+            return tensor.to('cpu'), None, None
+        buffer = self.acquire(tensor.numel(), tensor.dtype)
+        host_tensor = buffer[:tensor.numel()].view(tensor.shape)
+        # NOTE: The copy is queued on the current stream, so the device memory can't be reused before it's done.
+        host_tensor.copy_(tensor, non_blocking = True)
+        event = torch.cuda.Event()
+        event.record()
+        return host_tensor, buffer, event
+
+class SamplingPipeline:
+    """
+    Overlaps the host work of sampling with the forward passes, with bounded queues between the stages:
+
+        prepare (producer thread) -> compute + async device-to-host copy (calling thread) -> finish (writer thread)
+
+    'compute' returns a payload and a (device) tensor, and 'finish' is called with the payload and the tensor copied
+    to the host. Each stage runs in order, so 'finish' sees the batches in the order they were given.
+    """
+
+    def __init__(
+        self,
+        prepare: Callable[[Any], Any],
+        compute: Callable[[Any], Tuple[Any, Optional[torch.Tensor]]],
+        finish: Callable[[Any, Optional[torch.Tensor]], None],
+        queue_size: int = 2
+    ):
+        self.prepare = prepare
+        self.compute = compute
+        self.finish = finish
+        self.prepared_queue = queue.Queue(maxsize = queue_size)
+        self.computed_queue = queue.Queue(maxsize = queue_size)
+        self.buffer_pool = PinnedBufferPool(max_buffers = queue_size + 2)
+        self.stop = threading.Event()
+        self.errors = {}
+
+    def run(self, inputs: Iterable[Any]) -> None:
+        """
+        Runs every input through the stages, waiting for the last to be finished (or the first error).
+
+        NOTE: On an error (or interrupt), everything already computed is still finished before returning.
+        """
+        producer = threading.Thread(target = self._produce, args = (inputs,), daemon = True)
+        writer = threading.Thread(target = self._write, daemon = True)
+        producer.start()
+        writer.start()
+        try:
+            while True:
+                prepared = self._get(self.prepared_queue, "prepare")
+                if prepared is _DONE:
+                    break
+                payload, computed = self.compute(prepared)
+                if computed is not None:
+                    with tracing.span("device_to_host"):
+                        computed = self.buffer_pool.copy_to_host(computed)
+                if not self._put(self.computed_queue, (payload, computed), "finish"):
+                    break
+        finally:
+            self.stop.set()
+            # The writer only stops early on an error, so otherwise there is always room for the sentinel eventually.
+            while writer.is_alive() and "finish" not in self.errors:
+                try:
+                    self.computed_queue.put(_DONE, timeout = 0.1)
+                    break
+                except queue.Full:
+                    pass
+            writer.join()
+            producer.join()
+        for stage in ("prepare", "finish"):
+            if stage in self.errors:
+                raise self.errors[stage]
+
+    def _produce(self, inputs: Iterable[Any]) -> None:
+        try:
+            for item in inputs:
+                if self.stop.is_set():
+                    return
+                with tracing.span("prepare"):
+                    prepared = self.prepare(item)
+                if not self._put(self.prepared_queue, prepared, "compute"):
+                    return
+        except BaseException as e:
+            self.errors["prepare"] = e
+        finally:
+            self._put(self.prepared_queue, _DONE, "compute")
+
+    def _write(self) -> None:
+        try:
+            while (item := self.computed_queue.get()) is not _DONE:
+                payload, computed = item
+                buffer = None
+                if computed is not None:
+                    computed, buffer, event = computed
+                    if event is not None:
+                        with tracing.span("wait_for_device_to_host"):
+                            event.synchronize()
+                with tracing.span("finish"):
+                    self.finish(payload, computed)
+                if buffer is not None:
+                    self.buffer_pool.release(buffer)
+        except BaseException as e:
+            self.errors["finish"] = e
+
+    def _get(self, items: queue.Queue, stage: str) -> Any:
+        while True:
+            try:
+                return items.get(timeout = 0.1)
+            except queue.Empty:
+                if stage in self.errors:
+                    return _DONE
+
+    def _put(self, items: queue.Queue, item: Any, consumer: str) -> bool:
+        # Blocks while the queue is full, unless the consuming stage has failed (or stopped, for the calling thread).
+        while True:
+            try:
+                items.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                if consumer in self.errors or (consumer == "compute" and self.stop.is_set()):
+                    return False
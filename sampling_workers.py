@@ -0,0 +1,129 @@
+import os
+import queue
+import torch
+import traceback
+import multiprocessing
+
+from typing import List, Optional, Tuple, Union
+
+def _sample_in_worker(
+    worker_index: int,
+    num_workers: int,
+    pretrained_model_name_or_path: Union[str, os.PathLike],
+    device: str,
+    torch_dtype: Optional[str],
+    quantize_int8: bool,
+    num_threads: Optional[int],
+    layer_indices: List[int],
+    task_queue,
+    result_queue
+) -> None:
+    try:
+        # Give each worker its own GPU, or its own slice of the CPU cores.
+        # NOTE: CUDA isn't initialised until first used, so it's not too late to restrict the visible devices.
+        if device == "cuda":
+            visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+            visible_devices = visible_devices.split(",") if visible_devices else [str(i) for i in range(num_workers)]
+            os.environ["CUDA_VISIBLE_DEVICES"] = visible_devices[worker_index % len(visible_devices)]
+        else:
+            cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+            cores = cores[worker_index::num_workers] or cores
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cores)
+            torch.set_num_threads(num_threads or len(cores))
+        torch.set_grad_enabled(False)
+
+        from model_handler import ModelHandler
+        from hidden_state_capture import LastTokenCapture
+        from hidden_state_data_manager import HiddenStateDataManager
+        model_handler = ModelHandler(pretrained_model_name_or_path, device = device, torch_dtype = torch_dtype, quantize_int8 = quantize_int8)
+        hidden_state_data_manager = HiddenStateDataManager.open_for_sampling(model_handler)
+
+        with LastTokenCapture(model_handler.model, layer_indices) as capture:
+            while (task := task_queue.get()) is not None:
+                task_id, groups, share_prefix = task
+                items, deltas = hidden_state_data_manager.run_groups(capture, groups, share_prefix)
+                result_queue.put((task_id, [(class_index, sample_index, None) for class_index, sample_index, _ in items], deltas))
+    except BaseException:
+        result_queue.put((None, traceback.format_exc(), None))
+
+class SamplingWorkerPool:
+    """
+    A pool of sampling processes, each with its own model replica, pulling batches from a shared queue.
+
+    Results come back tagged with their (class, sample) indices, so they can be assembled in any order.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        pretrained_model_name_or_path: Union[str, os.PathLike],
+        device: str,
+        torch_dtype: Optional[str],
+        quantize_int8: bool,
+        layer_indices: List[int],
+        num_threads: Optional[int] = None
+    ):
+        # NOTE: Use 'spawn' so CUDA (and the OpenMP thread pool) is initialised afresh in each worker.
+        context = multiprocessing.get_context("spawn")
+        self.task_queue = context.Queue()
+        self.result_queue = context.Queue()
+        self.processes = [
+            context.Process(
+                target = _sample_in_worker,
+                args = (
+                    worker_index,
+                    num_workers,
+                    pretrained_model_name_or_path,
+                    device,
+                    torch_dtype,
+                    quantize_int8,
+                    num_threads,
+                    layer_indices,
+                    self.task_queue,
+                    self.result_queue
+                ),
+                daemon = True
+            )
+            for worker_index in range(num_workers)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # @UnusedVariable
+        self.close(terminate = exc_type is not None)
+
+    def submit(self, task_id: int, groups: List[List[Tuple[int, int, torch.Tensor]]], share_prefix: bool) -> None:
+        self.task_queue.put((task_id, groups, share_prefix))
+
+    def get_result(self) -> Tuple[int, List[Tuple[int, int, None]], torch.Tensor]:
+        """
+        Waits for the next finished batch.
+
+        Returns:
+            tuple: The task id, the (class, sample, None) item of each row, and the deltas of shape [batch, len(layer_indices), hidden].
+        """
+        while True:
+            try:
+                task_id, items, deltas = self.result_queue.get(timeout = 1)
+                break
+            except queue.Empty:
+                # A worker killed outright (eg: by the OOM killer) never gets to report its error.
+                if any(not process.is_alive() for process in self.processes):
+                    raise RuntimeError("A sampling worker exited unexpectedly.")
+        if task_id is None:
+            raise RuntimeError(f"A sampling worker failed:\n{items}")
+        return task_id, items, deltas
+
+    def close(self, terminate: bool = False) -> None:
+        for process in self.processes:
+            if terminate:
+                process.terminate()
+            else:
+                self.task_queue.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
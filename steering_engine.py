@@ -0,0 +1,276 @@
+import os
+import torch
+import argparse
+import tracing
+
+from functools import partial
+from typing import Dict, List, Optional, Union
+
+from gguf_combiner import ControlVector
+from model_handler import ModelHandler
+
+# A mix is a {control vector name: scale} dict, or the name of a preset (ie: a mix registered with add_preset()).
+Mix = Union[Dict[str, float], str, None]
+
+class SteeringEngine:
+    """
+    Applies control vectors to a loaded model at runtime, so one model can serve any number of steering presets.
+
+    Every control vector is held in one contiguous [vector, layer, hidden] tensor on the model's device, and each
+    decoder layer that any of them uses gets a single forward hook. Each row of a batch has its own mix of vectors and
+    scales: the mixes are gathered into one [layer, batch, hidden] tensor per batch (a single einsum), so each hook
+    only adds one [batch, hidden] slice to the layer's output.
+
+    NOTE: The directions are numbered as the exporter writes them, ie: 'direction.<k>' is added to the output of the
+          k-th (1-based) decoder layer, which is where its hidden states were sampled.
+    """
+
+    def __init__(self, model_handler: ModelHandler, control_vectors: Optional[Dict[str, Union[str, os.PathLike, ControlVector, torch.Tensor, list]]] = None):
+        assert model_handler.model is not None, "The model must be loaded."
+        assert hasattr(model_handler.model.model, 'layers'), "The model does not have the expected structure."
+
+        self.model_handler = model_handler
+        self.model = model_handler.model
+        self.num_layers = model_handler.get_num_layers()
+        self.hidden_size = model_handler.get_hidden_size()
+        self.dtype = model_handler.torch_dtype
+        self.device = self.model.device
+
+        self.names = []
+        self.vectors = torch.zeros((0, self.num_layers, self.hidden_size), dtype = self.dtype, device = self.device)
+        self.presets = {}
+
+        self.mixed = None
+        self.handles = []
+        self.hooked_layers = set()
+
+        for name, control_vector in (control_vectors or {}).items():
+            self.add_vector(name, control_vector)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # @UnusedVariable
+        self.remove()
+
+    def remove(self) -> None:
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.hooked_layers = set()
+        self.mixed = None
+
+    def add_vector(self, name: str, control_vector: Union[str, os.PathLike, ControlVector, torch.Tensor, list]) -> None:
+        """
+        Adds (or replaces) a named control vector.
+
+        Parameters:
+            name (str): The name used to refer to it in mixes.
+            control_vector: A '.gguf' file, a ControlVector, a [layer, hidden] tensor, or a list with a [k, hidden]
+                            tensor (or None) for each layer, in the form export_gguf() takes (the k rows are summed).
+        """
+        directions = self._get_directions(control_vector)
+        directions = directions.to(device = self.device, dtype = self.dtype).unsqueeze(0)
+
+        # NOTE: Rebuilt on each add (which only happens at load time), so the vectors always stay contiguous.
+        if name in self.names:
+            index = self.names.index(name)
+            self.vectors = torch.cat([self.vectors[:index], directions, self.vectors[index + 1:]]).contiguous()
+        else:
+            self.names.append(name)
+            self.vectors = torch.cat([self.vectors, directions]).contiguous()
+
+        self.mixed = None
+        self._register_hooks()
+
+    def add_preset(self, name: str, mix: Dict[str, float]) -> None:
+        """
+        Registers a named mix, so batches can refer to it by name (eg: one per user-facing steering preset).
+        """
+        self._check_mix(mix)
+        self.presets[name] = dict(mix)
+
+    def set_mixes(self, mixes: Union[List[Mix], torch.Tensor]) -> None:
+        """
+        Sets the mix for each row of the following batches.
+
+        Parameters:
+            mixes: A mix (or None, for no steering) for each row, or a [batch, vector] tensor of scales in the order
+                   the vectors were added.
+        """
+        with tracing.span("set_mixes", rows = len(mixes)):
+            if isinstance(mixes, torch.Tensor):
+                weights = mixes.to(torch.float32)
+            else:
+                weights = torch.zeros((len(mixes), len(self.names)), dtype = torch.float32)
+                for row, mix in enumerate(mixes):
+                    for name, scale in self._resolve_mix(mix).items():
+                        weights[row, self.names.index(name)] += scale
+            if weights.shape[1] != len(self.names):
+                raise ValueError(f"Expected scales for {len(self.names)} control vectors, but got {weights.shape[1]}.")
+
+            # Gather every row's mix of every layer at once: [batch, vector] x [vector, layer, hidden] --> [layer, batch, hidden].
+            weights = weights.to(device = self.device, dtype = self.dtype)
+            self.mixed = torch.einsum("bv,vld->lbd", weights, self.vectors).contiguous()
+        tracing.count("steered_rows", len(mixes))
+
+    def clear_mixes(self) -> None:
+        self.mixed = None
+
+    def steer(self, mixes: Union[List[Mix], torch.Tensor]) -> "_Steering":
+        """
+        Returns a context manager that applies the mixes within its block, eg:
+
+            with engine.steer([{"ornate": 0.5}, "descriptive", None]):
+                model.generate(...)
+        """
+        return _Steering(self, mixes)
+
+    def generate(self, prompts: List[str], mixes: List[Mix], use_chat_template: bool = True, **generate_kwargs) -> List[str]:
+        """
+        Generates a continuation of each prompt, steered by that prompt's mix.
+
+        Parameters:
+            prompts (List[str]): The prompts.
+            mixes (List[Mix]): A mix (or None) for each prompt.
+            use_chat_template (bool): Wrap each prompt as a user message with the tokenizer's chat template.
+            **generate_kwargs: Passed on to model.generate() (eg: max_new_tokens, do_sample, temperature).
+
+        Returns:
+            List[str]: The generated text of each prompt (without the prompt).
+        """
+        if len(prompts) != len(mixes):
+            raise ValueError(f"Expected a mix for each of the {len(prompts)} prompts, but got {len(mixes)}.")
+
+        tokenizer = self.model_handler.tokenizer
+        if use_chat_template:
+            prompts = [
+                tokenizer.apply_chat_template([{"role": "user", "content": prompt}], tokenize = False, add_generation_prompt = True)
+                for prompt in prompts
+            ]
+
+        # Left pad, so every row's new tokens start at the same position.
+        padding_side = tokenizer.padding_side
+        pad_token = tokenizer.pad_token
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        try:
+            inputs = tokenizer(prompts, return_tensors = "pt", padding = True, add_special_tokens = not use_chat_template).to(self.device)
+            with torch.no_grad(), self.steer(mixes), tracing.span("generate", rows = len(prompts)):
+                outputs = self.model.generate(**inputs, pad_token_id = tokenizer.pad_token_id, **generate_kwargs)
+        finally:
+            tokenizer.padding_side = padding_side
+            tokenizer.pad_token = pad_token
+
+        return tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens = True)
+
+    def _get_directions(self, control_vector) -> torch.Tensor:
+        if isinstance(control_vector, (str, os.PathLike)):
+            control_vector = ControlVector(control_vector)
+
+        if isinstance(control_vector, ControlVector):
+            model_type = self.model_handler.get_model_type()
+            if control_vector.model_hint != model_type:
+                print(f"WARNING: '{control_vector.path}' was made for '{control_vector.model_hint}', not '{model_type}'.")
+            directions = control_vector.directions
+        elif isinstance(control_vector, torch.Tensor):
+            directions = control_vector.to(torch.float32)
+        else:
+            directions = torch.zeros((len(control_vector), self.hidden_size), dtype = torch.float32)
+            for layer, direction in enumerate(control_vector):
+                if direction is not None:
+                    directions[layer] = direction.to(torch.float32).reshape(-1, self.hidden_size).sum(dim = 0).cpu()
+
+        if tuple(directions.shape) != (self.num_layers, self.hidden_size):
+            raise ValueError(
+                f"Expected directions of shape [{self.num_layers}, {self.hidden_size}] for this model, but got {list(directions.shape)}."
+            )
+        return directions
+
+    def _register_hooks(self) -> None:
+        # Only hook the layers some vector uses, so the rest of the model runs untouched.
+        used_layers = torch.nonzero(self.vectors.abs().amax(dim = (0, 2)) > 0).flatten().tolist()
+        for layer_index in used_layers:
+            if layer_index not in self.hooked_layers:
+                layer = self.model.model.layers[layer_index]
+                self.handles.append(layer.register_forward_hook(partial(self._hook, layer_index)))
+                self.hooked_layers.add(layer_index)
+
+    def _resolve_mix(self, mix: Mix) -> Dict[str, float]:
+        if mix is None:
+            return {}
+        if isinstance(mix, str):
+            if mix not in self.presets:
+                raise KeyError(f"Unknown preset '{mix}' (the presets are: {sorted(self.presets)}).")
+            return self.presets[mix]
+        self._check_mix(mix)
+        return mix
+
+    def _check_mix(self, mix: Dict[str, float]) -> None:
+        unknown = [name for name in mix if name not in self.names]
+        if unknown:
+            raise KeyError(f"Unknown control vectors {unknown} (the control vectors are: {self.names}).")
+
+    def _hook(self, layer_index, module, args, output):  # @UnusedVariable
+        if self.mixed is None:
+            return None
+        hidden_states = output[0] if isinstance(output, tuple) else output
+        steering = self.mixed[layer_index]
+        if steering.device != hidden_states.device:
+            steering = steering.to(hidden_states.device)
+
+        # NOTE: Beam search and 'num_return_sequences' repeat each row, so repeat its mix to match.
+        if steering.shape[0] != hidden_states.shape[0]:
+            if hidden_states.shape[0] % steering.shape[0] != 0:
+                raise ValueError(f"The batch has {hidden_states.shape[0]} rows, but mixes were set for {steering.shape[0]}.")
+            steering = steering.repeat_interleave(hidden_states.shape[0] // steering.shape[0], dim = 0)
+
+        hidden_states = hidden_states + steering.unsqueeze(1)
+        return (hidden_states,) + output[1:] if isinstance(output, tuple) else hidden_states
+
+class _Steering:
+
+    def __init__(self, engine: SteeringEngine, mixes: Union[List[Mix], torch.Tensor]):
+        self.engine = engine
+        self.mixes = mixes
+
+    def __enter__(self):
+        self.engine.set_mixes(self.mixes)
+        return self.engine
+
+    def __exit__(self, exc_type, exc_value, traceback):  # @UnusedVariable
+        self.engine.clear_mixes()
+
+def parse_mix(text: str) -> Mix:
+    """
+    Parses a mix of the form 'name=scale,name=scale' (a bare name means a scale of 1.0, and '' means no steering).
+    """
+    mix = {}
+    for part in filter(None, (part.strip() for part in text.split(","))):
+        name, _, scale = part.partition("=")
+        mix[name.strip()] = mix.get(name.strip(), 0.0) + float(scale or 1.0)
+    return mix
+
+def main(args):
+    torch.set_grad_enabled(False)
+    for values in args.prompt:
+        if len(values) > 2:
+            raise ValueError(f"Expected '--prompt <text> [<mix>]': {' '.join(values)}")
+    model_handler = ModelHandler(args.model_id, device = args.device)
+    with SteeringEngine(model_handler, {name: path for name, path in args.control_vector}) as engine:
+        prompts = [values[0] for values in args.prompt]
+        mixes = [parse_mix(values[1]) if len(values) > 1 else None for values in args.prompt]
+        outputs = engine.generate(prompts, mixes, max_new_tokens = args.max_new_tokens, do_sample = False)
+        for values, output in zip(args.prompt, outputs):
+            print(f"### [{values[1] if len(values) > 1 else 'unsteered'}] {values[0]}\n{output}\n")
+    model_handler.delete()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Generate from one loaded model with a different mix of control vectors for each prompt.")
+    parser.add_argument("--model_id", type = str, required = True, help = "The model ID or local path.")
+    parser.add_argument("--control_vector", type = str, nargs = 2, action = "append", default = [], metavar = ("NAME", "FILE"), help = "A named control vector '.gguf' file (can be repeated).")
+    parser.add_argument("--prompt", type = str, nargs = "+", action = "append", required = True, metavar = "VALUE", help = "A prompt, with an optional mix, eg: 'Write a story.' 'debias,ornate=0.5' (can be repeated).")
+    parser.add_argument("--max_new_tokens", type = int, default = 256, help = "The maximum number of tokens to generate for each prompt.")
+    parser.add_argument("--device", type = str, default = "cuda" if torch.cuda.is_available() else "cpu", choices = ["cpu", "cuda"], help = "The device to run on.")
+    main(parser.parse_args())
@@ -0,0 +1,31 @@
+import os
+import sys
+import json
+import pytest
+
+# The modules live at the root of the repository, rather than in a package.
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+DATA_PATH = os.path.join(ROOT_PATH, "data")
+PROMPT_STEMS_FILE = os.path.join(DATA_PATH, "prompt_stems.json")
+CONTINUATIONS_FILE = os.path.join(DATA_PATH, "dark_tetrad_continuations", "honesty_vs_machiavellianism.json")
+WRITING_PROMPTS_FILE = os.path.join(DATA_PATH, "writing_prompts.txt")
+
+@pytest.fixture(scope = "session")
+def tiny_model_path(tmp_path_factory):
+    """
+    A tiny random-init Llama model (and tokenizer) built from the repository's data, so no downloads are needed.
+    """
+    pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    pytest.importorskip("tokenizers")
+    from benchmark import build_tiny_model
+
+    with open(WRITING_PROMPTS_FILE, 'r') as f:
+        texts = [line.strip() for line in f]
+    with open(PROMPT_STEMS_FILE, 'r') as f:
+        texts += sum(json.load(f).values(), [])
+    path = str(tmp_path_factory.mktemp("tiny_model"))
+    build_tiny_model(path, texts, hidden_size = 64, num_layers = 3, vocab_size = 512)
+    return path
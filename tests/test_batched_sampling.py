@@ -0,0 +1,60 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from hidden_state_capture import LastTokenCapture
+from hidden_state_data_manager import HiddenStateDataManager
+
+NUM_CLASSES = 3
+NUM_SAMPLES = 6
+
+@pytest.fixture(scope = "module")
+def model_handler(tiny_model_path):
+    from model_handler import ModelHandler
+    torch.set_grad_enabled(False)
+    model_handler = ModelHandler(tiny_model_path, device = "cpu", torch_dtype = "float32")
+    yield model_handler
+    model_handler.delete()
+
+def create_dataset_tokens(vocab_size: int):
+    # Each sample's classes share a prefix of random length, followed by suffixes of different lengths (so rows
+    # need padding both in the batch and between the shared prefix and the suffixes).
+    generator = torch.Generator().manual_seed(0)
+    dataset_tokens = [[] for _ in range(NUM_CLASSES)]
+    for _ in range(NUM_SAMPLES):
+        prefix = torch.randint(3, vocab_size, (int(torch.randint(4, 12, (1,), generator = generator)),), generator = generator)
+        for class_index in range(NUM_CLASSES):
+            suffix = torch.randint(3, vocab_size, (int(torch.randint(1, 8, (1,), generator = generator)),), generator = generator)
+            dataset_tokens[class_index].append(torch.cat([prefix, suffix]))
+    return dataset_tokens
+
+def sample_batched(hidden_state_data_manager, capture, dataset_tokens):
+    deltas = {}
+    for batch in hidden_state_data_manager._create_batches(hidden_state_data_manager._create_groups(dataset_tokens)):
+        items, batch_deltas = hidden_state_data_manager.run_groups(capture, batch, hidden_state_data_manager.share_prefix)
+        for (class_index, sample_index, _), row in zip(items, batch_deltas):
+            deltas[(class_index, sample_index)] = row
+    return deltas
+
+@pytest.mark.parametrize("share_prefix", [False, True])
+def test_batched_deltas_match_unbatched(model_handler, share_prefix):
+    dataset_tokens = create_dataset_tokens(model_handler.model.config.vocab_size)
+    layer_indices = list(range(model_handler.get_num_layers()))
+
+    hidden_state_data_manager = HiddenStateDataManager.open_for_sampling(model_handler, share_prefix = share_prefix)
+    hidden_state_data_manager.batch_size = 6
+    hidden_state_data_manager.max_batch_tokens = None
+
+    with LastTokenCapture(model_handler.model, layer_indices) as capture:
+        # Each prompt on its own (no padding, no cache) is the reference.
+        expected = {
+            (class_index, sample_index): hidden_state_data_manager._generate(capture, [tokens])[0]
+            for class_index, token_list in enumerate(dataset_tokens)
+            for sample_index, tokens in enumerate(token_list)
+        }
+        deltas = sample_batched(hidden_state_data_manager, capture, dataset_tokens)
+
+    assert deltas.keys() == expected.keys()
+    for key, row in deltas.items():
+        assert row.shape == (len(layer_indices), model_handler.get_hidden_size())
+        torch.testing.assert_close(row, expected[key], atol = 1e-4, rtol = 1e-4)
@@ -0,0 +1,68 @@
+import io
+import os
+import json
+import pytest
+
+torch = pytest.importorskip("torch")
+spm = pytest.importorskip("sentencepiece")
+transformers = pytest.importorskip("transformers")
+
+from conftest import PROMPT_STEMS_FILE, WRITING_PROMPTS_FILE
+from chat_template_tokenizer import ChatTemplateTokenizer
+
+# A Llama 2 style template, where each body follows a space or line breaks (that SentencePiece attaches to the body).
+CHAT_TEMPLATE = (
+    "{{ bos_token }}[INST] {% for message in messages %}"
+    "{% if message['role'] == 'system' %}<<SYS>>\n{{ message['content'] }}\n<</SYS>>\n\n"
+    "{% else %}{{ message['content'] }} [/INST]{% endif %}{% endfor %}"
+)
+
+def load_texts():
+    with open(WRITING_PROMPTS_FILE, 'r') as f:
+        prompts = [line.strip() for line in f]
+    with open(PROMPT_STEMS_FILE, 'r') as f:
+        stems = json.load(f)
+    system_messages = [f"{pre} {post}." for pre in stems["pre"] for post in stems["post"]]
+    return system_messages, prompts
+
+@pytest.fixture(scope = "module")
+def sentencepiece_model_path(tmp_path_factory):
+    system_messages, prompts = load_texts()
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(
+        sentence_iterator = iter(system_messages + prompts),
+        model_writer = model,
+        vocab_size = 1000,
+        hard_vocab_limit = False,
+        model_type = "bpe",
+        byte_fallback = True,
+        normalization_rule_name = "identity",
+        remove_extra_whitespaces = False,
+        unk_id = 0,
+        bos_id = 1,
+        eos_id = 2
+    )
+    path = os.path.join(str(tmp_path_factory.mktemp("sentencepiece")), "tokenizer.model")
+    with open(path, 'wb') as f:
+        f.write(model.getvalue())
+    return path
+
+@pytest.mark.parametrize("legacy", [True, False])
+@pytest.mark.parametrize("use_separate_system_message", [True, False])
+def test_sentencepiece_skeleton_matches_chat_template(sentencepiece_model_path, legacy, use_separate_system_message):
+    if not legacy:
+        # NOTE: The non-legacy tokenizer rewrites the model's normalizer spec, which needs protobuf.
+        pytest.importorskip("google.protobuf")
+    tokenizer = transformers.LlamaTokenizer(vocab_file = sentencepiece_model_path, legacy = legacy)
+    tokenizer.chat_template = CHAT_TEMPLATE
+    system_messages, prompts = load_texts()
+    conversations = [(system_messages[i % len(system_messages)], prompt) for i, prompt in enumerate(prompts[:40])]
+
+    chat_template_tokenizer = ChatTemplateTokenizer(tokenizer, use_separate_system_message, num_verification_samples = len(conversations))
+    token_list = chat_template_tokenizer.tokenize(conversations)
+
+    # The splice must match 'apply_chat_template' by itself (ie: without falling back to it).
+    assert chat_template_tokenizer.skeleton is not None
+    for conversation, tokens in zip(conversations, token_list):
+        expected = chat_template_tokenizer._apply_chat_template(chat_template_tokenizer._get_bodies(*conversation))
+        assert torch.equal(tokens, expected.to(torch.long))
@@ -0,0 +1,74 @@
+import os
+import json
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("gguf")
+
+from gguf_exporter import export_gguf
+from gguf_combiner import ControlVector, combine_gguf_files, combine_presets, parse_layers
+
+NUM_LAYERS = 6
+HIDDEN_SIZE = 16
+
+def create_directions(seed: int, layers):
+    # The [1, hidden] direction of each (0-based) layer given, and None for the rest.
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.randn(1, HIDDEN_SIZE, generator = generator) if layer in layers else None for layer in range(NUM_LAYERS)]
+
+def write_control_vector(path: str, directions) -> str:
+    export_gguf(directions, path, "llama", NUM_LAYERS, verbose = False)
+    return path
+
+def test_round_trip(tmp_path):
+    directions = create_directions(0, [1, 2, 4])
+    control_vector = ControlVector(write_control_vector(os.path.join(str(tmp_path), "a.gguf"), directions))
+
+    assert (control_vector.model_hint, control_vector.layer_count, control_vector.hidden_size) == ("llama", NUM_LAYERS, HIDDEN_SIZE)
+    for layer, direction in enumerate(directions):
+        assert bool(control_vector.present[layer]) == (direction is not None)
+        expected = direction[0] if direction is not None else torch.zeros(HIDDEN_SIZE)
+        torch.testing.assert_close(control_vector.directions[layer], expected, rtol = 0, atol = 0)
+
+def test_combine_scales_and_masks_layers(tmp_path):
+    a = create_directions(0, [0, 1, 2, 3])
+    b = create_directions(1, [2, 3, 4])
+    paths = [
+        write_control_vector(os.path.join(str(tmp_path), "a.gguf"), a),
+        write_control_vector(os.path.join(str(tmp_path), "b.gguf"), b)
+    ]
+    output_path = os.path.join(str(tmp_path), "combined.gguf")
+    # NOTE: The layer ranges are 1-based, so '2-3' is the (0-based) layers 1 and 2.
+    combine_gguf_files(paths, output_path, scales = [0.5, -2.0], layers = ["2-3", None], verbose = False)
+
+    combined = ControlVector(output_path)
+    assert combined.present.tolist() == [False, True, True, True, True, False]
+    torch.testing.assert_close(combined.directions[1], 0.5 * a[1][0])
+    torch.testing.assert_close(combined.directions[2], 0.5 * a[2][0] - 2.0 * b[2][0])
+    torch.testing.assert_close(combined.directions[3], -2.0 * b[3][0])
+    torch.testing.assert_close(combined.directions[4], -2.0 * b[4][0])
+
+def test_presets_match_combining_directly(tmp_path):
+    a = write_control_vector(os.path.join(str(tmp_path), "a.gguf"), create_directions(0, range(NUM_LAYERS)))
+    b = write_control_vector(os.path.join(str(tmp_path), "b.gguf"), create_directions(1, range(NUM_LAYERS)))
+    presets_path = os.path.join(str(tmp_path), "presets.json")
+    with open(presets_path, 'w') as f:
+        json.dump({"both": [{"path": "a.gguf", "scale": 0.25}, {"path": "b.gguf", "layers": "1,4-6"}]}, f)
+
+    output_dir = os.path.join(str(tmp_path), "presets")
+    assert combine_presets(presets_path, output_dir) == [os.path.join(output_dir, "both.gguf")]
+    expected_path = os.path.join(str(tmp_path), "expected.gguf")
+    combine_gguf_files([a, b], expected_path, scales = [0.25, 1.0], layers = [None, "1,4-6"], verbose = False)
+    torch.testing.assert_close(ControlVector(os.path.join(output_dir, "both.gguf")).directions, ControlVector(expected_path).directions, rtol = 0, atol = 0)
+
+def test_mismatched_models_are_rejected(tmp_path):
+    a = write_control_vector(os.path.join(str(tmp_path), "a.gguf"), create_directions(0, [0]))
+    b = os.path.join(str(tmp_path), "b.gguf")
+    export_gguf(create_directions(1, [0]), b, "mistral", NUM_LAYERS, verbose = False)
+    with pytest.raises(ValueError):
+        combine_gguf_files([a, b], os.path.join(str(tmp_path), "combined.gguf"), verbose = False)
+
+@pytest.mark.parametrize("layers", ["0", "7", "3-2", "1-7"])
+def test_invalid_layer_ranges_are_rejected(layers):
+    with pytest.raises(ValueError):
+        parse_layers(layers, NUM_LAYERS)
@@ -0,0 +1,83 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from direction_analyzer import (
+    DirectionAnalyzer,
+    compute_discriminant_ratio,
+    compute_variance_reduction,
+    project_data_onto_direction
+)
+
+def create_data(num_samples: int = 400, hidden_size: int = 48):
+    # Two differenced classes pulled apart along a few orthogonal directions of different strengths, so the greedy
+    # search has several candidates to combine (float64, so both searches make the same decisions).
+    generator = torch.Generator().manual_seed(0)
+    signal_directions = torch.linalg.qr(torch.randn(hidden_size, 3, generator = generator, dtype = torch.float64))[0].T
+    signal = (torch.tensor([3.0, 1.5, 0.8], dtype = torch.float64).unsqueeze(1) * signal_directions).sum(dim = 0)
+    return [
+        torch.randn(num_samples, hidden_size, generator = generator, dtype = torch.float64) - signal,
+        torch.randn(num_samples, hidden_size, generator = generator, dtype = torch.float64) + signal
+    ]
+
+def search_by_reprojecting(data, scores, discriminant_ratio_tolerance):
+    # The original search, which renormalises the running sum and reprojects all the data at every step.
+    directions = scores["directions"]
+    discriminant_ratios = scores["discriminant_ratios"]
+    desired_means = scores["desired_means"]
+
+    selected = torch.nonzero(discriminant_ratios >= discriminant_ratio_tolerance).flatten()
+    results = [(discriminant_ratios[i].item(), desired_means[i] * directions[i, :]) for i in selected.tolist()]
+    results.sort(key = lambda x: x[0], reverse = True)
+
+    best_discriminant_ratio = 0.0
+    best_variance_reduction = 0.0
+    best_means = [0.0, 0.0]
+    best_stds = [0.0, 0.0]
+    best_direction_sum = torch.zeros_like(directions[0, :])
+    selected_directions = 0
+    for _, scaled_direction in results:
+        direction_sum = best_direction_sum + scaled_direction
+        direction = direction_sum / torch.norm(direction_sum)
+        projected_scores = [project_data_onto_direction(d, direction) for d in data]
+        discriminant_ratio = compute_discriminant_ratio(projected_scores[0], projected_scores[1])
+        if discriminant_ratio > best_discriminant_ratio + discriminant_ratio_tolerance:
+            best_discriminant_ratio = discriminant_ratio
+            best_variance_reduction = compute_variance_reduction(projected_scores[0], projected_scores[1])
+            best_means = [projected_scores[0].mean(), projected_scores[1].mean()]
+            best_stds = [projected_scores[0].std(), projected_scores[1].std()]
+            best_direction_sum = direction_sum
+            selected_directions += 1
+
+    return (
+        directions.shape[0],
+        len(results),
+        selected_directions,
+        best_direction_sum,
+        best_discriminant_ratio,
+        best_variance_reduction,
+        best_means,
+        best_stds
+    )
+
+@pytest.mark.parametrize("discriminant_ratio_tolerance", [0.01, 0.1, 0.5])
+def test_incremental_search_matches_reprojecting_search(discriminant_ratio_tolerance):
+    data = create_data()
+    scores = DirectionAnalyzer._score_layer_data(data, eigen_solver = "dense")
+
+    (
+        total_directions,
+        filtered_directions,
+        selected_directions,
+        direction_sum,
+        discriminant_ratio,
+        variance_reduction,
+        means,
+        stds
+    ) = DirectionAnalyzer._search_layer_data(data, scores, discriminant_ratio_tolerance)
+    expected = search_by_reprojecting(data, scores, discriminant_ratio_tolerance)
+
+    assert (total_directions, filtered_directions, selected_directions) == expected[:3]
+    torch.testing.assert_close(direction_sum, expected[3])
+    for value, expected_value in zip([discriminant_ratio, variance_reduction, *means, *stds], [*expected[4:6], *expected[6], *expected[7]]):
+        torch.testing.assert_close(torch.as_tensor(value, dtype = torch.float64), torch.as_tensor(expected_value, dtype = torch.float64))
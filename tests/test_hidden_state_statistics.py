@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from direction_analyzer import DirectionAnalyzer
+from hidden_state_statistics import HiddenStateStatistics
+
+NUM_SAMPLES = 300
+HIDDEN_SIZE = 24
+
+def create_deltas():
+    # [baseline, negative, positive] deltas for one layer, with the two classes pulled apart from the baseline along a
+    # few directions (and given a non-zero mean, so the merge has to carry the means correctly).
+    generator = torch.Generator().manual_seed(0)
+    signal_directions = torch.linalg.qr(torch.randn(HIDDEN_SIZE, 3, generator = generator, dtype = torch.float64))[0].T
+    signal = (torch.tensor([3.0, 1.5, 0.8], dtype = torch.float64).unsqueeze(1) * signal_directions).sum(dim = 0)
+    offset = torch.randn(HIDDEN_SIZE, generator = generator, dtype = torch.float64)
+    baseline = torch.randn(NUM_SAMPLES, HIDDEN_SIZE, generator = generator, dtype = torch.float64) + offset
+    negative = baseline + torch.randn(NUM_SAMPLES, HIDDEN_SIZE, generator = generator, dtype = torch.float64) - signal
+    positive = baseline + torch.randn(NUM_SAMPLES, HIDDEN_SIZE, generator = generator, dtype = torch.float64) + signal
+    return torch.stack([baseline, negative, positive]).unsqueeze(2)  # [class, sample, layer, hidden]
+
+def accumulate(path: str, deltas: torch.Tensor, batch_sizes) -> HiddenStateStatistics:
+    statistics = HiddenStateStatistics.create(path, 3, 1, [0], HIDDEN_SIZE, class_pairs = [(1, 2)])
+    start = 0
+    for batch_size in batch_sizes:
+        statistics.update(deltas[:, start:start + batch_size], list(range(start, start + batch_size)))
+        start += batch_size
+    assert start == NUM_SAMPLES
+    return statistics
+
+def test_merged_moments_match_samples(tmp_path):
+    deltas = create_deltas()
+    # Uneven batch sizes, so the pairwise merge is exercised with different counts on each side.
+    statistics = accumulate(str(tmp_path), deltas, [1, 7, 50, 42, 100, 100])
+    count, means, (C_AA, C_AB, C_BB) = statistics.get_layer_moments(0, [1, 2])
+
+    A = deltas[1, :, 0] - deltas[0, :, 0]
+    B = deltas[2, :, 0] - deltas[0, :, 0]
+    assert count == NUM_SAMPLES
+    torch.testing.assert_close(means, torch.stack([A.mean(dim = 0), B.mean(dim = 0)]))
+    centred_A, centred_B = A - A.mean(dim = 0), B - B.mean(dim = 0)
+    torch.testing.assert_close(C_AA, centred_A.T @ centred_A)
+    torch.testing.assert_close(C_AB, centred_A.T @ centred_B)
+    torch.testing.assert_close(C_BB, centred_B.T @ centred_B)
+
+    # The same moments read back from the saved layer files.
+    statistics.save()
+    saved_count, saved_means, saved_comoments = HiddenStateStatistics(str(tmp_path)).get_layer_moments(0, [1, 2])
+    assert saved_count == count
+    torch.testing.assert_close(saved_means, means, rtol = 0, atol = 0)
+    for saved_comoment, comoment in zip(saved_comoments, (C_AA, C_AB, C_BB)):
+        torch.testing.assert_close(saved_comoment, comoment, rtol = 0, atol = 0)
+
+@pytest.mark.parametrize("discriminant_ratio_tolerance", [0.01, 0.1, 0.5])
+def test_moments_analysis_matches_samples(tmp_path, discriminant_ratio_tolerance):
+    deltas = create_deltas()
+    statistics = accumulate(str(tmp_path), deltas, [64] * 4 + [44])
+    count, means, comoments = statistics.get_layer_moments(0, [1, 2])
+
+    data = [deltas[1, :, 0] - deltas[0, :, 0], deltas[2, :, 0] - deltas[0, :, 0]]
+    expected = DirectionAnalyzer._analyze_layer_data(data, discriminant_ratio_tolerance, eigen_solver = "dense")
+    actual = DirectionAnalyzer._analyze_layer_moments(count, means, comoments, discriminant_ratio_tolerance, eigen_solver = "dense")
+
+    # The total, filtered and selected numbers of directions.
+    assert actual[:3] == expected[:3]
+    torch.testing.assert_close(actual[3], expected[3].to(actual[3].dtype), atol = 1e-5, rtol = 1e-5)
+    for value, expected_value in zip([*actual[4:6], *actual[6], *actual[7]], [*expected[4:6], *expected[6], *expected[7]]):
+        torch.testing.assert_close(torch.as_tensor(value, dtype = torch.float64), torch.as_tensor(expected_value, dtype = torch.float64), atol = 1e-6, rtol = 1e-6)
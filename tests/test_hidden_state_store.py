@@ -0,0 +1,189 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from hidden_state_store import HiddenStateStore, QUANTIZED_ENCODINGS, encode_rows, decode_rows, get_encoded_row_size
+
+NUM_CLASSES = 3
+NUM_SAMPLES = 4
+LAYER_INDICES = [1, 2]
+HIDDEN_SIZE = 8
+
+def create_store(path: str, num_samples: int = NUM_SAMPLES) -> HiddenStateStore:
+    return HiddenStateStore.create(path, NUM_CLASSES, num_samples, 4, LAYER_INDICES, HIDDEN_SIZE, torch.float32)
+
+def create_rows(num_samples: int = NUM_SAMPLES) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(0)
+    return torch.randn(NUM_CLASSES, num_samples, len(LAYER_INDICES), HIDDEN_SIZE, generator = generator)
+
+def write_samples(store: HiddenStateStore, rows: torch.Tensor, sample_indices) -> None:
+    class_indices = [c for c in range(NUM_CLASSES) for _ in sample_indices]
+    samples = [s for _ in range(NUM_CLASSES) for s in sample_indices]
+    store.write(class_indices, samples, rows[class_indices, samples])
+
+def get_row_offset(class_index: int, sample_index: int, num_samples: int = NUM_SAMPLES) -> int:
+    return (class_index * num_samples + sample_index) * HIDDEN_SIZE * 4
+
+def test_interrupted_store_resumes_from_last_checkpoint(tmp_path):
+    rows = create_rows()
+    store = create_store(str(tmp_path))
+    write_samples(store, rows, [0, 1])
+    store.checkpoint()
+    # Written but never checkpointed (ie: the run was killed before the next checkpoint).
+    write_samples(store, rows, [2])
+    store.flush()
+
+    resumed = HiddenStateStore(str(tmp_path))
+    assert resumed.load_journal() == NUM_CLASSES * 2
+    assert all(resumed.is_written(c, s) for c in range(NUM_CLASSES) for s in [0, 1])
+    assert not any(resumed.is_written(c, s) for c in range(NUM_CLASSES) for s in [2, 3])
+
+    write_samples(resumed, rows, [2, 3])
+    resumed.mark_complete()
+    reopened = HiddenStateStore(str(tmp_path))
+    assert reopened.is_complete()
+    for position, layer_index in enumerate(LAYER_INDICES):
+        torch.testing.assert_close(reopened.get_layer(layer_index), rows[:, :, position, :], rtol = 0, atol = 0)
+
+def test_torn_journal_entry_is_truncated(tmp_path):
+    rows = create_rows()
+    store = create_store(str(tmp_path))
+    write_samples(store, rows, [0])
+    store.checkpoint()
+    journal_filename = os.path.join(str(tmp_path), HiddenStateStore.JOURNAL_FILENAME)
+    valid_size = os.path.getsize(journal_filename)
+    write_samples(store, rows, [1])
+    store.checkpoint()
+
+    # Tear the last entry part way through (as if the process died mid-write).
+    with open(journal_filename, 'r+b') as f:
+        f.truncate(valid_size + 10)
+
+    resumed = HiddenStateStore(str(tmp_path))
+    assert resumed.load_journal() == NUM_CLASSES
+    assert os.path.getsize(journal_filename) == valid_size
+    assert not resumed.is_written(0, 1)
+
+def test_corrupt_row_is_resampled(tmp_path):
+    rows = create_rows()
+    store = create_store(str(tmp_path))
+    write_samples(store, rows, list(range(NUM_SAMPLES)))
+    store.mark_complete()
+    store.close()
+
+    # Flip a byte of one row of one layer.
+    layer_filename = HiddenStateStore._get_layer_filename(str(tmp_path), LAYER_INDICES[1])
+    with open(layer_filename, 'r+b') as f:
+        f.seek(get_row_offset(2, 1) + 3)
+        byte = f.read(1)
+        f.seek(get_row_offset(2, 1) + 3)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    damaged = HiddenStateStore(str(tmp_path))
+    # The cheap check only looks at the metadata, journal and file sizes...
+    assert damaged.verify()
+    # ... but the full check (and resuming) reads every row back.
+    assert not damaged.verify(full = True)
+    assert damaged.load_journal() == NUM_CLASSES * NUM_SAMPLES - 1
+    assert not damaged.is_written(2, 1)
+
+    write_samples(damaged, rows, [1])
+    damaged.mark_complete()
+    assert HiddenStateStore(str(tmp_path)).verify(full = True)
+
+def test_truncated_layer_file_fails_cheap_check(tmp_path):
+    store = create_store(str(tmp_path))
+    write_samples(store, create_rows(), list(range(NUM_SAMPLES)))
+    store.mark_complete()
+    store.close()
+    with open(HiddenStateStore._get_layer_filename(str(tmp_path), LAYER_INDICES[0]), 'r+b') as f:
+        f.truncate(get_row_offset(1, 0))
+    assert not HiddenStateStore(str(tmp_path)).verify()
+
+def test_grow_keeps_rows(tmp_path):
+    rows = create_rows(2 * NUM_SAMPLES)
+    store = create_store(str(tmp_path))
+    write_samples(store, rows, list(range(NUM_SAMPLES)))
+    store.mark_complete()
+
+    store.grow(2 * NUM_SAMPLES)
+    assert not store.is_complete()
+    assert store.load_journal() == NUM_CLASSES * NUM_SAMPLES
+    write_samples(store, rows, list(range(NUM_SAMPLES, 2 * NUM_SAMPLES)))
+    store.mark_complete()
+
+    grown = HiddenStateStore(str(tmp_path))
+    assert grown.verify(full = True)
+    for position, layer_index in enumerate(LAYER_INDICES):
+        torch.testing.assert_close(grown.get_layer(layer_index), rows[:, :, position, :], rtol = 0, atol = 0)
+
+def test_grow_interrupted_before_switch_is_discarded(tmp_path):
+    rows = create_rows()
+    store = create_store(str(tmp_path))
+    write_samples(store, rows, list(range(NUM_SAMPLES)))
+    store.mark_complete()
+    store.close()
+
+    # A partly written grown file, from a grow killed before the metadata was switched over.
+    layer_filename = HiddenStateStore._get_layer_filename(str(tmp_path), LAYER_INDICES[0])
+    with open(layer_filename + ".grow", 'wb') as f:
+        f.write(b"\0" * 100)
+
+    reopened = HiddenStateStore(str(tmp_path))
+    assert not os.path.exists(layer_filename + ".grow")
+    assert reopened.num_samples == NUM_SAMPLES
+    assert reopened.verify(full = True)
+
+def test_grow_interrupted_after_switch_is_finished(tmp_path):
+    rows = create_rows()
+    store = create_store(str(tmp_path))
+    write_samples(store, rows, list(range(NUM_SAMPLES)))
+    store.checkpoint()
+    store.close()
+
+    # Every grown file was written in full and the metadata switched, but the files weren't moved into place.
+    for layer_index in LAYER_INDICES:
+        layer_filename = HiddenStateStore._get_layer_filename(str(tmp_path), layer_index)
+        old = np.fromfile(layer_filename, dtype = np.float32).reshape(NUM_CLASSES, NUM_SAMPLES, HIDDEN_SIZE)
+        new = np.zeros((NUM_CLASSES, 2 * NUM_SAMPLES, HIDDEN_SIZE), dtype = np.float32)
+        new[:, :NUM_SAMPLES] = old
+        new.tofile(layer_filename + ".grow")
+    store.metadata["num_samples"] = 2 * NUM_SAMPLES
+    HiddenStateStore._write_metadata(str(tmp_path), store.metadata)
+
+    reopened = HiddenStateStore(str(tmp_path))
+    assert reopened.num_samples == 2 * NUM_SAMPLES
+    assert reopened.load_journal() == NUM_CLASSES * NUM_SAMPLES
+    for position, layer_index in enumerate(LAYER_INDICES):
+        assert not os.path.exists(HiddenStateStore._get_layer_filename(str(tmp_path), layer_index) + ".grow")
+        torch.testing.assert_close(reopened.get_layer(layer_index)[:, :NUM_SAMPLES], rows[:, :, position, :], rtol = 0, atol = 0)
+
+@pytest.mark.parametrize("encoding", list(QUANTIZED_ENCODINGS))
+@pytest.mark.parametrize("hidden_size", [7, 8])
+def test_quantized_round_trip_is_within_half_a_step(encoding, hidden_size):
+    generator = torch.Generator().manual_seed(0)
+    rows = torch.randn(16, hidden_size, generator = generator) * torch.logspace(-3, 3, 16).unsqueeze(1)
+    rows[5] = 0.0
+    codes, scales = encode_rows(rows, encoding)
+    assert codes.shape[-1] * codes.element_size() + 4 == get_encoded_row_size(encoding, hidden_size)
+
+    decoded = decode_rows(codes, scales, encoding, hidden_size)
+    assert decoded.shape == rows.shape and decoded.dtype == torch.float32
+    # Rounding to the nearest code is out by at most half a step (of the row's scale) in each element.
+    assert torch.all((decoded - rows).abs() <= scales.unsqueeze(1) / 2 * (1 + 1e-6))
+    # The largest element of each row is exact (up to the scale's rounding), and a row of zeros stays zero.
+    torch.testing.assert_close(decoded.abs().amax(dim = 1), rows.abs().amax(dim = 1))
+    assert scales[5] == 0.0 and torch.all(decoded[5] == 0.0)
+
+@pytest.mark.parametrize("encoding", list(QUANTIZED_ENCODINGS))
+def test_quantized_class_matches_layer(tmp_path, encoding):
+    rows = create_rows()
+    store = HiddenStateStore.create(str(tmp_path), NUM_CLASSES, NUM_SAMPLES, 4, LAYER_INDICES, HIDDEN_SIZE, torch.float32, encoding = encoding)
+    write_samples(store, rows, list(range(NUM_SAMPLES)))
+    store.mark_complete()
+    for layer_index in LAYER_INDICES:
+        layer = store.get_layer(layer_index, chunk_size = 3)
+        for class_index in range(NUM_CLASSES):
+            torch.testing.assert_close(store.get_class(layer_index, class_index, chunk_size = 3), layer[class_index], rtol = 0, atol = 0)
@@ -0,0 +1,34 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from conftest import PROMPT_STEMS_FILE, CONTINUATIONS_FILE, WRITING_PROMPTS_FILE
+from dataset_manager import DatasetManager
+from hidden_state_data_manager import HiddenStateDataManager
+
+def sample(model_path: str, output_path: str, num_sampling_workers: int) -> HiddenStateDataManager:
+    dataset_manager = DatasetManager(PROMPT_STEMS_FILE, CONTINUATIONS_FILE, WRITING_PROMPTS_FILE, 24)
+    return HiddenStateDataManager(
+        dataset_manager,
+        model_path,
+        output_path,
+        use_separate_system_message = False,
+        batch_size = 4,
+        checkpoint_interval = float("inf"),
+        device = "cpu",
+        torch_dtype = "float32",
+        num_sampling_workers = num_sampling_workers,
+        num_threads = 1
+    )
+
+def test_workers_match_single_process(tiny_model_path, tmp_path):
+    torch.set_grad_enabled(False)
+    expected = sample(tiny_model_path, os.path.join(tmp_path, "single_"), num_sampling_workers = 1)
+    actual = sample(tiny_model_path, os.path.join(tmp_path, "workers_"), num_sampling_workers = 2)
+
+    assert actual.store.is_complete() and expected.store.is_complete()
+    assert actual.store.get_manifest() == expected.store.get_manifest()
+    assert actual.store.layer_indices == expected.store.layer_indices
+    for layer_index in expected.store.layer_indices:
+        torch.testing.assert_close(actual.store.get_layer(layer_index), expected.store.get_layer(layer_index), atol = 1e-5, rtol = 1e-5)
@@ -0,0 +1,59 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("gguf")
+
+from gguf_exporter import export_gguf
+from steering_engine import SteeringEngine
+
+@pytest.fixture(scope = "module")
+def model_handler(tiny_model_path):
+    from model_handler import ModelHandler
+    torch.set_grad_enabled(False)
+    model_handler = ModelHandler(tiny_model_path, device = "cpu", torch_dtype = "float32")
+    yield model_handler
+    model_handler.delete()
+
+def get_hidden_states(model_handler, input_ids):
+    return model_handler.model(input_ids = input_ids, output_hidden_states = True).hidden_states
+
+@pytest.mark.parametrize("layer_index", [0, 1])
+def test_direction_is_added_to_its_layer(model_handler, tmp_path, layer_index):
+    # NOTE: 'direction.<k>' is 1-based, so the exporter writes the direction of (0-based) layer i as 'direction.<i + 1>'.
+    generator = torch.Generator().manual_seed(0)
+    direction = torch.randn(1, model_handler.get_hidden_size(), generator = generator)
+    directions = [direction if layer == layer_index else None for layer in range(model_handler.get_num_layers())]
+    path = os.path.join(str(tmp_path), "control_vector.gguf")
+    export_gguf(directions, path, model_handler.get_model_type(), model_handler.get_num_layers(), verbose = False)
+
+    input_ids = torch.randint(3, model_handler.model.config.vocab_size, (3, 8), generator = generator)
+    expected = get_hidden_states(model_handler, input_ids)
+    with SteeringEngine(model_handler, {"test": path}) as engine:
+        assert engine.hooked_layers == {layer_index}
+        with engine.steer([None, {"test": 1.0}, {"test": -0.5}]):
+            actual = get_hidden_states(model_handler, input_ids)
+
+    # The output of layer i is 'hidden_states[i + 1]' (the embeddings come first), and the unsteered row is unchanged.
+    for i in range(layer_index + 1):
+        torch.testing.assert_close(actual[i], expected[i])
+    torch.testing.assert_close(actual[layer_index + 1][0], expected[layer_index + 1][0])
+    torch.testing.assert_close(actual[layer_index + 1][1], expected[layer_index + 1][1] + direction)
+    torch.testing.assert_close(actual[layer_index + 1][2], expected[layer_index + 1][2] - 0.5 * direction)
+
+    # The hooks are gone once the engine is removed.
+    torch.testing.assert_close(get_hidden_states(model_handler, input_ids)[-1], expected[-1])
+
+def test_directions_of_every_form_match(model_handler, tmp_path):
+    generator = torch.Generator().manual_seed(1)
+    num_layers, hidden_size = model_handler.get_num_layers(), model_handler.get_hidden_size()
+    directions = [torch.randn(2, hidden_size, generator = generator) if layer != 1 else None for layer in range(num_layers)]
+    path = os.path.join(str(tmp_path), "control_vector.gguf")
+    export_gguf(directions, path, model_handler.get_model_type(), num_layers, verbose = False)
+
+    # The same directions from the '.gguf' file, as the exporter's list (whose rows are summed) and as a [layer, hidden] tensor.
+    as_tensor = torch.stack([d.sum(dim = 0) if d is not None else torch.zeros(hidden_size) for d in directions])
+    with SteeringEngine(model_handler, {"file": path, "list": directions, "tensor": as_tensor}) as engine:
+        assert engine.hooked_layers == {layer for layer in range(num_layers) if layer != 1}
+        torch.testing.assert_close(engine.vectors[0], engine.vectors[1])
+        torch.testing.assert_close(engine.vectors[0], engine.vectors[2])
@@ -0,0 +1,49 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from conftest import PROMPT_STEMS_FILE, CONTINUATIONS_FILE, WRITING_PROMPTS_FILE
+from dataset_manager import DatasetManager
+from hidden_state_data_manager import HiddenStateDataManager
+
+def sample(model_path: str, output_path: str, num_prompt_samples: int, use_statistics: bool) -> HiddenStateDataManager:
+    dataset_manager = DatasetManager(PROMPT_STEMS_FILE, CONTINUATIONS_FILE, WRITING_PROMPTS_FILE, num_prompt_samples)
+    return HiddenStateDataManager(
+        dataset_manager,
+        model_path,
+        output_path,
+        use_separate_system_message = False,
+        batch_size = 4,
+        use_statistics = use_statistics,
+        checkpoint_interval = float("inf"),
+        device = "cpu",
+        torch_dtype = "float32",
+        num_threads = 1
+    )
+
+@pytest.mark.parametrize("use_statistics", [False, True])
+def test_top_up_matches_fresh_run(tiny_model_path, tmp_path, use_statistics):
+    torch.set_grad_enabled(False)
+    sample(tiny_model_path, os.path.join(str(tmp_path), "topped_up_"), 12, use_statistics)
+    actual = sample(tiny_model_path, os.path.join(str(tmp_path), "topped_up_"), 24, use_statistics)
+    expected = sample(tiny_model_path, os.path.join(str(tmp_path), "fresh_"), 24, use_statistics)
+
+    if use_statistics:
+        assert actual.statistics.is_complete() and actual.statistics.count == expected.statistics.count
+        assert actual.statistics.completed_samples == expected.statistics.completed_samples
+        assert actual.statistics.get_manifest() == expected.statistics.get_manifest()
+        for layer_index in expected.statistics.layer_indices:
+            for class_indices in expected.statistics.class_pairs:
+                actual_count, actual_means, actual_comoments = actual.get_layer_moments(layer_index, list(class_indices))
+                expected_count, expected_means, expected_comoments = expected.get_layer_moments(layer_index, list(class_indices))
+                assert actual_count == expected_count
+                # NOTE: The samples are merged in a different order (and batched differently), so only close.
+                torch.testing.assert_close(actual_means, expected_means, atol = 1e-5, rtol = 1e-5)
+                for actual_comoment, expected_comoment in zip(actual_comoments, expected_comoments):
+                    torch.testing.assert_close(actual_comoment, expected_comoment, atol = 1e-4, rtol = 1e-5)
+    else:
+        assert actual.store.is_complete() and actual.store.num_samples == expected.store.num_samples
+        assert actual.store.get_manifest() == expected.store.get_manifest()
+        for layer_index in expected.store.layer_indices:
+            torch.testing.assert_close(actual.store.get_layer(layer_index), expected.store.get_layer(layer_index), atol = 1e-5, rtol = 1e-5)
@@ -0,0 +1,34 @@
+import os
+import pytest
+
+torch = pytest.importorskip("torch")
+safetensors_torch = pytest.importorskip("safetensors.torch")
+
+from weight_orthogonalizer import DOWN_PROJ_PATTERN, orthogonalize_checkpoint
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_checkpoint_matches_loaded_model(tiny_model_path, tmp_path, num_workers):
+    from model_handler import ModelHandler
+
+    # Unnormalised directions, so both paths have to normalise them the same way.
+    generator = torch.Generator().manual_seed(0)
+    model_handler = ModelHandler(tiny_model_path, device = "cpu", torch_dtype = "float32")
+    direction_matrix = 3.0 * torch.randn(2, model_handler.get_hidden_size(), generator = generator)
+
+    output_path = os.path.join(str(tmp_path), "orthogonalized")
+    orthogonalize_checkpoint(tiny_model_path, output_path, direction_matrix, skip_begin_layers = 1, num_workers = num_workers)
+    model_handler.modify_tensors(direction_matrix, skip_begin_layers = 1, skip_end_layers = 0)
+
+    expected = model_handler.model.state_dict()
+    original = safetensors_torch.load_file(os.path.join(tiny_model_path, "model.safetensors"))
+    actual = safetensors_torch.load_file(os.path.join(output_path, "model.safetensors"))
+    assert set(actual) == set(original)
+    for name, tensor in actual.items():
+        match = DOWN_PROJ_PATTERN.match(name)
+        if match and int(match.group(1)) >= 1:
+            torch.testing.assert_close(tensor, expected[name])
+            assert not torch.equal(tensor, original[name])
+        else:
+            # Every other tensor (including the skipped layer's 'down_proj') is copied byte for byte.
+            assert torch.equal(tensor, original[name])
+    model_handler.delete()
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+from typing import Optional
+
+# NOTE: PyTorch is only imported (lazily) if tracing is enabled and a span asks for memory usage.
+
+_NULL_SPAN = contextlib.nullcontext()
+
+class _Span:
+
+    def __init__(self, tracer: "Tracer", name: str, memory: bool, args: dict):
+        self.tracer = tracer
+        self.name = name
+        self.memory = memory
+        self.args = args
+
+    def __enter__(self):
+        if self.memory:
+            self.tracer._reset_peak_memory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # @UnusedVariable
+        end = time.perf_counter()
+        if self.memory:
+            self.args.update(self.tracer._get_memory())
+        self.tracer._add_span(self.name, self.start, end, self.args)
+
+class Tracer:
+    """
+    Records named spans (with optional memory usage) and counters, and writes them as a JSON summary or a Chrome trace.
+
+    A disabled tracer hands out a shared no-op context manager, so leaving the spans in costs next to nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.spans = []
+        self.counters = {}
+        self.counter_events = []
+        self.start = time.perf_counter()
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.spans = []
+        self.counters = {}
+        self.counter_events = []
+        self.start = time.perf_counter()
+
+    def span(self, name: str, memory: bool = False, **args):
+        """
+        Times a block of code (and records the peak CUDA memory within it, the RSS at its end and the process's peak RSS
+        so far, if 'memory' is set).
+
+        NOTE: Resetting the peak CUDA memory affects any enclosing span, so only set 'memory' on the innermost spans.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, memory, args)
+
+    def count(self, name: str, value: float = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.counter_events.append((name, time.perf_counter(), self.counters[name]))
+
+    def collect(self) -> dict:
+        """
+        Returns (and clears) the spans and counters recorded so far, so a worker process can hand them back to be merged.
+        """
+        with self.lock:
+            # NOTE: Each worker process gets its own track, and the counters are handed back as increments.
+            pid = os.getpid()
+            spans = [(name, start, end, pid, args) for name, start, end, _, args in self.spans]
+            totals = {}
+            increments = []
+            for name, timestamp, total in self.counter_events:
+                increments.append((name, timestamp, total - totals.get(name, 0)))
+                totals[name] = total
+            self.spans = []
+            self.counters = {}
+            self.counter_events = []
+        return {"spans": spans, "counter_increments": increments}
+
+    def merge(self, records: dict) -> None:
+        """
+        Merges the spans and counters collected by a worker process.
+
+        NOTE: The span times come from 'time.perf_counter', which is system-wide on Linux and macOS, so they line up.
+        """
+        with self.lock:
+            self.spans.extend(records["spans"])
+            for name, timestamp, increment in records["counter_increments"]:
+                self.counters[name] = self.counters.get(name, 0) + increment
+                self.counter_events.append((name, timestamp, self.counters[name]))
+
+    def save(self, path: str, trace_format: str = "json") -> None:
+        if trace_format == "chrome":
+            data = {"traceEvents": self._get_chrome_events(), "displayTimeUnit": "ms"}
+        elif trace_format == "json":
+            data = {"summary": self.get_summary(), "spans": self._get_span_records()}
+        else:
+            raise ValueError(f"The trace format must be 'json' or 'chrome': {trace_format}")
+        with open(path, 'w') as f:
+            json.dump(data, f, indent = 1)
+        print(f"Trace written to '{path}'")
+
+    def get_summary(self) -> dict:
+        """
+        Returns the total time of each span name, the total of each counter, each counter's rate over the run, and the
+        peak CUDA memory (of the 'memory' spans) and peak RSS (of the process, so far).
+        """
+        elapsed = time.perf_counter() - self.start
+        spans = {}
+        for name, start, end, _, _ in self.spans:
+            summary = spans.setdefault(name, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            summary["count"] += 1
+            summary["total_seconds"] += end - start
+            summary["max_seconds"] = max(summary["max_seconds"], end - start)
+        # NOTE: The RSS at the end of a span misses anything allocated and freed within it, so use the high-water mark.
+        peaks = {"peak_rss_mb": self._get_peak_rss() / (1 << 20)}
+        for _, _, _, _, args in self.spans:
+            if args.get("peak_cuda_mb") is not None:
+                peaks["peak_cuda_mb"] = max(peaks.get("peak_cuda_mb", 0.0), args["peak_cuda_mb"])
+        return {
+            "elapsed_seconds": elapsed,
+            "spans": spans,
+            "counters": dict(self.counters),
+            "rates_per_second": {name: value / elapsed for name, value in self.counters.items()} if elapsed > 0 else {},
+            "peak_memory": peaks,
+        }
+
+    def _add_span(self, name: str, start: float, end: float, args: dict) -> None:
+        with self.lock:
+            self.spans.append((name, start, end, threading.get_ident(), args))
+
+    def _get_span_records(self) -> list:
+        return [
+            {"name": name, "start": start - self.start, "seconds": end - start, "thread": thread, **args}
+            for name, start, end, thread, args in self.spans
+        ]
+
+    def _get_chrome_events(self) -> list:
+        pid = os.getpid()
+        events = [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.start) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": thread,
+                "args": args,
+            }
+            for name, start, end, thread, args in self.spans
+        ]
+        events += [
+            {"name": name, "ph": "C", "ts": (timestamp - self.start) * 1e6, "pid": pid, "args": {name: value}}
+            for name, timestamp, value in self.counter_events
+        ]
+        return events
+
+    def _reset_peak_memory(self) -> None:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _get_memory(self) -> dict:
+        import torch
+        memory = {"rss_mb": self._get_rss() / (1 << 20), "peak_rss_mb": self._get_peak_rss() / (1 << 20)}
+        if torch.cuda.is_available():
+            memory["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / (1 << 20)
+        return memory
+
+    @staticmethod
+    def _get_rss() -> int:
+        try:
+            with open("/proc/self/statm", 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return 0
+
+    @staticmethod
+    def _get_peak_rss() -> int:
+        try:
+            import resource
+        except ImportError:
+            return 0
+        # NOTE: Linux reports the maximum resident set size in KiB, and macOS in bytes.
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+# The process-wide tracer (disabled until enable() is called).
+_tracer = Tracer()
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+def enable() -> None:
+    _tracer.enable()
+
+def is_enabled() -> bool:
+    return _tracer.enabled
+
+def span(name: str, memory: bool = False, **args):
+    return _tracer.span(name, memory, **args)
+
+def count(name: str, value: float = 1) -> None:
+    _tracer.count(name, value)
+
+def collect() -> dict:
+    return _tracer.collect()
+
+def merge(records: dict) -> None:
+    _tracer.merge(records)
+
+def save(path: str, trace_format: str = "json") -> None:
+    _tracer.save(path, trace_format)
+
+def get_summary() -> Optional[dict]:
+    return _tracer.get_summary() if _tracer.enabled else None
@@ -0,0 +1,157 @@
+import os
+import re
+import sys
+import json
+import mmap
+import shutil
+import struct
+import torch
+import tracing
+import concurrent.futures
+
+from typing import Union, List, Tuple
+
+from gguf_exporter import ModelMetadata
+from direction_analyzer import compute_layer_range
+
+# See: https://github.com/huggingface/safetensors (the file format is an 8 byte header size, a JSON header then the data).
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+}
+
+DOWN_PROJ_PATTERN = re.compile(r"^(?:.*\.)?layers\.(\d+)\.mlp\.down_proj\.weight$")
+
+def read_safetensors_header(file_path: Union[str, os.PathLike]) -> Tuple[dict, int]:
+    """
+    Reads the header of a '.safetensors' file.
+
+    Returns:
+        tuple: The header (tensor name -> dtype, shape and data offsets) and the file offset of the data.
+    """
+    with open(file_path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+def get_safetensors_shards(pretrained_model_name_or_path: Union[str, os.PathLike]) -> List[str]:
+    index_path = os.path.join(pretrained_model_name_or_path, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            weight_map = json.load(f)["weight_map"]
+        return sorted(set(weight_map.values()))
+    if os.path.exists(os.path.join(pretrained_model_name_or_path, "model.safetensors")):
+        return ["model.safetensors"]
+    raise FileNotFoundError(f"No '.safetensors' weights found in '{pretrained_model_name_or_path}'")
+
+def orthogonalize_weight(weight_matrix: torch.Tensor, direction_matrix: torch.Tensor) -> torch.Tensor:
+    """
+    Projects the directions out of a weight matrix's outputs: (I - V^T * V) * W, computed as the rank-k update W - V^T * (V * W).
+
+    Parameters:
+        weight_matrix (torch.Tensor): The [d, m] weight matrix (eg: 'down_proj' which writes to the residual stream).
+        direction_matrix (torch.Tensor): The [k, d] unit directions (as rows).
+
+    Returns:
+        torch.Tensor: The modified weight matrix (in the original dtype).
+    """
+    dtype = weight_matrix.dtype
+    weight_matrix = weight_matrix.to(torch.float32)
+    weight_matrix = weight_matrix - torch.mm(direction_matrix.t(), torch.mm(direction_matrix, weight_matrix))
+    return weight_matrix.to(dtype)
+
+def orthogonalize_checkpoint(
+    pretrained_model_name_or_path: Union[str, os.PathLike],
+    output_path: Union[str, os.PathLike],
+    direction_matrix: torch.Tensor,
+    skip_begin_layers = 0,
+    skip_end_layers = 0,
+    num_workers: int = 1
+) -> None:
+    """
+    Orthogonalizes the 'down_proj' weights of a checkpoint against the directions, streaming one tensor at a time.
+
+    The files are copied to 'output_path' and the modified tensors are then written in place (their dtypes, shapes and
+    offsets are unchanged), so the model is never loaded and peak memory is a few tensors (per worker).
+
+    NOTE: This is an API-only entry point (used by benchmark.py), as the directions come from the analysis in memory;
+          create_control_vectors.py has no orthogonalization option and ModelHandler.modify_tensors() edits a loaded model.
+
+    Parameters:
+        pretrained_model_name_or_path: The folder of the model to modify.
+        output_path: The folder to save the modified model to.
+        direction_matrix (torch.Tensor): The [k, d] directions (as rows) to project out.
+        skip_begin_layers (int or float): The number (or fraction) of initial layers to skip.
+        skip_end_layers (int or float): The number (or fraction) of end layers to skip.
+        num_workers (int): The number of tensors to modify in parallel.
+    """
+    # Each vector must have unit norm so V.V^T correctly computes the projection onto the subspace.
+    # NOTE: The projection matrix calculation is invariant to the signs of the vectors though...
+    direction_matrix = torch.nn.functional.normalize(direction_matrix.to(torch.float32), p = 2, dim = 1)
+
+    # The source files are read while the copies are written, so they can't be the same files.
+    if os.path.exists(output_path) and os.path.samefile(pretrained_model_name_or_path, output_path):
+        raise ValueError(f"The output path must not be the model's own folder (it can't be modified in place): '{output_path}'")
+
+    model_metadata = ModelMetadata(pretrained_model_name_or_path)
+    layer_indices = set(compute_layer_range(model_metadata.get_num_layers(), skip_begin_layers, skip_end_layers))
+
+    # Copy everything (config, tokenizer, weights, etc) first.
+    print(f"Copying '{pretrained_model_name_or_path}' to '{output_path}'... ", end = "")
+    sys.stdout.flush()
+    os.makedirs(output_path, exist_ok = True)
+    for filename in sorted(os.listdir(pretrained_model_name_or_path)):
+        source_path = os.path.join(pretrained_model_name_or_path, filename)
+        if os.path.isfile(source_path):
+            shutil.copyfile(source_path, os.path.join(output_path, filename))
+    print("Done.")
+
+    num_modified = 0
+    for shard in get_safetensors_shards(pretrained_model_name_or_path):
+        header, data_offset = read_safetensors_header(os.path.join(pretrained_model_name_or_path, shard))
+        tensor_names = [
+            name for name in header
+            if name != "__metadata__" and (match := DOWN_PROJ_PATTERN.match(name)) and int(match.group(1)) in layer_indices
+        ]
+        if not tensor_names:
+            continue
+
+        print(f"Modifying {len(tensor_names)} tensors in '{shard}'... ", end = "")
+        sys.stdout.flush()
+
+        # NOTE: Copy-on-write mapping, so the tensors can be viewed without PyTorch warning about read-only buffers.
+        with open(os.path.join(pretrained_model_name_or_path, shard), 'rb') as source_file, \
+             open(os.path.join(output_path, shard), 'r+b') as output_file, \
+             mmap.mmap(source_file.fileno(), 0, access = mmap.ACCESS_COPY) as source:
+
+            def modify(name):
+                with tracing.span("orthogonalize_tensor", tensor = name):
+                    modify_tensor(name)
+
+            def modify_tensor(name):
+                info = header[name]
+                if info["dtype"] not in SAFETENSORS_DTYPES:
+                    raise ValueError(f"Unsupported dtype '{info['dtype']}' for '{name}'")
+                dtype = SAFETENSORS_DTYPES[info["dtype"]]
+                start, end = info["data_offsets"]
+                weight_matrix = torch.frombuffer(
+                    source,
+                    dtype = dtype,
+                    count = (end - start) // dtype.itemsize,
+                    offset = data_offset + start
+                ).reshape(info["shape"])
+                weight_matrix = orthogonalize_weight(weight_matrix, direction_matrix)
+                os.pwrite(output_file.fileno(), weight_matrix.contiguous().view(torch.uint8).numpy().tobytes(), data_offset + start)
+                tracing.count("bytes_written", end - start)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, num_workers)) as executor:
+                for future in [executor.submit(modify, name) for name in tensor_names]:
+                    future.result()
+
+        num_modified += len(tensor_names)
+        print("Done.")
+
+    if num_modified != len(layer_indices):
+        print(f"WARNING: Only {num_modified} of {len(layer_indices)} 'down_proj' tensors were found and modified.")